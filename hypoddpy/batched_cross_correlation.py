@@ -0,0 +1,183 @@
+"""
+Batched FFT cross correlation of pick snippets.
+
+This is a vectorized replacement for calling
+obspy.signal.cross_correlation.xcorr_pick_correction() once per pick pair. All
+snippets of one station, phase and channel are cut to a common window
+around their picks and stacked into a 2-D array. Their spectra are calculated
+once and the normalized cross correlation of every requested pair is
+obtained from a batched inverse FFT. The sub-sample refinement is the same as
+in xcorr_pick_correction(): A parabola is fitted to the convex part of the
+cross correlation function around its maximum; its vertex gives the pick
+correction and the correlation coefficient.
+
+Tolerance
+=========
+
+For identical snippets the results agree with xcorr_pick_correction() to
+within 1E-6 s in the pick correction and 1E-6 in the correlation coefficient.
+The remaining differences are caused by the FFT instead of the direct
+correlation and by the window length: The windows here always have the same
+number of samples whereas slicing a trace might yield one sample more or less
+depending on the pick time. In that case the differences can reach a few
+percent of a sample in the correction and about 1E-3 in the coefficient.
+
+A fit that cannot be performed because less than three samples are convex
+around the maximum is reported as invalid.
+"""
+import numpy as np
+
+
+# Maximum number of pairs correlated at once to bound the memory usage.
+PAIR_CHUNK_SIZE = 4096
+
+
+def _next_power_of_two(number):
+    return 1 << int(np.ceil(np.log2(number)))
+
+
+def stack_windows(snippets, pick_times, t_before, t_after, cc_maxlag):
+    """
+    Cut the cross correlation windows of all snippets and stack them.
+
+    All snippets must have the same sampling rate. The window of each
+    snippet is the same one xcorr_pick_correction() uses, e.g. it spans from
+    pick_time - t_before - cc_maxlag / 2 to pick_time + t_after +
+    cc_maxlag / 2.
+
+    :param snippets: List of traces.
+    :param pick_times: List of pick times, one per snippet.
+
+    Returns a float64 array with one row per snippet and a boolean array
+    which is False for all snippets not covering their full window.
+    """
+    sampling_rate = snippets[0].stats.sampling_rate
+    npts = int(round((t_before + t_after + cc_maxlag) * sampling_rate)) + 1
+    data = np.zeros((len(snippets), npts), dtype=np.float64)
+    valid = np.zeros(len(snippets), dtype=np.bool_)
+    for _i, (snippet, pick_time) in enumerate(zip(snippets, pick_times)):
+        start = pick_time - t_before - (cc_maxlag / 2.0)
+        first = int(round((start - snippet.stats.starttime) * sampling_rate))
+        if first < 0 or first + npts > snippet.stats.npts:
+            continue
+        data[_i] = snippet.data[first:first + npts]
+        valid[_i] = True
+    return data, valid
+
+
+def correlate_pairs(data, pairs, shift_len):
+    """
+    Normalized cross correlation of all requested pairs of rows of data.
+
+    Equivalent to obspy.signal.cross_correlation.correlate(data[i], data[j],
+    shift_len) with demeaning and naive normalization for every pair (i, j).
+
+    :param data: 2-D array with one signal per row.
+    :param pairs: Integer array of shape (M, 2) with row indices.
+    :param shift_len: Maximum shift in samples.
+
+    Returns an array of shape (M, 2 * shift_len + 1).
+    """
+    data = data - data.mean(axis=1)[:, np.newaxis]
+    energy = (data ** 2).sum(axis=1)
+    npts = data.shape[1]
+    nfft = _next_power_of_two(npts + shift_len)
+    spectra = np.fft.rfft(data, nfft, axis=1)
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    cc = np.empty((len(pairs), 2 * shift_len + 1), dtype=np.float64)
+    for start in xrange(0, len(pairs), PAIR_CHUNK_SIZE):
+        chunk = pairs[start:start + PAIR_CHUNK_SIZE]
+        full = np.fft.irfft(spectra[chunk[:, 0]] *
+                            np.conj(spectra[chunk[:, 1]]), nfft, axis=1)
+        # Negative lags are wrapped around to the end.
+        if shift_len:
+            cc[start:start + len(chunk), :shift_len] = full[:, -shift_len:]
+        cc[start:start + len(chunk), shift_len:] = full[:, :shift_len + 1]
+        norm = np.sqrt(energy[chunk[:, 0]] * energy[chunk[:, 1]])
+        norm[norm == 0] = np.inf
+        cc[start:start + len(chunk)] /= norm[:, np.newaxis]
+    return cc
+
+
+def refine_peaks(cc, cc_maxlag):
+    """
+    Sub-sample refinement of the cross correlation maxima.
+
+    Fits a parabola to the convex part around the maximum of each row just
+    like xcorr_pick_correction() does.
+
+    :param cc: Array of shape (M, 2 * shift_len + 1) as returned by
+        correlate_pairs().
+    :param cc_maxlag: Maximum lag time in seconds corresponding to shift_len.
+
+    Returns the pick corrections for the second picks, the correlation
+    coefficients and a boolean array marking the valid fits.
+    """
+    n_pairs, length = cc.shape
+    shift_len = (length - 1) // 2
+    cc_t = np.linspace(-cc_maxlag, cc_maxlag, shift_len * 2 + 1)
+    curvature = np.zeros_like(cc)
+    curvature[:, 1:-1] = np.diff(cc, 2, axis=1)
+    peak = cc.argmax(axis=1)
+    index = np.arange(length)[np.newaxis, :]
+    positive = curvature > 0
+    # First and last sample of the concave region around the peak.
+    left = np.where(positive & (index < peak[:, np.newaxis]), index, -1)
+    first = left.max(axis=1) + 1
+    right = np.where(positive & (index > peak[:, np.newaxis]), index, length)
+    last = right.min(axis=1) - 1
+    valid = (last - first + 1) >= 3
+    # Weighted least squares fit of a parabola in time relative to the peak
+    # to keep the normal equations well conditioned.
+    weights = ((index >= first[:, np.newaxis]) &
+               (index <= last[:, np.newaxis])).astype(np.float64)
+    t = cc_t[np.newaxis, :] - cc_t[peak][:, np.newaxis]
+    powers = [(weights * t ** _i).sum(axis=1) for _i in range(5)]
+    matrix = np.empty((n_pairs, 3, 3), dtype=np.float64)
+    for row in range(3):
+        for col in range(3):
+            matrix[:, row, col] = powers[4 - row - col]
+    rhs = np.empty((n_pairs, 3), dtype=np.float64)
+    for row in range(3):
+        rhs[:, row] = (weights * cc * t ** (2 - row)).sum(axis=1)
+    # Do not try to solve the singular systems of invalid fits.
+    matrix[~valid] = np.eye(3)
+    rhs[~valid] = (1.0, 0.0, 0.0)
+    coeffs = np.linalg.solve(matrix, rhs[:, :, np.newaxis])[:, :, 0]
+    a, b, c = coeffs[:, 0], coeffs[:, 1], coeffs[:, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vertex = -b / (2.0 * a)
+        coeff = c - b ** 2 / (4.0 * a)
+    # The vertex is the shift of the second trace. The pick correction is
+    # its negative.
+    pick2_corr = -(cc_t[peak] + vertex)
+    valid &= np.isfinite(pick2_corr) & np.isfinite(coeff)
+    return pick2_corr, coeff, valid
+
+
+def xcorr_pick_pairs(snippets, pick_times, pairs, t_before, t_after,
+                     cc_maxlag):
+    """
+    Batched equivalent of xcorr_pick_correction() for many pick pairs.
+
+    All snippets must belong to the same channel and have the same sampling
+    rate.
+
+    :param snippets: List of pre-processed traces.
+    :param pick_times: List of pick times, one per snippet.
+    :param pairs: List of (index_1, index_2) tuples into snippets.
+
+    Returns the corrections for the second picks, the correlation
+    coefficients and a boolean array marking valid results.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    if not len(pairs):
+        empty = np.empty(0, dtype=np.float64)
+        return empty, empty, np.empty(0, dtype=np.bool_)
+    data, covered = stack_windows(snippets, pick_times, t_before, t_after,
+                                  cc_maxlag)
+    shift_len = int(cc_maxlag * snippets[0].stats.sampling_rate)
+    cc = correlate_pairs(data, pairs, shift_len)
+    pick2_corr, coeff, valid = refine_peaks(cc, cc_maxlag)
+    valid &= covered[pairs[:, 0]] & covered[pairs[:, 1]]
+    return pick2_corr, coeff, valid
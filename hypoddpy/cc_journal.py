@@ -0,0 +1,152 @@
+"""
+Append-only journal for the dt.cc blocks of the cross correlated event pairs.
+
+Every finished event pair is immediately appended to one journal file. A
+second file holds one line per block with the event pair, the byte offset and
+the length of the block. Interrupted runs are resumed by replaying the index;
+a block whose index line has not been written completely is discarded.
+
+A journal can be tied to a fingerprint of everything its blocks depend on.
+If it is opened with a different fingerprint all blocks are discarded.
+
+The final dt.cc file is streamed block by block from the journal so the whole
+file never has to be held in memory.
+"""
+import os
+
+
+class CrossCorrelationJournal(object):
+    """
+    Journal of dt.cc blocks keyed by event pair.
+
+    Usage
+    =====
+
+    >>> journal = CrossCorrelationJournal("dt.cc.journal")
+    >>> if (1, 2) not in journal:
+    ...     journal.append((1, 2), "# 1  2 0.0\\nST.A 0.1 0.9 P")
+    >>> journal.write_dt_cc("dt.cc", [(1, 2)])
+    >>> journal.close()
+    """
+    def __init__(self, filename, fingerprint=None):
+        """
+        :param filename: The journal file. The index will be stored in
+            filename.index.
+        :param fingerprint: Optional fingerprint of the inputs of the blocks.
+            It is stored in filename.fingerprint. An existing journal with a
+            different fingerprint is emptied.
+        """
+        self.filename = filename
+        self.index_filename = filename + ".index"
+        self.fingerprint_filename = filename + ".fingerprint"
+        self._index = {}
+        if fingerprint is not None:
+            self._check_fingerprint(fingerprint)
+        self._replay()
+        self._data_file = open(self.filename, "ab")
+        self._index_file = open(self.index_filename, "ab")
+
+    def _check_fingerprint(self, fingerprint):
+        """
+        Remove all blocks if the journal has been written for a different
+        fingerprint and store the new one. Journals without a stored
+        fingerprint are kept.
+        """
+        if os.path.exists(self.fingerprint_filename):
+            with open(self.fingerprint_filename, "r") as open_file:
+                old_fingerprint = open_file.read().strip()
+            if old_fingerprint != fingerprint:
+                for filename in (self.filename, self.index_filename):
+                    if os.path.exists(filename):
+                        os.remove(filename)
+        with open(self.fingerprint_filename, "w") as open_file:
+            open_file.write(fingerprint)
+
+    def _replay(self):
+        """
+        Read the index and truncate both files to the last complete block.
+        """
+        data_size = 0
+        if os.path.exists(self.filename):
+            data_size = os.path.getsize(self.filename)
+        valid_index_size = 0
+        valid_data_size = 0
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, "rb") as open_file:
+                for line in open_file:
+                    if not line.endswith("\n"):
+                        break
+                    try:
+                        event_1, event_2, offset, length = map(int,
+                                                               line.split())
+                    except ValueError:
+                        break
+                    if offset + length > data_size:
+                        break
+                    self._index[(event_1, event_2)] = (offset, length)
+                    valid_index_size += len(line)
+                    valid_data_size = max(valid_data_size, offset + length)
+        # Remove everything not covered by the index.
+        for filename, size in ((self.index_filename, valid_index_size),
+                               (self.filename, valid_data_size)):
+            if os.path.exists(filename) and os.path.getsize(filename) > size:
+                with open(filename, "r+b") as open_file:
+                    open_file.truncate(size)
+
+    def __contains__(self, event_pair):
+        return tuple(event_pair) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def append(self, event_pair, block):
+        """
+        Append the dt.cc block of one event pair. The block is on disk once
+        this method returns.
+
+        :param event_pair: Tuple of the two numeric event ids.
+        :param block: The block as a string.
+        """
+        self._data_file.seek(0, os.SEEK_END)
+        offset = self._data_file.tell()
+        self._data_file.write(block)
+        self._data_file.flush()
+        # Only index the block after it has been written completely.
+        self._index_file.write("%i %i %i %i\n" % (event_pair[0],
+                                                  event_pair[1], offset,
+                                                  len(block)))
+        self._index_file.flush()
+        self._index[tuple(event_pair)] = (offset, len(block))
+
+    def write_dt_cc(self, filename, event_pairs):
+        """
+        Stream the blocks of the given event pairs in the given order to
+        filename. The blocks are separated by newlines; event pairs not in
+        the journal are skipped.
+        """
+        self._data_file.flush()
+        first = True
+        with open(self.filename, "rb") as journal_file:
+            with open(filename, "wb") as open_file:
+                for event_pair in event_pairs:
+                    entry = self._index.get(tuple(event_pair))
+                    if entry is None:
+                        continue
+                    offset, length = entry
+                    journal_file.seek(offset)
+                    if not first:
+                        open_file.write("\n")
+                    open_file.write(journal_file.read(length))
+                    first = False
+
+    def clear(self):
+        """
+        Discard all blocks.
+        """
+        self._data_file.truncate(0)
+        self._index_file.truncate(0)
+        self._index = {}
+
+    def close(self):
+        self._data_file.close()
+        self._index_file.close()
@@ -0,0 +1,79 @@
+"""
+Station-major scheduling of the cross correlation work.
+
+The event pairs in dt.ct are ordered by event, so consecutive pairs usually
+need waveforms of unrelated stations and days. Processing the work in that
+order defeats any waveform cache. Instead the event pairs are expanded into
+pick pairs, e.g. the picks of the same station and phase in both events, and
+these are grouped by station and time block. Every group only touches the
+waveforms of one station within a short time span, so the data stays
+resident while the group is processed.
+
+The results are keyed by pick pair. Every work item remembers its event pair
+so the dt.cc block of an event pair can be written as soon as all of its pick
+pairs are done; the final dt.cc is assembled in the original order of the
+event pairs.
+"""
+import math
+
+
+# Length of the time blocks in seconds. Waveform archives usually store one
+# file per channel and day.
+DEFAULT_TIME_BLOCK = 86400.0
+
+
+def get_work_key(pick, block_length=DEFAULT_TIME_BLOCK):
+    """
+    Returns the (station_id, time block) key of a pick.
+    """
+    return (pick["station_id"],
+            int(math.floor(pick["pick_time"].timestamp / block_length)))
+
+
+def sort_picks(picks, block_length=DEFAULT_TIME_BLOCK):
+    """
+    Returns the picks sorted by station, time block and pick time.
+    """
+    return sorted(picks, key=lambda pick: (
+        get_work_key(pick, block_length), pick["pick_time"].timestamp,
+        pick["id"]))
+
+
+def expand_pick_pairs(event_pairs, get_pick_pairs):
+    """
+    Expand event pairs into work items, e.g. pick pairs.
+
+    :param event_pairs: List of (event_1, event_2) tuples.
+    :param get_pick_pairs: Function returning the list of (pick_1, pick_2)
+        pick dictionary tuples of an event pair that need to be processed.
+
+    Returns a list of ((event_1, event_2), pick_1, pick_2) tuples in the
+    order of the event pairs.
+    """
+    work_items = []
+    for event_1, event_2 in event_pairs:
+        for pick_1, pick_2 in get_pick_pairs(event_1, event_2):
+            work_items.append(((event_1, event_2), pick_1, pick_2))
+    return work_items
+
+
+def group_pick_pairs(work_items, block_length=DEFAULT_TIME_BLOCK):
+    """
+    Group work items by the station and time block of their first pick.
+
+    :param work_items: List of (event_pair, pick_1, pick_2) tuples, see
+        expand_pick_pairs().
+
+    Returns a list of groups sorted by station and time block. Every group is
+    a list of work items sorted by the time of the first and then the second
+    pick.
+    """
+    groups = {}
+    for item in work_items:
+        groups.setdefault(get_work_key(item[1], block_length), []).append(
+            item)
+    result = []
+    for key in sorted(groups):
+        result.append(sorted(groups[key], key=lambda item: (
+            item[1]["pick_time"].timestamp, item[2]["pick_time"].timestamp)))
+    return result
@@ -0,0 +1,219 @@
+"""
+Compact on-disk store for cross correlation results based on SQLite.
+
+The relocator keeps its cross correlation results in a nested dictionary
+keyed by pick resource id strings with either (pick2_corr, cross_corr_coeff)
+tuples or error messages as values. This module stores the same information
+in a SQLite database:
+
+    * picks: Maps every pick resource id to an integer key.
+    * results: One row per pick pair with the integer keys of both picks, a
+      status code and the time correction and correlation coefficient.
+
+Error messages are replaced by the status codes defined below. Single
+results are looked up through the primary key without loading the store,
+new results are appended in transactions and stores of separate runs can be
+merged.
+"""
+import os
+import sqlite3
+
+
+# Status codes of the stored results.
+CC_OK = 0
+CC_NO_CROSS_CORRELATIONS = 1
+CC_MORE_THAN_ONE_TRACE = 2
+CC_NO_MATCHING_TRACE = 3
+CC_NON_MATCHING_IDS = 4
+CC_NON_MATCHING_SAMPLING_RATES = 5
+CC_CROSS_CORRELATION_ERROR = 6
+CC_UNKNOWN_ERROR = 7
+
+# Message stored in the result dictionaries for every status code and the
+# prefixes used to recognize them.
+STATUS_MESSAGES = {
+    CC_NO_CROSS_CORRELATIONS: "No cross correlations performed",
+    CC_MORE_THAN_ONE_TRACE: "More than one matching trace found",
+    CC_NO_MATCHING_TRACE: "No matching trace found",
+    CC_NON_MATCHING_IDS: "Non matching ids during cross correlation.",
+    CC_NON_MATCHING_SAMPLING_RATES: "Non matching sampling rates during "
+                                    "cross correlation.",
+    CC_CROSS_CORRELATION_ERROR: "Error during cross correlating",
+    CC_UNKNOWN_ERROR: "Unknown cross correlation error"}
+
+# File extensions recognized as cross correlation stores.
+STORE_EXTENSIONS = [".sqlite", ".sqlite3", ".db"]
+
+
+def is_store_filename(filename):
+    """
+    True if the filename has one of the extensions used for stores.
+    """
+    return os.path.splitext(filename)[1].lower() in STORE_EXTENSIONS
+
+
+def encode_result(result):
+    """
+    Convert a result as stored in the relocator's result dictionary to a
+    (status, pick2_corr, cross_corr_coeff) tuple.
+    """
+    if isinstance(result, (list, tuple)) and len(result) == 2:
+        return CC_OK, float(result[0]), float(result[1])
+    if isinstance(result, basestring):
+        for status, message in STATUS_MESSAGES.iteritems():
+            if result.startswith(message):
+                return status, None, None
+    return CC_UNKNOWN_ERROR, None, None
+
+
+def decode_result(status, pick2_corr, cross_corr_coeff):
+    """
+    Inverse of encode_result(). Error codes are converted to their messages.
+    """
+    if status == CC_OK:
+        return (pick2_corr, cross_corr_coeff)
+    return STATUS_MESSAGES.get(status, STATUS_MESSAGES[CC_UNKNOWN_ERROR])
+
+
+class CrossCorrelationStore(object):
+    """
+    SQLite backed store of cross correlation results.
+
+    Usage
+    =====
+
+    >>> store = CrossCorrelationStore("cc_results.sqlite")
+    >>> store.add_results({"pick_1": {"pick_2": (0.01, 0.9)}})
+    >>> store.get("pick_1", "pick_2")
+    (0.01, 0.9)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._pid = None
+        self._connection = None
+        self._pick_keys = {}
+        self._get_connection()
+
+    def _get_connection(self):
+        """
+        Returns the connection to the database. SQLite connections must not
+        be shared between processes so every forked process opens its own.
+        """
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.filename)
+            self._pid = os.getpid()
+            self._pick_keys = {}
+            self._connection.executescript("""
+                PRAGMA synchronous = NORMAL;
+                CREATE TABLE IF NOT EXISTS picks (
+                    key INTEGER PRIMARY KEY,
+                    resource_id TEXT UNIQUE NOT NULL);
+                CREATE TABLE IF NOT EXISTS results (
+                    pick_1 INTEGER NOT NULL,
+                    pick_2 INTEGER NOT NULL,
+                    status INTEGER NOT NULL,
+                    pick2_corr REAL,
+                    cross_corr_coeff REAL,
+                    PRIMARY KEY (pick_1, pick_2)) WITHOUT ROWID;
+            """)
+        return self._connection
+
+    def _get_pick_key(self, resource_id, create=False):
+        """
+        Returns the integer key of a pick or None if it is unknown and create
+        is False.
+        """
+        key = self._pick_keys.get(resource_id)
+        if key is not None:
+            return key
+        connection = self._get_connection()
+        if create:
+            connection.execute(
+                "INSERT OR IGNORE INTO picks (resource_id) VALUES (?)",
+                (resource_id,))
+        row = connection.execute(
+            "SELECT key FROM picks WHERE resource_id = ?",
+            (resource_id,)).fetchone()
+        if row is None:
+            return None
+        self._pick_keys[resource_id] = row[0]
+        return row[0]
+
+    def get(self, pick_id_1, pick_id_2):
+        """
+        Returns the result for the ordered pick pair or None if it is not in
+        the store.
+        """
+        key_1 = self._get_pick_key(pick_id_1)
+        key_2 = self._get_pick_key(pick_id_2)
+        if key_1 is None or key_2 is None:
+            return None
+        row = self._get_connection().execute(
+            "SELECT status, pick2_corr, cross_corr_coeff FROM results "
+            "WHERE pick_1 = ? AND pick_2 = ?", (key_1, key_2)).fetchone()
+        if row is None:
+            return None
+        return decode_result(*row)
+
+    def add_results(self, cc_results):
+        """
+        Append all results of a nested result dictionary in one transaction.
+        Existing results for the same pick pairs are replaced.
+        """
+        connection = self._get_connection()
+        with connection:
+            rows = []
+            for pick_id_1, items in cc_results.iteritems():
+                key_1 = self._get_pick_key(pick_id_1, create=True)
+                for pick_id_2, result in items.iteritems():
+                    key_2 = self._get_pick_key(pick_id_2, create=True)
+                    rows.append((key_1, key_2) + encode_result(result))
+            connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows)
+
+    def merge(self, filename):
+        """
+        Merge all results of the store in filename into this store. Results
+        of the other store win for pick pairs present in both.
+        """
+        connection = self._get_connection()
+        connection.execute("ATTACH DATABASE ? AS other", (filename,))
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR IGNORE INTO picks (resource_id) "
+                    "SELECT resource_id FROM other.picks")
+                connection.execute("""
+                    INSERT OR REPLACE INTO results
+                    SELECT p1.key, p2.key, r.status, r.pick2_corr,
+                           r.cross_corr_coeff
+                    FROM other.results AS r
+                    JOIN other.picks AS o1 ON o1.key = r.pick_1
+                    JOIN other.picks AS o2 ON o2.key = r.pick_2
+                    JOIN picks AS p1 ON p1.resource_id = o1.resource_id
+                    JOIN picks AS p2 ON p2.resource_id = o2.resource_id""")
+        finally:
+            connection.execute("DETACH DATABASE other")
+
+    def iterresults(self):
+        """
+        Iterate over all (pick_id_1, pick_id_2, result) tuples in the store.
+        """
+        cursor = self._get_connection().execute("""
+            SELECT p1.resource_id, p2.resource_id, r.status, r.pick2_corr,
+                   r.cross_corr_coeff
+            FROM results AS r
+            JOIN picks AS p1 ON p1.key = r.pick_1
+            JOIN picks AS p2 ON p2.key = r.pick_2""")
+        for pick_id_1, pick_id_2, status, pick2_corr, coeff in cursor:
+            yield pick_id_1, pick_id_2, decode_result(status, pick2_corr,
+                                                      coeff)
+
+    def __len__(self):
+        return self._get_connection().execute(
+            "SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,268 @@
+"""
+Extraction of the event and pick information needed for the relocation from
+event files.
+
+QuakeML files are parsed incrementally: Every event element is converted to a
+dictionary as soon as it is complete and then removed from the document, so
+the memory usage does not grow with the size of the file. read_event_table()
+collects the dictionaries in chunks in the compact columns of an EventTable,
+so a whole file is never held as dictionaries. Files in any other
+format supported by ObsPy and QuakeML files the streaming parser does not
+understand are read with obspy.core.event.read_events() instead.
+
+Every event is a dictionary with the keys
+
+    * event_id
+    * magnitude - The first magnitude.
+    * origin_time, origin_latitude, origin_longitude, origin_depth and the
+      respective uncertainties *_error, which default to 0.0 - Always from the
+      first origin.
+    * picks - A list of dictionaries with the keys id, pick_time,
+      pick_time_error, station_id (NETWORK.STATION) and phase.
+"""
+import itertools
+
+from lxml import etree
+from obspy.core import UTCDateTime
+from obspy.core.event import read_events
+
+from event_table import EventTable
+
+
+QUAKEML_BED_NAMESPACES = ["http://quakeml.org/xmlns/bed/1.2",
+                          "http://quakeml.org/xmlns/bed-rt/1.2"]
+
+# Number of event dictionaries converted to an event table at once.
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class QuakeMLStreamError(Exception):
+    """
+    Raised if an event cannot be parsed by the streaming parser.
+    """
+    pass
+
+
+def get_local_name(element):
+    """
+    Returns the tag of an element without its namespace or None if the
+    element is not part of the QuakeML BED namespace.
+    """
+    tag = element.tag
+    if not isinstance(tag, basestring):
+        # Comments and processing instructions.
+        return None
+    if tag.startswith("{"):
+        namespace, tag = tag[1:].split("}", 1)
+        if namespace not in QUAKEML_BED_NAMESPACES:
+            return None
+    return tag
+
+
+def _get_child(element, name):
+    """
+    Returns the first child of an element with the given local name or None.
+    """
+    for child in element:
+        if get_local_name(child) == name:
+            return child
+    return None
+
+
+def _get_text(element, *path):
+    """
+    Returns the stripped text of the element at the given path of local
+    names below element or None.
+    """
+    for name in path:
+        element = _get_child(element, name)
+        if element is None:
+            return None
+    if element.text is None:
+        return None
+    return element.text.strip()
+
+
+def _get_quantity(element, name, converter):
+    """
+    Returns the value and the uncertainty of a QuakeML quantity. A missing
+    uncertainty is returned as None.
+    """
+    value = _get_text(element, name, "value")
+    if value is None:
+        msg = "Missing value of %s." % name
+        raise QuakeMLStreamError(msg)
+    uncertainty = _get_text(element, name, "uncertainty")
+    if uncertainty is not None:
+        uncertainty = float(uncertainty)
+    return converter(value), uncertainty
+
+
+def _parse_event_element(element):
+    """
+    Convert an event element to the event dictionary.
+    """
+    event = {}
+    event["event_id"] = element.get("publicID")
+    origin = _get_child(element, "origin")
+    magnitude = _get_child(element, "magnitude")
+    if event["event_id"] is None or origin is None or magnitude is None:
+        msg = "Event without id, origin or magnitude."
+        raise QuakeMLStreamError(msg)
+    # Take the value from the first magnitude.
+    event["magnitude"] = _get_quantity(magnitude, "mag", float)[0]
+    # Always take the first origin.
+    for key, name, converter in [("origin_time", "time", UTCDateTime),
+                                 ("origin_latitude", "latitude", float),
+                                 ("origin_longitude", "longitude", float),
+                                 ("origin_depth", "depth", float)]:
+        value, uncertainty = _get_quantity(origin, name, converter)
+        event[key] = value
+        event[key + "_error"] = uncertainty if uncertainty is not None \
+            else 0.0
+    # Also append all picks.
+    event["picks"] = []
+    for child in element:
+        if get_local_name(child) != "pick":
+            continue
+        waveform_id = _get_child(child, "waveformID")
+        if child.get("publicID") is None or waveform_id is None:
+            msg = "Pick without id or waveform id."
+            raise QuakeMLStreamError(msg)
+        pick = {}
+        pick["id"] = child.get("publicID")
+        pick["pick_time"], pick["pick_time_error"] = _get_quantity(
+            child, "time", UTCDateTime)
+        # Missing codes are empty like in the ObsPy based reader.
+        pick["station_id"] = "%s.%s" % (
+            waveform_id.get("networkCode") or "",
+            waveform_id.get("stationCode") or "")
+        pick["phase"] = _get_text(child, "phaseHint")
+        event["picks"].append(pick)
+    return event
+
+
+def iter_event_elements(filename):
+    """
+    Generator yielding the event elements of a QuakeML file. Every event
+    element is cleared and removed from the document once the next one is
+    requested.
+
+    Raises QuakeMLStreamError if the file is not a QuakeML file.
+    """
+    context = etree.iterparse(filename, events=("start", "end"),
+                              remove_blank_text=True, huge_tree=True)
+    root = None
+    for action, element in context:
+        if root is None:
+            root = element
+            tag = root.tag if isinstance(root.tag, basestring) else ""
+            if not tag.endswith("}quakeml"):
+                msg = "Not a QuakeML file."
+                raise QuakeMLStreamError(msg)
+        if action != "end" or get_local_name(element) != "event":
+            continue
+        parent = element.getparent()
+        if parent is None or get_local_name(parent) != "eventParameters":
+            continue
+        yield element
+        # Free the element and all of its already processed siblings.
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def iter_quakeml_events(filename):
+    """
+    Generator yielding the event dictionaries of a QuakeML file. Every event
+    element is discarded after it has been converted.
+
+    Raises QuakeMLStreamError if the file is not a QuakeML file or contains
+    events that cannot be parsed.
+    """
+    for element in iter_event_elements(filename):
+        yield _parse_event_element(element)
+
+
+def _convert_obspy_event(event):
+    """
+    Convert an ObsPy event to the event dictionary.
+    """
+    current_event = {}
+    current_event["event_id"] = str(event.resource_id)
+    # Take the value from the first magnitude.
+    current_event["magnitude"] = event.magnitudes[0].mag
+    # Always take the first origin.
+    origin = event.origins[0]
+    for key, name in [("origin_time", "time"),
+                      ("origin_latitude", "latitude"),
+                      ("origin_longitude", "longitude"),
+                      ("origin_depth", "depth")]:
+        current_event[key] = getattr(origin, name)
+        uncertainty = getattr(origin, name + "_errors").uncertainty
+        current_event[key + "_error"] = uncertainty \
+            if uncertainty is not None else 0.0
+    # Also append all picks.
+    current_event["picks"] = []
+    for pick in event.picks:
+        current_pick = {}
+        current_pick["id"] = str(pick.resource_id)
+        current_pick["pick_time"] = pick.time
+        if hasattr(pick.time_errors, "uncertainty"):
+            current_pick["pick_time_error"] = \
+                pick.time_errors.uncertainty
+        else:
+            current_pick["pick_time_error"] = None
+        current_pick["station_id"] = "%s.%s" % \
+            (pick.waveform_id.network_code,
+             pick.waveform_id.station_code)
+        current_pick["phase"] = pick.phase_hint
+        current_event["picks"].append(current_pick)
+    return current_event
+
+
+def read_event_file(filename):
+    """
+    Returns the event dictionaries of all events in an event file in the
+    order of the file.
+
+    QuakeML files are parsed incrementally, all other files and QuakeML files
+    the streaming parser cannot handle are read with ObsPy.
+    """
+    try:
+        return list(iter_quakeml_events(filename))
+    except (QuakeMLStreamError, etree.XMLSyntaxError, ValueError):
+        pass
+    return [_convert_obspy_event(_i) for _i in read_events(filename)]
+
+
+def _to_event_table(events, chunk_size):
+    """
+    Convert an iterable of event dictionaries to an EventTable chunk by
+    chunk.
+    """
+    tables = []
+    while True:
+        chunk = list(itertools.islice(events, chunk_size))
+        if not chunk:
+            break
+        tables.append(EventTable.from_events(chunk))
+    return EventTable.concatenate(tables)
+
+
+def read_event_table(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns an EventTable with all events in an event file in the order of
+    the file, see read_event_file().
+
+    Only chunk_size event dictionaries are held in memory at a time. The
+    table is much smaller than the dictionaries and therefore also cheaper
+    to send back from a worker process.
+    """
+    try:
+        return _to_event_table(iter_quakeml_events(filename), chunk_size)
+    except (QuakeMLStreamError, etree.XMLSyntaxError, ValueError):
+        pass
+    return _to_event_table(
+        itertools.imap(_convert_obspy_event, read_events(filename)),
+        chunk_size)
@@ -0,0 +1,410 @@
+"""
+Columnar storage of the event and pick information.
+
+All events are stored as NumPy arrays with one entry per event and all picks
+as arrays with one entry per pick. The picks of the event at position i are
+the picks pick_offsets[i]:pick_offsets[i + 1]. Times are stored as int64
+nanoseconds, station ids and phases as indices into small lookup arrays and
+missing values as NaN or -1.
+
+A table is saved as a directory with one .npy file per column. The files are
+memory mapped when loading so a table is available almost immediately and
+only the parts actually accessed are read.
+
+The event dictionaries used throughout the relocator (see event_reader.py)
+are created on access. Picks are looked up by event, station and phase in a
+sorted array of keys of all picks, so the picks of an event pair can be
+matched without creating any dictionaries.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+from obspy.core import UTCDateTime
+
+
+TABLE_VERSION = 1
+
+EVENT_FLOAT_COLUMNS = ["magnitude", "origin_time_error", "origin_latitude",
+                       "origin_latitude_error", "origin_longitude",
+                       "origin_longitude_error", "origin_depth",
+                       "origin_depth_error"]
+COLUMNS = ["event_id", "origin_time"] + EVENT_FLOAT_COLUMNS + \
+    ["pick_offsets", "pick_id", "pick_time", "pick_time_error",
+     "pick_station", "pick_phase", "stations", "phases"]
+
+
+def _to_string_array(values):
+    """
+    Convert a list of strings to a fixed width byte string array with UTF-8
+    encoding.
+    """
+    values = [_i.encode("utf-8") if isinstance(_i, unicode) else str(_i)
+              for _i in values]
+    width = max([len(_i) for _i in values] or [1]) or 1
+    return np.array(values, dtype="S%i" % width)
+
+
+def _to_float(value):
+    return np.nan if value is None else float(value)
+
+
+def _from_float(value):
+    return None if np.isnan(value) else float(value)
+
+
+class EventTable(object):
+    """
+    Columnar, memory mappable representation of a list of event
+    dictionaries.
+
+    Usage
+    =====
+
+    >>> table = EventTable.from_events(events)
+    >>> table.save("event_table")
+    >>> table = EventTable.load("event_table")
+    >>> event = table[0]
+    >>> latitudes = table.get_column("origin_latitude")
+    """
+    def __init__(self, columns):
+        """
+        :param columns: Dictionary with all arrays listed in COLUMNS.
+        """
+        self.columns = columns
+        self.stations = [_i.decode("utf-8") for _i in columns["stations"]]
+        self.phases = [_i.decode("utf-8") for _i in columns["phases"]]
+        self._station_index = dict((_j, _i) for _i, _j in
+                                   enumerate(self.stations))
+        self._phase_index = dict((_j, _i) for _i, _j in
+                                 enumerate(self.phases))
+        # Sorted (event, station, phase) keys of all picks and the pick
+        # indices in the same order. Created on first use.
+        self._pick_keys = None
+        self._pick_order = None
+
+    @classmethod
+    def from_events(cls, events):
+        """
+        Create a table from a list of event dictionaries.
+        """
+        columns = {}
+        columns["event_id"] = _to_string_array(
+            [_i["event_id"] for _i in events])
+        columns["origin_time"] = np.array(
+            [_i["origin_time"].ns for _i in events], dtype=np.int64)
+        for name in EVENT_FLOAT_COLUMNS:
+            columns[name] = np.array([_to_float(_i[name]) for _i in events],
+                                     dtype=np.float64)
+        picks = [_j for _i in events for _j in _i["picks"]]
+        columns["pick_offsets"] = np.cumsum(
+            [0] + [len(_i["picks"]) for _i in events]).astype(np.int64)
+        columns["pick_id"] = _to_string_array([_i["id"] for _i in picks])
+        columns["pick_time"] = np.array(
+            [_i["pick_time"].ns for _i in picks], dtype=np.int64)
+        columns["pick_time_error"] = np.array(
+            [_to_float(_i["pick_time_error"]) for _i in picks],
+            dtype=np.float64)
+        stations = sorted(set(_i["station_id"] for _i in picks))
+        station_index = dict((_j, _i) for _i, _j in enumerate(stations))
+        columns["stations"] = _to_string_array(stations)
+        columns["pick_station"] = np.array(
+            [station_index[_i["station_id"]] for _i in picks],
+            dtype=np.int32)
+        # Missing phases are stored as -1.
+        phases = sorted(set(_i["phase"] for _i in picks
+                            if _i["phase"] is not None))
+        phase_index = dict((_j, _i) for _i, _j in enumerate(phases))
+        columns["phases"] = _to_string_array(phases)
+        columns["pick_phase"] = np.array(
+            [phase_index.get(_i["phase"], -1) for _i in picks],
+            dtype=np.int32)
+        return cls(columns)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Create a table with the events of all tables in the given order.
+        """
+        if not tables:
+            return cls.from_events([])
+        stations = sorted(set(_j for _i in tables for _j in _i.stations))
+        phases = sorted(set(_j for _i in tables for _j in _i.phases))
+        station_index = dict((_j, _i) for _i, _j in enumerate(stations))
+        phase_index = dict((_j, _i) for _i, _j in enumerate(phases))
+        columns = {}
+        for name in ["event_id", "origin_time"] + EVENT_FLOAT_COLUMNS + \
+                ["pick_id", "pick_time", "pick_time_error"]:
+            columns[name] = np.concatenate(
+                [np.asarray(_i.columns[name]) for _i in tables])
+        counts = np.concatenate(
+            [np.diff(_i.columns["pick_offsets"]) for _i in tables])
+        columns["pick_offsets"] = np.concatenate(
+            [[0], np.cumsum(counts)]).astype(np.int64)
+        pick_stations = []
+        pick_phases = []
+        for table in tables:
+            # Map the station and phase indices to the merged lookups. The
+            # last entry maps missing phases (-1) to -1 again.
+            station_map = np.array(
+                [station_index[_i] for _i in table.stations] + [-1],
+                dtype=np.int32)
+            phase_map = np.array(
+                [phase_index[_i] for _i in table.phases] + [-1],
+                dtype=np.int32)
+            pick_stations.append(station_map[table.columns["pick_station"]])
+            pick_phases.append(phase_map[table.columns["pick_phase"]])
+        columns["pick_station"] = np.concatenate(pick_stations)
+        columns["pick_phase"] = np.concatenate(pick_phases)
+        columns["stations"] = _to_string_array(stations)
+        columns["phases"] = _to_string_array(phases)
+        return cls(columns)
+
+    def select(self, positions, pick_mask=None):
+        """
+        Create a table with the events at the given positions in the given
+        order.
+
+        :param positions: Positions of the events to keep.
+        :param pick_mask: Optional boolean array with one entry per pick of
+            this table. Only picks with a true entry are kept.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        offsets = np.asarray(self.columns["pick_offsets"])
+        columns = {}
+        for name in ["event_id", "origin_time"] + EVENT_FLOAT_COLUMNS:
+            columns[name] = np.asarray(self.columns[name])[positions]
+        starts = offsets[positions]
+        counts = offsets[positions + 1] - starts
+        # Indices of the picks of the selected events in their new order.
+        pick_indices = np.arange(counts.sum(), dtype=np.int64) + np.repeat(
+            starts - (np.cumsum(counts) - counts), counts)
+        if pick_mask is not None:
+            keep = np.asarray(pick_mask, dtype=np.bool_)[pick_indices]
+            counts = np.bincount(
+                np.repeat(np.arange(len(positions)), counts)[keep],
+                minlength=len(positions))
+            pick_indices = pick_indices[keep]
+        columns["pick_offsets"] = np.concatenate(
+            [[0], np.cumsum(counts)]).astype(np.int64)
+        for name in ["pick_id", "pick_time", "pick_time_error",
+                     "pick_station", "pick_phase"]:
+            columns[name] = np.asarray(self.columns[name])[pick_indices]
+        columns["stations"] = np.asarray(self.columns["stations"])
+        columns["phases"] = np.asarray(self.columns["phases"])
+        return EventTable(columns)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Load a table saved with save(). All columns are memory mapped.
+        """
+        with open(os.path.join(directory, "table.json"), "r") as open_file:
+            info = json.load(open_file)
+        if info.get("version") != TABLE_VERSION:
+            msg = "Unsupported event table version %s." % info.get("version")
+            raise ValueError(msg)
+        columns = {}
+        for name in COLUMNS:
+            columns[name] = np.load(os.path.join(directory, name + ".npy"),
+                                    mmap_mode="r")
+        return cls(columns)
+
+    def save(self, directory):
+        """
+        Save the table to a directory. The directory is replaced atomically
+        so an interrupted save never leaves a partial table behind.
+        """
+        temp_directory = directory + ".tmp"
+        if os.path.exists(temp_directory):
+            shutil.rmtree(temp_directory)
+        os.makedirs(temp_directory)
+        for name in COLUMNS:
+            np.save(os.path.join(temp_directory, name + ".npy"),
+                    np.asarray(self.columns[name]))
+        with open(os.path.join(temp_directory, "table.json"), "w") as \
+                open_file:
+            json.dump({"version": TABLE_VERSION,
+                       "event_count": len(self),
+                       "pick_count": len(self.columns["pick_id"])},
+                      open_file)
+        if os.path.exists(directory):
+            old_directory = directory + ".old"
+            if os.path.exists(old_directory):
+                shutil.rmtree(old_directory)
+            os.rename(directory, old_directory)
+            os.rename(temp_directory, directory)
+            shutil.rmtree(old_directory)
+        else:
+            os.rename(temp_directory, directory)
+
+    def __len__(self):
+        return len(self.columns["event_id"])
+
+    def __iter__(self):
+        for position in xrange(len(self)):
+            yield self[position]
+
+    def __getitem__(self, position):
+        """
+        Returns the event dictionary of the event at position.
+        """
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("Event table index out of range.")
+        columns = self.columns
+        event = {}
+        event["event_id"] = columns["event_id"][position].decode("utf-8")
+        event["origin_time"] = UTCDateTime(
+            ns=int(columns["origin_time"][position]))
+        for name in EVENT_FLOAT_COLUMNS:
+            event[name] = _from_float(columns[name][position])
+        start, end = columns["pick_offsets"][position:position + 2]
+        event["picks"] = [self._get_pick(_i) for _i in xrange(start, end)]
+        return event
+
+    def _get_pick(self, index):
+        """
+        Returns the pick dictionary of the pick at index.
+        """
+        columns = self.columns
+        phase = int(columns["pick_phase"][index])
+        return {
+            "id": columns["pick_id"][index].decode("utf-8"),
+            "pick_time": UTCDateTime(ns=int(columns["pick_time"][index])),
+            "pick_time_error": _from_float(columns["pick_time_error"][index]),
+            "station_id": self.stations[columns["pick_station"][index]],
+            "phase": self.phases[phase] if phase >= 0 else None}
+
+    def _get_key(self, positions, stations, phases):
+        """
+        Returns the sort keys for the given event positions, station and
+        phase indices. Missing phases (-1) get their own key.
+        """
+        return (np.asarray(positions, dtype=np.int64) * len(self.stations) +
+                stations) * (len(self.phases) + 1) + (
+                    np.asarray(phases, dtype=np.int64) + 1)
+
+    def _create_pick_keys(self):
+        """
+        Create the sorted key array of all picks. The sort is stable so the
+        first of several picks with the same station and phase is found.
+        """
+        offsets = np.asarray(self.columns["pick_offsets"])
+        positions = np.repeat(np.arange(len(self), dtype=np.int64),
+                              np.diff(offsets))
+        keys = self._get_key(positions, self.columns["pick_station"],
+                             self.columns["pick_phase"])
+        self._pick_order = np.argsort(keys, kind="mergesort")
+        self._pick_keys = keys[self._pick_order]
+
+    def _find_picks(self, keys):
+        """
+        Returns the index of the first pick with each of the keys or -1.
+        """
+        if self._pick_keys is None:
+            self._create_pick_keys()
+        keys = np.atleast_1d(keys)
+        indices = np.searchsorted(self._pick_keys, keys)
+        found = indices < len(self._pick_keys)
+        found[found] = self._pick_keys[indices[found]] == keys[found]
+        result = np.empty(len(keys), dtype=np.int64)
+        result.fill(-1)
+        result[found] = self._pick_order[indices[found]]
+        return result
+
+    def get_pick_indices(self, position):
+        """
+        Returns the indices of all picks of the event at position.
+        """
+        start, end = self.columns["pick_offsets"][position:position + 2]
+        return xrange(int(start), int(end))
+
+    def get_pick_at(self, index):
+        """
+        Returns the pick dictionary of the pick at index, see
+        get_pick_indices().
+        """
+        return self._get_pick(index)
+
+    def get_pick_id(self, index):
+        """
+        Returns the id of the pick at index.
+        """
+        return self.columns["pick_id"][index].decode("utf-8")
+
+    def get_pick_time(self, index):
+        """
+        Returns the time of the pick at index.
+        """
+        return UTCDateTime(ns=int(self.columns["pick_time"][index]))
+
+    def get_pick_station(self, index):
+        """
+        Returns the station id of the pick at index.
+        """
+        return self.stations[self.columns["pick_station"][index]]
+
+    def get_pick_phase(self, index):
+        """
+        Returns the phase of the pick at index or None.
+        """
+        phase = int(self.columns["pick_phase"][index])
+        return self.phases[phase] if phase >= 0 else None
+
+    def get_origin_time(self, position):
+        """
+        Returns the origin time of the event at position.
+        """
+        return UTCDateTime(ns=int(self.columns["origin_time"][position]))
+
+    def get_pick(self, position, station_id, phase):
+        """
+        Returns the first pick of the event at position with the given
+        station id and phase or None.
+        """
+        station = self._station_index.get(station_id)
+        phase = self._phase_index.get(phase, -1 if phase is None else None)
+        if station is None or phase is None:
+            return None
+        index = self._find_picks(self._get_key(position, station, phase))[0]
+        if index < 0:
+            return None
+        return self._get_pick(int(index))
+
+    def match_picks(self, position_1, position_2):
+        """
+        Match the picks of two events by station and phase.
+
+        Returns a list of (index_1, index_2) tuples with the index of every
+        pick of the first event and the index of the first pick of the
+        second event with the same station and phase, in the order of the
+        picks of the first event.
+        """
+        start, end = self.columns["pick_offsets"][position_1:position_1 + 2]
+        if start == end:
+            return []
+        indices_1 = np.arange(start, end, dtype=np.int64)
+        indices_2 = self._find_picks(self._get_key(
+            position_2, self.columns["pick_station"][start:end],
+            self.columns["pick_phase"][start:end]))
+        found = indices_2 >= 0
+        return zip(indices_1[found].tolist(), indices_2[found].tolist())
+
+    def get_event_ids(self):
+        """
+        Returns a list of all event ids.
+        """
+        return [_i.decode("utf-8") for _i in self.columns["event_id"]]
+
+    def get_column(self, name):
+        """
+        Returns the array of an event column, e.g. origin_latitude. Times
+        are int64 nanoseconds and missing values NaN.
+        """
+        if name not in ["event_id", "origin_time"] + EVENT_FLOAT_COLUMNS:
+            msg = "Unknown event column %s." % name
+            raise ValueError(msg)
+        return self.columns[name]
@@ -0,0 +1,197 @@
+"""
+Writing of the relocated events.
+
+The QuakeML output is written one event at a time: The input QuakeML files
+are parsed incrementally (see event_reader.py), the HypoDD origin is appended
+to the origins of every relocated event and the event element is written to
+the output file right away. The event elements are passed through unchanged
+otherwise. Only the events are kept: They are written to a single new
+eventParameters element, the publicID, description, comments, creation info
+and any other children of the eventParameters of the input files are
+dropped. Input files in other formats are read with ObsPy one file at a time.
+
+The CSV output is a compact alternative with one line per event which does
+not need the input files at all.
+"""
+import csv
+import itertools
+import os
+
+from lxml import etree
+from obspy.core import UTCDateTime
+from obspy.core.event import Catalog, Comment, Origin, read_events, \
+    ResourceIdentifier
+from obspy.io.quakeml.core import NSMAP_QUAKEML, Pickler
+
+from event_reader import get_local_name, iter_event_elements, \
+    QUAKEML_BED_NAMESPACES, QuakeMLStreamError
+
+
+QUAKEML_NAMESPACE = NSMAP_QUAKEML["q"]
+BED_NAMESPACE = QUAKEML_BED_NAMESPACES[0]
+
+CSV_COLUMNS = ["event_id", "hypodd_id", "relocated", "origin_time",
+               "latitude", "longitude", "depth", "error_x", "error_y",
+               "error_z", "cluster_id", "original_origin_time",
+               "original_latitude", "original_longitude", "original_depth",
+               "magnitude"]
+
+
+def get_relocated_time(relocation):
+    """
+    Returns the origin time of an event in hypoDD.reloc.
+
+    :param relocation: Dictionary with at least the keys year, month, day,
+        hour, minute and second.
+    """
+    second = float(relocation["second"])
+    sec = int(second)
+    # Correct for a bug in hypoDD which can write 60 seconds...
+    add_minute = False
+    if sec >= 60:
+        sec = 0
+        add_minute = True
+    time = UTCDateTime(
+        int(relocation["year"]), int(relocation["month"]),
+        int(relocation["day"]), int(relocation["hour"]),
+        int(relocation["minute"]), sec, int((second % 1.0) * 1E6))
+    if add_minute is True:
+        time = time + 60.0
+    return time
+
+
+def create_hypodd_origin(relocation):
+    """
+    Create the origin of a relocated event.
+
+    :param relocation: Dictionary with the keys latitude, longitude, depth
+        (in km), year, month, day, hour, minute, second and cluster_id of an
+        event in hypoDD.reloc.
+    """
+    new_origin = Origin()
+    new_origin.time = get_relocated_time(relocation)
+    new_origin.latitude = float(relocation["latitude"])
+    new_origin.longitude = float(relocation["longitude"])
+    # Convert back to meters.
+    new_origin.depth = float(relocation["depth"]) * 1000.0
+    new_origin.method_id = "HypoDD"
+    # Put the cluster id in the comments to be able to use it later on.
+    new_origin.comments.append(Comment(
+        text="HypoDD cluster id: %i" % int(relocation["cluster_id"])))
+    return new_origin
+
+
+def _origin_to_element(origin):
+    """
+    Serialize an origin to an element in the QuakeML BED namespace.
+    """
+    element = Pickler()._origin(origin)
+    for child in element.iter():
+        if isinstance(child.tag, basestring) and \
+                not child.tag.startswith("{"):
+            child.tag = "{%s}%s" % (BED_NAMESPACE, child.tag)
+    return element
+
+
+def _add_origin(event_element, origin):
+    """
+    Insert an origin after the last origin of an event element.
+    """
+    position = len(event_element)
+    for index, child in enumerate(event_element):
+        if get_local_name(child) == "origin":
+            position = index + 1
+    event_element.insert(position, _origin_to_element(origin))
+
+
+def _iter_obspy_event_elements(filename):
+    """
+    Generator yielding the events of any file ObsPy can read as event
+    elements in the QuakeML BED namespace.
+    """
+    for event in read_events(filename):
+        document = etree.fromstring(Pickler().dumps(Catalog(events=[event])))
+        yield document.find(".//{%s}event" % BED_NAMESPACE)
+
+
+def write_quakeml(event_files, output_file, origins):
+    """
+    Write all events of the event files to a single QuakeML file and append
+    the new origins.
+
+    :param event_files: List of input event files.
+    :param output_file: The output QuakeML file.
+    :param origins: Dictionary mapping event ids to the origins to append.
+
+    The events are written to a temporary file which replaces output_file
+    once all events are written, so errors while reading an input file never
+    leave a truncated document behind.
+
+    Returns the number of written events.
+    """
+    temp_file = output_file + ".tmp"
+    try:
+        count = _write_quakeml(event_files, temp_file, origins)
+        os.rename(temp_file, output_file)
+    finally:
+        # Only left over if writing failed.
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return count
+
+
+def _write_quakeml(event_files, output_file, origins):
+    """
+    Write the QuakeML document, see write_quakeml().
+    """
+    count = 0
+    with open(output_file, "wb") as open_file:
+        open_file.write(
+            '<?xml version=\'1.0\' encoding=\'utf-8\'?>\n'
+            '<q:quakeml xmlns:q="%s" xmlns="%s">\n'
+            '  <eventParameters publicID="%s">\n' % (
+                QUAKEML_NAMESPACE, BED_NAMESPACE, ResourceIdentifier()))
+        for filename in event_files:
+            # QuakeML files are streamed, everything else is read with
+            # ObsPy. Files are only checked for QuakeML while reading the
+            # root element so nothing has been written yet if it fails.
+            elements = iter_event_elements(filename)
+            try:
+                first = next(elements, None)
+            except (QuakeMLStreamError, etree.XMLSyntaxError):
+                elements = _iter_obspy_event_elements(filename)
+                first = next(elements, None)
+            if first is None:
+                continue
+            for element in itertools.chain([first], elements):
+                origin = origins.get(element.get("publicID"))
+                if origin is not None:
+                    _add_origin(element, origin)
+                open_file.write(etree.tostring(element, pretty_print=True,
+                                               encoding="utf-8"))
+                count += 1
+        open_file.write('  </eventParameters>\n</q:quakeml>\n')
+    return count
+
+
+def write_csv(output_file, rows):
+    """
+    Write the relocated events as CSV file with the columns CSV_COLUMNS.
+
+    :param output_file: The output file.
+    :param rows: Iterable of dictionaries with the keys of CSV_COLUMNS.
+        Missing values are written as empty fields.
+
+    Returns the number of written events.
+    """
+    count = 0
+    with open(output_file, "wb") as open_file:
+        writer = csv.DictWriter(open_file, CSV_COLUMNS, restval="",
+                                lineterminator="\n")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict((_i, _j.encode("utf-8")
+                                  if isinstance(_j, unicode) else _j)
+                                 for _i, _j in row.iteritems()))
+            count += 1
+    return count
@@ -0,0 +1,192 @@
+"""
+Vectorized distance calculations for event and station locations.
+
+All coordinates are converted to a local Cartesian system in kilometers with
+an equirectangular projection:
+
+    * x - East, longitude scaled with the cosine of a reference latitude
+    * y - North
+    * z - Depth, positive downwards. Stations have a depth of -elevation.
+
+This is accurate enough for the regional distances HypoDD works with and
+makes all distance calculations simple NumPy array operations.
+
+Percentiles of the inter-event distances are either calculated exactly by
+processing the pairs in blocks of bounded size or estimated from randomly
+sampled pairs. For the estimate the Dvoretzky-Kiefer-Wolfowitz inequality
+bounds the error: With a probability of 1 - alpha the true fraction of pairs
+closer than the returned distance deviates by at most
+
+    epsilon = sqrt(ln(2 / alpha) / (2 * n_samples))
+
+from the requested fraction. With the defaults (10^6 samples, alpha = 0.01)
+epsilon is 0.0016.
+"""
+import numpy as np
+
+
+# Kilometers per degree latitude with a mean earth radius of 6371 km.
+KM_PER_DEGREE = 6371.0 * np.pi / 180.0
+
+# Up to this number of events percentiles are calculated exactly.
+EXACT_PERCENTILE_MAX_EVENTS = 4000
+# Maximum number of distances held in memory at once by the exact method.
+BLOCK_SIZE = 2 ** 22
+# Number of histogram bins used to narrow down the exact percentile.
+HISTOGRAM_BINS = 2 ** 16
+# Number of pairs and confidence of the sampled estimate.
+PERCENTILE_SAMPLES = 10 ** 6
+PERCENTILE_ALPHA = 0.01
+
+
+def to_cartesian(latitudes, longitudes, depths, reference_latitude=None):
+    """
+    Convert geographic coordinates to local Cartesian coordinates in km.
+
+    :param latitudes: Latitudes in degree.
+    :param longitudes: Longitudes in degree.
+    :param depths: Depths in km, positive downwards.
+    :param reference_latitude: Latitude the longitudes are scaled for.
+        Defaults to the mean latitude.
+
+    Returns an array of shape (N, 3).
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    depths = np.asarray(depths, dtype=np.float64)
+    if reference_latitude is None:
+        reference_latitude = latitudes.mean() if len(latitudes) else 0.0
+    points = np.empty((len(latitudes), 3), dtype=np.float64)
+    points[:, 0] = longitudes * KM_PER_DEGREE * \
+        np.cos(np.radians(reference_latitude))
+    points[:, 1] = latitudes * KM_PER_DEGREE
+    points[:, 2] = depths
+    return points
+
+
+def get_maximum_distance(points):
+    """
+    Upper bound of the distance between any two points, e.g. the diagonal of
+    their bounding box.
+
+    :param points: Array of shape (N, 3) as returned by to_cartesian().
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if not len(points):
+        return 0.0
+    return float(np.sqrt(((points.max(axis=0) -
+                           points.min(axis=0)) ** 2).sum()))
+
+
+def _iter_distance_blocks(points):
+    """
+    Yields the distances of all pairs (i, j) with i < j in blocks of at most
+    about BLOCK_SIZE distances.
+    """
+    count = len(points)
+    rows = max(1, BLOCK_SIZE // count)
+    for start in xrange(0, count - 1, rows):
+        stop = min(start + rows, count - 1)
+        block = points[start:stop]
+        others = points[start + 1:]
+        # One coordinate at a time avoids a large 3-D temporary array.
+        squared = np.zeros((len(block), len(others)), dtype=np.float64)
+        for axis in range(3):
+            difference = block[:, axis, np.newaxis] - \
+                others[np.newaxis, :, axis]
+            difference *= difference
+            squared += difference
+        distances = np.sqrt(squared, out=squared)
+        # Only keep the pairs with j > i.
+        mask = (np.arange(start + 1, count)[np.newaxis, :] >
+                np.arange(start, stop)[:, np.newaxis])
+        yield distances[mask]
+
+
+def get_exact_distance_percentile(points, percentile):
+    """
+    Exact percentile of the distances of all pairs of distinct points.
+
+    The percentile is defined as the distance at position
+    floor(n_pairs * percentile / 100) of the sorted distances. The memory
+    usage is bounded: A first pass over all pairs builds a histogram of the
+    distances, a second pass only keeps the distances in the bin that
+    contains the percentile.
+
+    :param points: Array of shape (N, 3) as returned by to_cartesian().
+    :param percentile: Percentile between 0 and 100.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    count = len(points)
+    n_pairs = count * (count - 1) // 2
+    if n_pairs == 0:
+        return 0.0
+    position = min(int(np.floor(n_pairs * percentile / 100.0)), n_pairs - 1)
+    scale = HISTOGRAM_BINS / max(get_maximum_distance(points), 1E-9)
+
+    def get_bins(distances):
+        return np.minimum((distances * scale).astype(np.int64),
+                          HISTOGRAM_BINS - 1)
+
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for distances in _iter_distance_blocks(points):
+        histogram += np.bincount(get_bins(distances),
+                                 minlength=HISTOGRAM_BINS)
+    cumulative = histogram.cumsum()
+    target_bin = int(np.searchsorted(cumulative, position, side="right"))
+    before = int(cumulative[target_bin - 1]) if target_bin else 0
+    candidates = []
+    for distances in _iter_distance_blocks(points):
+        candidates.append(distances[get_bins(distances) == target_bin])
+    candidates = np.sort(np.concatenate(candidates))
+    return float(candidates[position - before])
+
+
+def get_sampled_distance_percentile(points, percentile,
+                                    n_samples=PERCENTILE_SAMPLES,
+                                    alpha=PERCENTILE_ALPHA, random_state=None):
+    """
+    Estimate the percentile of the distances of all pairs of distinct points
+    from randomly sampled pairs.
+
+    :param points: Array of shape (N, 3) as returned by to_cartesian().
+    :param percentile: Percentile between 0 and 100.
+    :param n_samples: Number of sampled pairs.
+    :param alpha: The error bound holds with a probability of 1 - alpha.
+    :param random_state: Seed or numpy.random.RandomState for reproducible
+        results.
+
+    Returns the estimated distance and the error bound epsilon of the
+    fraction of pairs closer than it, see the module documentation.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    count = len(points)
+    if count < 2:
+        return 0.0, 0.0
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    first = random_state.randint(0, count, n_samples)
+    # Offsets from 1 to count - 1 guarantee distinct points.
+    second = (first + random_state.randint(1, count, n_samples)) % count
+    distances = np.sqrt(((points[first] - points[second]) ** 2).sum(axis=1))
+    position = min(int(np.floor(n_samples * percentile / 100.0)),
+                   n_samples - 1)
+    distance = float(np.partition(distances, position)[position])
+    epsilon = float(np.sqrt(np.log(2.0 / alpha) / (2.0 * n_samples)))
+    return distance, epsilon
+
+
+def get_distance_percentile(points, percentile, random_state=None):
+    """
+    Percentile of the distances of all pairs of distinct points. It is
+    calculated exactly for up to EXACT_PERCENTILE_MAX_EVENTS points and
+    estimated from sampled pairs otherwise.
+
+    Returns the distance and the error bound of the estimate, see
+    get_sampled_distance_percentile(). The error bound is 0.0 for exact
+    results.
+    """
+    if len(points) <= EXACT_PERCENTILE_MAX_EVENTS:
+        return get_exact_distance_percentile(points, percentile), 0.0
+    return get_sampled_distance_percentile(points, percentile,
+                                           random_state=random_state)
@@ -13,12 +13,34 @@ the hypoDD.inc file used for the compilation.
 If all three files are present and the hypoDD.inc that would be used for a new
 compilation is identical to the one already present nothing will happen as the
 end result would be the same.
+
+Compiled binaries are stored in a cache directory shared by all working
+directories. Every build is keyed by a hash of the hypoDD.inc file, the HypoDD
+archive and the platform, so a lookup is a single directory check and the
+archive only has to be unpacked and verified if a new build is necessary.
+Builds are protected by a lock file and published with an atomic rename so
+concurrent relocations needing the same array sizes share one build. The
+binaries in the working directory are symbolic links to the cache.
+
+The cache directory defaults to ~/.hypoddpy/binaries and can be changed with
+the HYPODDPY_CACHE_DIR environment variable.
+
+The optimization flags are chosen with a compile profile, see
+COMPILE_PROFILES. Every cache entry contains a build.json file recording the
+profile, the flags and the compile time.
 """
+import fcntl
+import hashlib
+import json
 import md5
+import multiprocessing
 import os
+import platform
 import shutil
 import subprocess
 import tarfile
+import tempfile
+import time
 
 
 # Specify the HypoDD version to be compiled.
@@ -30,6 +52,52 @@ HYPODD_ARCHIVE = os.path.abspath(os.path.join(os.path.dirname(__file__), 'src',
 # or simply comment out the line: if md5_hash != HYPODD_MD5_HASH:    
 HYPODD_MD5_HASH = "ac7fb5829abef23aa91f1f8a115e2b45"
 
+# The cache directory for the compiled binaries shared by all working
+# directories.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".hypoddpy",
+                                 "binaries")
+CACHE_DIR_ENVIRONMENT_VARIABLE = "HYPODDPY_CACHE_DIR"
+
+# Fortran compiler flags of the compile profiles. The default profile uses the
+# flags of the Makefiles in the archive.
+COMPILE_PROFILES = {
+    "debug": "-O0 -g -fbounds-check",
+    "default": None,
+    "aggressive": "-O3 -march=native -funroll-loops"}
+
+
+# Approximate number of 4 byte words HypoDD statically allocates per unit of
+# the array dimensions. Observation arrays include the LSQR system matrix,
+# station-event arrays the travel time and partial derivative tables and SVD
+# arrays the dense system matrix and its copies. Used to estimate the memory
+# footprint of a configuration before compiling.
+WORDS_PER_DATUM = 40
+WORDS_PER_EVENT = 60
+WORDS_PER_STATION = 20
+WORDS_PER_STATION_EVENT = 8
+WORDS_PER_CLUSTER_EVENT = 1
+WORDS_PER_SVD_ELEMENT = 16
+
+
+def estimate_static_memory(MAXEVE, MAXDATA, MAXEVE0, MAXDATA0, MAXLAY,
+                           MAXSTA, MAXCL):
+    """
+    Estimate the static memory of hypoDD compiled with the given array
+    dimensions in bytes. See HypoDDCompiler.configure() for the parameters.
+
+    This is a rough approximation of the dominating arrays and intended to
+    detect configurations that will not fit into memory before running
+    them.
+    """
+    words = WORDS_PER_DATUM * MAXDATA + \
+        WORDS_PER_EVENT * MAXEVE + \
+        WORDS_PER_STATION * MAXSTA + \
+        WORDS_PER_STATION_EVENT * MAXSTA * MAXEVE + \
+        WORDS_PER_CLUSTER_EVENT * MAXCL * MAXEVE + \
+        WORDS_PER_SVD_ELEMENT * MAXDATA0 * MAXEVE0 + \
+        2 * MAXLAY
+    return 4 * words
+
 
 class HypoDDCompilationError(Exception):
     """
@@ -50,11 +118,14 @@ class HypoDDCompiler(object):
     >>> hyp_comp.configure()
     >>> hyp_comp.make()
     """
-    def __init__(self, working_dir, log_function):
+    def __init__(self, working_dir, log_function, cache_dir=None):
         """
         :param working_dir: The working directory. Everything will happen in
             there.
         :param log_function: Function to use to log activity.
+        :param cache_dir: Directory of the shared binary cache. Defaults to
+            the HYPODDPY_CACHE_DIR environment variable or, if it is not set,
+            to ~/.hypoddpy/binaries.
         """
         # Set the log function.
         self.log = log_function
@@ -62,8 +133,10 @@ class HypoDDCompiler(object):
         self.working_dir = working_dir
         if not os.path.exists(self.working_dir):
             os.makedirs(self.working_dir)
-        # Make sure the given HypoDD archive is valid.
-        self.verify_archive()
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_DIR_ENVIRONMENT_VARIABLE,
+                                       DEFAULT_CACHE_DIR)
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
         # Setup and determine all the necessary paths.
         self.determine_paths()
         self.is_configured = False
@@ -71,7 +144,7 @@ class HypoDDCompiler(object):
     def verify_archive(self):
         """
         Method that checks if the HypoDD archive exists and that its md5 has is
-        valid.
+        valid. Only called before an actual compilation.
         """
         if not os.path.exists(HYPODD_ARCHIVE):
             msg = "HypoDD archive file could not be found"
@@ -98,26 +171,29 @@ class HypoDDCompiler(object):
         # the run, the currently used hypoDD.inc file will be copied there.
         self.paths["old hypoDD.inc file"] = \
             os.path.join(self.paths["binary_dir"], "hypoDD.inc")
-        # Where to unpack the archive.
-        self.paths["hypodd_unpack_dir"] = os.path.join(self.working_dir,
-            "hypodd_src")
+
+    def determine_build_paths(self, build_dir):
+        """
+        Returns the paths within the unpacked archive in build_dir.
+        """
+        paths = {}
+        paths["hypodd_unpack_dir"] = build_dir
         # Some paths in the unpacked archive.
-        self.paths["make_directory"] = os.path.join(
-            self.paths["hypodd_unpack_dir"], "HYPODD", "src")
+        paths["make_directory"] = os.path.join(build_dir, "HYPODD", "src")
         # The resulting binaries directly after the compilation.
-        self.paths["compiled_hypodd_binary"] = os.path.join(
-            self.paths["make_directory"], "hypoDD", "hypoDD")
-        self.paths["compiled_ph2dt_binary"] = os.path.join(
-            self.paths["make_directory"], "ph2dt", "ph2dt")
+        paths["compiled_hypodd_binary"] = os.path.join(
+            paths["make_directory"], "hypoDD", "hypoDD")
+        paths["compiled_ph2dt_binary"] = os.path.join(
+            paths["make_directory"], "ph2dt", "ph2dt")
         # The include directory.
-        self.paths["include_dir"] = os.path.join(
-            self.paths["hypodd_unpack_dir"], "HYPODD", "include")
+        paths["include_dir"] = os.path.join(build_dir, "HYPODD", "include")
         # The hypoDD.inc file
-        self.paths["hypoDD.inc"] = os.path.join(self.paths["include_dir"],
-            "hypoDD.inc")
+        paths["hypoDD.inc"] = os.path.join(paths["include_dir"], "hypoDD.inc")
+        return paths
 
     def configure(self, MAXEVE=3000, MAXDATA=2800000, MAXEVE0=50,
-        MAXDATA0=60000, MAXLAY=30, MAXSTA=2000, MAXCL=200):
+        MAXDATA0=60000, MAXLAY=30, MAXSTA=2000, MAXCL=200, profile="default",
+        jobs=None):
         """
         Configure the compilation.
 
@@ -145,7 +221,23 @@ class HypoDDCompiler(object):
             Defaults to 2000.
         :param MAXCL: Max number of clusters allowed.
             Defaults to 200.
+
+        **Build configuration**
+
+        :param profile: The compile profile, one of "debug", "default" and
+            "aggressive". See COMPILE_PROFILES for the flags. Binaries
+            compiled with "aggressive" are optimized for the CPU of the
+            compiling machine.
+            Defaults to "default".
+        :param jobs: Number of parallel make jobs.
+            Defaults to the number of CPUs.
         """
+        if profile not in COMPILE_PROFILES:
+            msg = "Unknown compile profile %s. Available profiles: %s" % (
+                profile, ", ".join(sorted(COMPILE_PROFILES)))
+            raise HypoDDCompilationError(msg)
+        self.profile = profile
+        self.jobs = int(jobs) if jobs else multiprocessing.cpu_count()
         # Set the hypodd_inc configuration.
         self.hypodd_inc_config = {
             "MAXEVE": MAXEVE,
@@ -158,18 +250,11 @@ class HypoDDCompiler(object):
 
         self.is_configured = True
 
-    def unpack_archive(self):
+    def unpack_archive(self, unpack_dir):
         """
-        Unpacks the HypoDD archive to the hypodd_src subfolder in the working
-        directory.
+        Unpacks the HypoDD archive to unpack_dir.
         """
         self.log("Unpacking HypoDD archive ...")
-
-        unpack_dir = self.paths["hypodd_unpack_dir"]
-        if os.path.exists(unpack_dir):
-            shutil.rmtree(unpack_dir)
-        os.makedirs(unpack_dir)
-
         tar = tarfile.open(HYPODD_ARCHIVE, "r:gz")
         tar.extractall(unpack_dir)
         self.log("Unpacking HypoDD archive done.")
@@ -178,19 +263,107 @@ class HypoDDCompiler(object):
         if self.is_configured is not True:
             msg = "Compiler object need to be configured first."
             raise HypoDDCompilationError(msg)
-        # Unpack the archive.
-        self.unpack_archive()
         # Create the hypoDD_inc file.
         self.hypodd_inc_file = self.create_hypoDD_inc_file()
+        cache_entry = os.path.join(self.cache_dir, self.get_build_key())
         # Check the current HypoDD compilation (if any).
-        if self.is_current_hypodd_compilation_valid() is True:
-            shutil.rmtree(self.paths["hypodd_unpack_dir"])
+        if self.is_current_hypodd_compilation_valid(cache_entry) is True:
             self.log("Current compilation is up to date.")
             return
-        # Finally compile it.
-        self.compile_hypodd()
-        # Cleanup.
-        shutil.rmtree(self.paths["hypodd_unpack_dir"])
+        if self.is_cache_entry_valid(cache_entry):
+            self.log("Using cached HypoDD compilation %s (profile: %s)." % (
+                cache_entry, self.get_build_info(cache_entry).get(
+                    "profile", "unknown")))
+        else:
+            self.build_cache_entry(cache_entry)
+        self.link_cache_entry(cache_entry)
+
+    def get_build_key(self):
+        """
+        Returns the key of the current configuration in the binary cache.
+        """
+        key = hashlib.sha1()
+        parts = [self.hypodd_inc_file, HYPODD_MD5_HASH, platform.system(),
+                 platform.machine(), self.profile,
+                 str(COMPILE_PROFILES[self.profile])]
+        # Binaries optimized for the CPU must not be shared with other
+        # machines using the same cache directory.
+        if "-march=native" in str(COMPILE_PROFILES[self.profile]):
+            parts.append(platform.node())
+        for part in parts:
+            key.update(part)
+            key.update("\0")
+        return key.hexdigest()
+
+    def get_build_info(self, cache_entry):
+        """
+        Returns the recorded information about the build of a cache entry,
+        i.e. the profile, the compiler flags, the number of make jobs and the
+        compile time in seconds.
+        """
+        filename = os.path.join(cache_entry, "build.json")
+        if not os.path.exists(filename):
+            return {}
+        with open(filename, "r") as open_file:
+            return json.load(open_file)
+
+    def is_cache_entry_valid(self, cache_entry):
+        """
+        A cache entry only exists once it has been completely built as it is
+        published with an atomic rename.
+        """
+        return os.path.exists(os.path.join(cache_entry, "hypoDD")) and \
+            os.path.exists(os.path.join(cache_entry, "ph2dt"))
+
+    def build_cache_entry(self, cache_entry):
+        """
+        Compile HypoDD and publish the binaries as cache_entry. Other
+        processes building the same entry at the same time wait for the lock
+        and then use the published binaries.
+        """
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Created by a concurrent process.
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        with open(cache_entry + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self.is_cache_entry_valid(cache_entry):
+                    self.log("HypoDD has been compiled by another process.")
+                    return
+                self.verify_archive()
+                build_dir = tempfile.mkdtemp(prefix="build_",
+                                             dir=self.cache_dir)
+                try:
+                    self.unpack_archive(build_dir)
+                    entry_dir = os.path.join(build_dir, "entry")
+                    os.makedirs(entry_dir)
+                    self.compile_hypodd(self.determine_build_paths(build_dir),
+                                        entry_dir)
+                    # A stale, incomplete entry would block the rename.
+                    if os.path.exists(cache_entry):
+                        shutil.rmtree(cache_entry)
+                    os.rename(entry_dir, cache_entry)
+                finally:
+                    shutil.rmtree(build_dir)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def link_cache_entry(self, cache_entry):
+        """
+        Link the binaries of a cache entry to the working directory and copy
+        its hypoDD.inc file.
+        """
+        for name in ["hypoDD", "ph2dt"]:
+            path = self.paths["%s_binary" % name]
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(os.path.join(cache_entry, name), path)
+        shutil.copyfile(os.path.join(cache_entry, "hypoDD.inc"),
+                        self.paths["old hypoDD.inc file"])
 
     def create_hypoDD_inc_file(self):
         """
@@ -242,10 +415,12 @@ class HypoDDCompiler(object):
         hypoDD_inc = hypoDD_inc[1:]
         return hypoDD_inc
 
-    def is_current_hypodd_compilation_valid(self):
+    def is_current_hypodd_compilation_valid(self, cache_entry):
         """
         Returns True if the current compilation is ok, False otherwise. False
         should always trigger a new compilation.
+
+        :param cache_entry: The cache entry of the current configuration.
         """
         # If the binary dir does not exist return False.
         if not os.path.exists(self.paths["binary_dir"]):
@@ -261,36 +436,60 @@ class HypoDDCompiler(object):
             old_hypodd_file = open_file.read()
         if old_hypodd_file != self.hypodd_inc_file:
             return False
-        return True
+        # The binaries have to be linked to the cache entry of the current
+        # configuration. Plain binaries of working directories predating the
+        # cache are only reused with the default profile.
+        if os.path.islink(self.paths["hypoDD_binary"]):
+            return os.path.dirname(os.readlink(
+                self.paths["hypoDD_binary"])) == cache_entry
+        return self.profile == "default"
 
-    def compile_hypodd(self):
+    def compile_hypodd(self, paths, output_dir):
         """
         Actually compiles HypoDD.
+
+        :param paths: The paths in the unpacked archive, see
+            determine_build_paths().
+        :param output_dir: The directory the binaries and the hypoDD.inc file
+            are moved to.
         """
         # Replace hypoDD.inc file with the custom one.
-        os.remove(self.paths["hypoDD.inc"])
-        with open(self.paths["hypoDD.inc"], "w") as open_file:
+        os.remove(paths["hypoDD.inc"])
+        with open(paths["hypoDD.inc"], "w") as open_file:
             open_file.write(self.hypodd_inc_file)
         # Compile it.
-        self.log("Compiling HypoDD ...")
+        command = ["make", "-j%i" % self.jobs]
+        flags = COMPILE_PROFILES[self.profile]
+        if flags is not None:
+            # Overriding FFLAGS replaces the include path of the Makefiles.
+            command.append("FFLAGS=%s -I%s" % (
+                flags, os.path.abspath(paths["include_dir"])))
+        self.log("Compiling HypoDD with profile %s: %s" % (
+            self.profile, " ".join(command)))
+        start_time = time.time()
         sub = subprocess.Popen(
-            "make", cwd=self.paths["make_directory"], stdout=subprocess.PIPE,
+            command, cwd=paths["make_directory"], stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT)
         self.log(sub.stdout.read())
         retcode = sub.wait()
+        compile_time = time.time() - start_time
         if retcode != 0:
             msg = "Problem compiling HypoDD."
             raise HypoDDCompilationError(msg)
         # Check if the output files have been created.
-        if not os.path.exists(self.paths["compiled_hypodd_binary"]) or \
-           not os.path.exists(self.paths["compiled_ph2dt_binary"]):
+        if not os.path.exists(paths["compiled_hypodd_binary"]) or \
+           not os.path.exists(paths["compiled_ph2dt_binary"]):
             msg = "The binary output files could not be found."
             raise HypoDDCompilationError(msg)
         # Move the binary files and the hypoDD.inc file.
-        shutil.move(self.paths["compiled_hypodd_binary"],
-            self.paths["hypoDD_binary"])
-        shutil.move(self.paths["compiled_ph2dt_binary"],
-            self.paths["ph2dt_binary"])
-        shutil.move(self.paths["hypoDD.inc"],
-            self.paths["old hypoDD.inc file"])
-        self.log("Compiling HypoDD done.")
+        shutil.move(paths["compiled_hypodd_binary"],
+            os.path.join(output_dir, "hypoDD"))
+        shutil.move(paths["compiled_ph2dt_binary"],
+            os.path.join(output_dir, "ph2dt"))
+        shutil.move(paths["hypoDD.inc"],
+            os.path.join(output_dir, "hypoDD.inc"))
+        with open(os.path.join(output_dir, "build.json"), "w") as open_file:
+            json.dump({"profile": self.profile, "flags": flags,
+                       "jobs": self.jobs, "compile_time": compile_time},
+                      open_file, indent=4)
+        self.log("Compiling HypoDD done in %.1f seconds." % compile_time)
@@ -0,0 +1,403 @@
+"""
+Readers for the output files of hypoDD.
+
+Every file is loaded into a NumPy structured array with one entry per line.
+The lines are not parsed one at a time: A whole chunk of lines is split into
+tokens with a single call and every column is converted at once. Large files,
+especially hypoDD.res, can also be processed chunk by chunk with
+iter_output_chunks() so they never have to fit into memory.
+
+Usage
+=====
+
+>>> relocations = read_reloc("hypoDD.reloc")
+>>> relocations["latitude"][relocations["cluster_id"] == 1]
+>>> statistics = get_residual_statistics("hypoDD.res", by="station")
+>>> for chunk in iter_output_chunks("hypoDD.res", RES_DTYPE):
+...     print chunk["residual"].mean()
+"""
+import itertools
+
+import numpy as np
+
+
+# hypoDD.reloc and hypoDD.loc. Depths and x, y, z are in km, the errors in m.
+RELOC_DTYPE = np.dtype([
+    ("id", np.int64), ("latitude", np.float64), ("longitude", np.float64),
+    ("depth", np.float64), ("x", np.float64), ("y", np.float64),
+    ("z", np.float64), ("error_x", np.float64), ("error_y", np.float64),
+    ("error_z", np.float64), ("year", np.int32), ("month", np.int32),
+    ("day", np.int32), ("hour", np.int32), ("minute", np.int32),
+    ("second", np.float64), ("magnitude", np.float64),
+    ("nccp", np.int32), ("nccs", np.int32), ("nctp", np.int32),
+    ("ncts", np.int32), ("rcc", np.float64), ("rct", np.float64),
+    ("cluster_id", np.int32)])
+
+# hypoDD.res. dt is in s, the residual in ms. The data type is 1 for P and 2
+# for S cross correlation data, 3 for P and 4 for S catalog data.
+RES_DTYPE = np.dtype([
+    ("station", "S32"), ("dt", np.float64), ("event_1", np.int64),
+    ("event_2", np.int64), ("data_type", np.int32), ("quality", np.float64),
+    ("residual", np.float64), ("weight", np.float64),
+    ("offset", np.float64)])
+
+# hypoDD.sta. The rms residuals are in ms.
+STA_DTYPE = np.dtype([
+    ("station", "S32"), ("latitude", np.float64), ("longitude", np.float64),
+    ("distance", np.float64), ("azimuth", np.float64),
+    ("n_cc_p", np.int32), ("n_cc_s", np.int32), ("n_ct_p", np.int32),
+    ("n_ct_s", np.int32), ("rms_cc", np.float64), ("rms_ct", np.float64),
+    ("cluster_id", np.int32)])
+
+# Header lines starting with this are skipped.
+_HEADER_PREFIX = "STA DT "
+
+DEFAULT_CHUNK_SIZE = 1000000
+
+_TRANSPOSE_BLOCK_SIZE = 8192
+
+
+def get_src_dtype(column_count):
+    """
+    Returns the dtype of hypoDD.src. The layout of the file differs between
+    hypoDD versions so all columns are read as floats named column_0,
+    column_1, ...
+    """
+    return np.dtype([("column_%i" % _i, np.float64)
+                     for _i in xrange(column_count)])
+
+
+def _convert_token(token, dtype):
+    """
+    Convert a single token. Float tokens that cannot be converted are NaN,
+    Fortran writes asterisks if a value does not fit its field.
+    """
+    if dtype.kind == "f":
+        try:
+            return float(token)
+        except ValueError:
+            return np.nan
+    return int(token)
+
+
+def _parse_split(lines, dtype):
+    """
+    Parse lines by splitting them one at a time. Used for files without a
+    fixed column layout.
+    """
+    column_count = len(dtype.names)
+    rows = [_i for _i in (_j.split() for _j in lines) if _i]
+    if any(len(_i) != column_count for _i in rows):
+        msg = "Expected %i columns per line." % column_count
+        raise ValueError(msg)
+    result = np.empty(len(rows), dtype=dtype)
+    for name, tokens in zip(dtype.names, zip(*rows)):
+        try:
+            result[name] = np.array(tokens).astype(dtype[name])
+        except ValueError:
+            result[name] = [_convert_token(_i, dtype[name]) for _i in tokens]
+    return result
+
+
+def _transpose(array):
+    """
+    Returns a contiguous copy of the transpose of a 2D array. Copying blocks
+    of rows is much faster than transposing a large array in one go.
+    """
+    result = np.empty(array.shape[::-1], dtype=array.dtype)
+    for start in xrange(0, len(array), _TRANSPOSE_BLOCK_SIZE):
+        end = start + _TRANSPOSE_BLOCK_SIZE
+        result[:, start:end] = array[start:end].T
+    return result
+
+
+def _parse_numeric_field(chars, is_space, dtype):
+    """
+    Vectorized conversion of a fixed width field of decimal numbers.
+
+    :param chars: uint8 array of shape (width, N), the characters of one
+        token per column.
+    :param is_space: Boolean array of the whitespace in chars.
+
+    The digits of every token are combined to an exact integer mantissa
+    which is divided by a power of ten, so the result is identical to
+    float(). Tokens in any other format, e.g. with exponents or asterisks,
+    are converted one at a time.
+    """
+    width, count = chars.shape
+    result = np.empty(count, dtype=dtype)
+    # The value is only exact up to 2 ** 53.
+    if width > 15:
+        for index in xrange(count):
+            result[index] = _convert_token(
+                chars[:, index].tostring().strip(), dtype)
+        return result
+
+    digits = chars - np.uint8(48)
+    is_digit = digits <= 9
+    is_dot = chars == 46
+    is_sign = (chars == 45) | (chars == 43)
+    # Signs are only allowed as first character, at most one dot.
+    bad = np.any(~(is_digit | is_dot | is_sign | is_space), axis=0) | \
+        np.any(is_sign[1:] & ~is_space[:-1], axis=0) | \
+        (np.sum(is_dot, axis=0) > 1) | ~np.any(is_digit, axis=0)
+    digits = np.where(is_digit, digits, 0)
+
+    dot_rows = np.nonzero(np.any(is_dot, axis=1))[0]
+    if len(dot_rows) == 0 or \
+            (len(dot_rows) == 1 and np.all(is_dot[dot_rows[0]])):
+        # Fortran F format: The dot is at the same position in every line,
+        # so the value is a weighted sum of the digits.
+        dot = dot_rows[0] if len(dot_rows) else width - 1
+        places = width - 1 - np.arange(width)
+        places[:dot] -= len(dot_rows)
+        value = (10.0 ** places).dot(digits)
+        scale = 10.0 ** (width - 1 - dot)
+    else:
+        # value = value * 10 + digit and scale *= 10 for the digits after
+        # the dot, without branches.
+        value = np.zeros(count, dtype=np.float64)
+        scale = np.ones(count, dtype=np.float64)
+        seen_dot = np.zeros(count, dtype=np.bool_)
+        for row_digits, row_is_digit, row_is_dot in zip(digits, is_digit,
+                                                        is_dot):
+            seen_dot |= row_is_dot
+            factor = 1.0 + 9.0 * row_is_digit
+            value *= factor
+            value += row_digits
+            scale *= np.where(seen_dot, factor, 1.0)
+    value /= scale
+    value[np.any(chars == 45, axis=0)] *= -1.0
+
+    result[:] = value
+    for index in np.nonzero(bad)[0]:
+        result[index] = _convert_token(
+            chars[:, index].tostring().strip(), dtype)
+    return result
+
+
+def _parse_fixed_width(data, dtype):
+    """
+    Parse lines of identical length with the columns at the same positions
+    in every line, as written by hypoDD.
+
+    Returns None if the lines do not have such a layout or contain header
+    lines.
+    """
+    width = data.find("\n") + 1
+    if not width or len(data) % width:
+        return None
+    chars = np.frombuffer(data, dtype=np.uint8).reshape(-1, width)
+    if np.any(chars[:, -1] != 10):
+        return None
+    header = np.frombuffer(_HEADER_PREFIX, dtype=np.uint8)
+    if width > len(header) and np.any(
+            np.all(chars[:, :len(header)] == header, axis=1)):
+        return None
+    # One contiguous row per character position.
+    chars = _transpose(chars[:, :-1])
+    is_space = chars <= 32
+    # A field is a run of character positions that are not empty in all
+    # lines and contains exactly one token in every line.
+    separators = np.all(is_space, axis=1)
+    fields = []
+    for index, separator in enumerate(separators):
+        if separator:
+            continue
+        if fields and fields[-1][1] == index:
+            fields[-1][1] = index + 1
+        else:
+            fields.append([index, index + 1])
+    if len(fields) != len(dtype.names):
+        return None
+    result = np.empty(chars.shape[1], dtype=dtype)
+    for name, (start, end) in zip(dtype.names, fields):
+        field_chars = chars[start:end]
+        field_space = is_space[start:end]
+        token_starts = ~field_space[0] + np.sum(
+            field_space[:-1] & ~field_space[1:], axis=0)
+        if np.any(token_starts != 1):
+            return None
+        if dtype[name].kind == "S":
+            tokens = np.where(field_space, 0, field_chars).astype(np.uint8)
+            tokens = _transpose(tokens).view(
+                "S%i" % (end - start))[:, 0]
+            if np.any(field_space[0]):
+                # Right aligned strings, hypoDD writes them left aligned.
+                tokens = [_i.lstrip("\x00") for _i in tokens]
+            result[name] = tokens
+        else:
+            result[name] = _parse_numeric_field(field_chars, field_space,
+                                                dtype[name])
+    return result
+
+
+def parse_lines(lines, dtype):
+    """
+    Parse lines of a hypoDD output file.
+
+    :param lines: List of lines. Empty lines and header lines are skipped.
+    :param dtype: One of RELOC_DTYPE, RES_DTYPE, STA_DTYPE or the result of
+        get_src_dtype().
+
+    Returns a structured array with one entry per line.
+    """
+    result = _parse_fixed_width("".join(lines), dtype)
+    if result is not None:
+        return result
+    # Remove header and empty lines and try again.
+    lines = [_i for _i in lines
+             if _i.strip() and not _i.startswith(_HEADER_PREFIX)]
+    if not lines:
+        return np.empty(0, dtype=dtype)
+    if not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    result = _parse_fixed_width("".join(lines), dtype)
+    if result is None:
+        result = _parse_split(lines, dtype)
+    return result
+
+
+def iter_line_chunks(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Generator yielding lists of up to chunk_size lines of a file.
+    """
+    with open(filename, "r") as open_file:
+        while True:
+            lines = list(itertools.islice(open_file, chunk_size))
+            if not lines:
+                break
+            yield lines
+
+
+def iter_output_chunks(filename, dtype, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Generator yielding structured arrays of up to chunk_size lines of a hypoDD
+    output file.
+    """
+    for lines in iter_line_chunks(filename, chunk_size):
+        yield parse_lines(lines, dtype)
+
+
+def read_output_file(filename, dtype):
+    """
+    Read a complete hypoDD output file into a structured array.
+    """
+    chunks = list(iter_output_chunks(filename, dtype))
+    if not chunks:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+
+def read_reloc(filename):
+    """
+    Read hypoDD.reloc or hypoDD.loc.
+    """
+    return read_output_file(filename, RELOC_DTYPE)
+
+
+def read_res(filename):
+    """
+    Read hypoDD.res. Use iter_output_chunks() for very large files.
+    """
+    return read_output_file(filename, RES_DTYPE)
+
+
+def read_sta(filename):
+    """
+    Read hypoDD.sta.
+    """
+    return read_output_file(filename, STA_DTYPE)
+
+
+def read_src(filename):
+    """
+    Read hypoDD.src, see get_src_dtype().
+    """
+    column_count = 0
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            if line.strip():
+                column_count = len(line.split())
+                break
+    return read_output_file(filename, get_src_dtype(column_count))
+
+
+def get_residual_statistics(res_file, by="station", reloc_file=None,
+                            data_types=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Compute residual statistics of hypoDD.res per station or per cluster.
+    The file is processed chunk by chunk.
+
+    :param res_file: The hypoDD.res file.
+    :param by: "station" or "cluster". The cluster of a residual is the
+        cluster of the first event of its pair.
+    :param reloc_file: The hypoDD.reloc file with the cluster ids. Only
+        needed if by is "cluster". Residuals of events that are not in the
+        file are ignored.
+    :param data_types: Only use residuals of the given data types, see
+        RES_DTYPE. Defaults to all.
+    :param chunk_size: Number of lines processed at once.
+
+    Returns a structured array sorted by the key with the fields key, count,
+    mean, std, rms and weighted_rms. All residuals are in ms.
+    """
+    if by not in ["station", "cluster"]:
+        msg = "by has to be either 'station' or 'cluster'."
+        raise ValueError(msg)
+    if by == "cluster":
+        if reloc_file is None:
+            msg = "The reloc_file is needed for statistics per cluster."
+            raise ValueError(msg)
+        relocations = read_reloc(reloc_file)
+        sorter = np.argsort(relocations["id"])
+        event_ids = relocations["id"][sorter]
+        cluster_ids = relocations["cluster_id"][sorter]
+
+    # Running sums per key: count, sum, sum of squares, sum of weights and
+    # weighted sum of squares.
+    sums = {}
+    for chunk in iter_output_chunks(res_file, RES_DTYPE, chunk_size):
+        if data_types is not None:
+            chunk = chunk[np.in1d(chunk["data_type"], data_types)]
+        if by == "station":
+            keys = chunk["station"]
+        else:
+            positions = np.searchsorted(event_ids, chunk["event_1"])
+            positions = np.minimum(positions, max(len(event_ids) - 1, 0))
+            known = event_ids[positions] == chunk["event_1"] \
+                if len(event_ids) else np.zeros(len(chunk), dtype=np.bool_)
+            chunk = chunk[known]
+            keys = cluster_ids[positions[known]]
+        if not len(chunk):
+            continue
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        residuals = chunk["residual"]
+        weights = chunk["weight"]
+        chunk_sums = np.array([
+            np.bincount(inverse, minlength=len(unique_keys)),
+            np.bincount(inverse, residuals, len(unique_keys)),
+            np.bincount(inverse, residuals ** 2, len(unique_keys)),
+            np.bincount(inverse, weights, len(unique_keys)),
+            np.bincount(inverse, weights * residuals ** 2,
+                        len(unique_keys))], dtype=np.float64)
+        for index, key in enumerate(unique_keys):
+            key = key.item()
+            if key in sums:
+                sums[key] += chunk_sums[:, index]
+            else:
+                sums[key] = chunk_sums[:, index].copy()
+
+    key_dtype = RES_DTYPE["station"] if by == "station" else np.int32
+    statistics = np.zeros(len(sums), dtype=[
+        ("key", key_dtype), ("count", np.int64), ("mean", np.float64),
+        ("std", np.float64), ("rms", np.float64),
+        ("weighted_rms", np.float64)])
+    for index, key in enumerate(sorted(sums)):
+        count, total, squares, weights, weighted_squares = sums[key]
+        mean = total / count
+        statistics[index] = (
+            key, count, mean, np.sqrt(max(squares / count - mean ** 2, 0.0)),
+            np.sqrt(squares / count),
+            np.sqrt(weighted_squares / weights) if weights else np.nan)
+    return statistics
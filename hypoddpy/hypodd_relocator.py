@@ -1,12 +1,12 @@
 import copy
-import fnmatch
-import glob
+import itertools
 import json
 import logging
 import math
-from obspy.core import read, Stream, UTCDateTime
-from obspy.core.event import Catalog, Comment, Origin, read_events, \
-    ResourceIdentifier
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from obspy.core import read, Stream, Trace, UTCDateTime
 from obspy.signal.cross_correlation import xcorr_pick_correction
 from obspy.io.xseed import Parser
 import os
@@ -16,17 +16,112 @@ import subprocess
 import sys
 import warnings
 
-from hypodd_compiler import HypoDDCompiler
+from batched_cross_correlation import xcorr_pick_pairs
+from cc_journal import CrossCorrelationJournal
+from cc_schedule import expand_pick_pairs, group_pick_pairs, sort_picks
+from cc_store import CrossCorrelationStore, is_store_filename
+from geometry import get_distance_percentile, get_maximum_distance, \
+    to_cartesian
+from event_reader import read_event_table
+from event_table import EventTable
+from event_writer import create_hypodd_origin, get_relocated_time, \
+    write_csv, write_quakeml
+from hypodd_compiler import COMPILE_PROFILES, estimate_static_memory, \
+    HypoDDCompiler
+from hypodd_output import read_reloc
+from native_ph2dt import run_ph2dt
+from partitioning import assign_partitions, merge_partition_outputs, \
+    write_partition_inputs
+from stage_cache import get_file_content_fingerprint, \
+    get_files_fingerprint, get_fingerprint, get_function_fingerprint, \
+    StageCache
+from waveform_cache import WaveformCache
+from waveform_index import WaveformIndex
+from waveform_records import get_trace_spans, RecordIndex, scan_records
+from waveform_sources import FileListSource, WaveformSource
+from waveform_snippets import cut_snippet, get_snippet_window, \
+    SNIPPET_PADDING_PERIODS, WaveformSnippets
+
+
+# Minimum number of cross correlation and catalog observations of linked
+# event pairs, OBSCC and OBSCT in hypoDD.inp. With IDAT=3 their sum is used
+# for both.
+_OBSCC = 8
+_OBSCT = 0
+# Number of station groups of pick pairs sent to a worker process at once.
+# The groups differ a lot in size so they are handed out one by one.
+_CC_WORKER_CHUNKSIZE = 1
+# Number of event pairs cross correlated at once. Bounds the memory used by
+# the pending work and the results not yet written to the journal.
+_CC_EVENT_PAIR_CHUNKSIZE = 2000
+# The relocator the forked cross correlation workers operate on.
+_CC_WORKER_RELOCATOR = None
+# Number of waveform files sent to a worker process at once.
+_WAVEFORM_SCAN_CHUNKSIZE = 50
+# Number of scanned waveform files after which the registry is saved so an
+# interrupted scan does not have to start from scratch.
+_WAVEFORM_REGISTRY_SAVE_INTERVAL = 10000
 
 
 class HypoDDException(Exception):
     pass
 
 
+def _cross_correlate_pick_pairs_worker(work_items):
+    """
+    Cross correlate a group of pick pairs in a worker process.
+
+    :param work_items: List of (event_pair, pick_1, pick_2) tuples.
+
+    Returns the event pair of every work item and a dictionary with all newly
+    calculated pick pair results.
+    """
+    cc_results = {}
+    for _, pick_1, pick_2 in work_items:
+        _CC_WORKER_RELOCATOR._cross_correlate_pick_pair(pick_1, pick_2,
+                                                        cc_results)
+    return [_i[0] for _i in work_items], cc_results
+
+
+def _scan_waveform_file(args):
+    """
+    Scan the records of one waveform file, possibly in a worker process.
+    The record index of miniSEED files is stored in the given directory and
+    the traces are derived from it. Other formats are read header only with
+    ObsPy.
+
+    :param args: Tuple of the filename and the record index directory.
+
+    Returns the filename and a list of (trace_id, starttime, endtime) tuples
+    with the times as strings or None if the file could not be read.
+    """
+    filename, record_directory = args
+    record_index = RecordIndex(record_directory)
+    try:
+        records = scan_records(filename)
+    except ValueError:
+        records = None
+    if records is not None:
+        record_index.save(filename, records)
+        return filename, [(trace_id, str(UTCDateTime(starttime)),
+                           str(UTCDateTime(endtime))) for
+                          trace_id, starttime, endtime in
+                          get_trace_spans(records)]
+    # Not a miniSEED file. It will always be read in full.
+    record_index.remove(filename)
+    try:
+        st = read(filename, headonly=True)
+    except Exception:
+        return filename, None
+    return filename, [(trace.id, str(trace.stats.starttime),
+                       str(trace.stats.endtime)) for trace in st]
+
+
 class HypoDDRelocator(object):
     def __init__(self, working_dir, cc_time_before, cc_time_after, cc_maxlag,
                  cc_filter_min_freq, cc_filter_max_freq, cc_p_phase_weighting,
-                 cc_s_phase_weighting, cc_min_allowed_cross_corr_coeff):
+                 cc_s_phase_weighting, cc_min_allowed_cross_corr_coeff,
+                 cc_engine="obspy"):
         """
         :param working_dir: The working directory where all temporary and final
             files will be placed.
@@ -55,6 +150,11 @@ class HypoDDRelocator(object):
         :param cc_min_allowed_cross_corr_coeff: The minimum allowed
             cross-correlation coefficient for a differential travel time to be
             accepted.
+        :param cc_engine: How to calculate the cross correlations. "obspy"
+            calls xcorr_pick_correction() for every pick pair, "fft" uses the
+            batched FFT engine in batched_cross_correlation.py which
+            correlates all pick pairs of one station, phase and channel at
+            once. Defaults to "obspy".
         """
         self.working_dir = working_dir
         if not os.path.exists(working_dir):
@@ -64,6 +164,9 @@ class HypoDDRelocator(object):
         if cc_filter_min_freq >= cc_filter_max_freq:
             msg = "cc_filter_min_freq has to smaller then cc_filter_max_freq."
             raise HypoDDException(msg)
+        if cc_engine not in ["obspy", "fft"]:
+            msg = "cc_engine has to be either 'obspy' or 'fft'."
+            raise HypoDDException(msg)
         # Fill the phase weighting dict if necessary.
         cc_p_phase_weighting = copy.copy(cc_p_phase_weighting)
         cc_s_phase_weighting = copy.copy(cc_s_phase_weighting)
@@ -83,8 +186,13 @@ class HypoDDRelocator(object):
             "cc_filter_max_freq": cc_filter_max_freq,
             "cc_p_phase_weighting": cc_p_phase_weighting,
             "cc_s_phase_weighting": cc_s_phase_weighting,
-            "cc_min_allowed_cross_corr_coeff": cc_min_allowed_cross_corr_coeff}
+            "cc_min_allowed_cross_corr_coeff": cc_min_allowed_cross_corr_coeff,
+            "cc_engine": cc_engine}
         self.cc_results = {}
+        # Attached on-disk stores of previously computed results.
+        self.cc_stores = []
+        # Pre-processed waveform snippets of all picks.
+        self.snippets = None
 
         # Setup logging.
         logging.basicConfig(level=logging.DEBUG,
@@ -94,16 +202,58 @@ class HypoDDRelocator(object):
         self.event_files = []
         self.station_files = []
         self.waveform_files = []
+        # The waveform files are the default source of the waveform data,
+        # see setup_waveform_source().
+        self.waveform_source = FileListSource(self.waveform_files)
 
         # Dictionary to store forced configuration values.
         self.forced_configuration_values = {}
 
+        # Number of processes used for the cross correlation.
+        self.n_workers = 1
+        # Update the working directory of a previous run instead of
+        # recomputing everything.
+        self.incremental = False
+        # Use the ph2dt binary or the Python implementation.
+        self.ph2dt_engine = "binary"
+        # Tile size and halo of the partitioned relocation or None to
+        # relocate all events at once. See setup_partitioning().
+        self.partitioning = None
+        # Relative headroom of the hypoDD array dimensions and the memory
+        # budget in MB, see setup_hypodd_arrays().
+        self.hypodd_array_headroom = 0.2
+        self.hypodd_memory_budget = None
+        # Compile profile and number of make jobs, see setup_compilation().
+        self.compile_profile = "default"
+        self.compile_jobs = None
+        # Decoded waveform files kept in memory while the snippets are
+        # extracted, see setup_waveform_cache().
+        self.waveform_cache = WaveformCache()
+
         # Configure the paths.
         self._configure_paths()
 
+        # Fingerprints of the inputs of all stages. A stage is only rerun if
+        # its fingerprint changed.
+        stage_cache_file = os.path.join(self.paths["working_files"],
+                                        "stage_fingerprints.json")
+        # Only outputs of working directories written by earlier versions,
+        # i.e. without any fingerprints, are adopted, see
+        # _is_stage_current().
+        self._adopt_outputs = not os.path.exists(stage_cache_file)
+        self.stage_cache = StageCache(stage_cache_file)
+        self.stage_fingerprints = {}
+        # Stages rerun in this run.
+        self._rerun_stages = set()
+        # Record level index of the miniSEED files for ranged reads. Filled
+        # while the waveform files are parsed.
+        self.record_index = RecordIndex(os.path.join(
+            self.paths["working_files"], "waveform_records"))
+
     def start_relocation(self, output_event_file,
                          output_cross_correlation_file=None,
-                         create_plots=True):
+                         create_plots=True, n_workers=1, incremental=False,
+                         ph2dt_engine="binary", output_format="quakeml"):
         """
         Start the relocation with HypoDD and write the output to
         output_event_file.
@@ -115,12 +265,44 @@ class HypoDDRelocator(object):
         :type output_cross_correlation_file: str
         :param create_plots: If true, some plots will be created in
             working_dir/output_files. Defaults to True.
+        :type n_workers: int
+        :param n_workers: Number of processes the waveform files will be
+            distributed over during the waveform scan and the event pairs
+            during the cross correlation. Also the number of partitions
+            relocated at the same time, see setup_partitioning(). Defaults
+            to 1.
+        :type incremental: bool
+        :param incremental: If True, the working directory of a previous run
+            is updated instead of recomputed. Only event files that have not
+            been parsed before are read and the new events are appended with
+            new event numbers. ph2dt only contributes the pairs involving new
+            events to dt.ct and only these pairs are cross correlated. All
+            previous results are kept as long as the cross correlation
+            parameters do not change. Defaults to False.
+        :type ph2dt_engine: str
+        :param ph2dt_engine: How to select the catalog event pairs. "binary"
+            runs the compiled ph2dt, "native" uses the implementation in
+            native_ph2dt.py which has no compile-time size limits and scales
+            to large catalogs. Defaults to "binary".
+        :type output_format: str
+        :param output_format: "quakeml" writes all input events with the
+            HypoDD origins appended, "csv" writes one line with the original
+            and the relocated location per event. Defaults to "quakeml".
         """
+        if n_workers < 1:
+            msg = "n_workers has to be at least 1."
+            raise HypoDDException(msg)
+        if ph2dt_engine not in ["binary", "native"]:
+            msg = "ph2dt_engine has to be either 'binary' or 'native'."
+            raise HypoDDException(msg)
+        if output_format not in ["quakeml", "csv"]:
+            msg = "output_format has to be either 'quakeml' or 'csv'."
+            raise HypoDDException(msg)
+        self.ph2dt_engine = ph2dt_engine
+        self.output_format = output_format
+        self.n_workers = int(n_workers)
+        self.incremental = bool(incremental)
         self.output_event_file = output_event_file
-        if os.path.exists(self.output_event_file):
-            msg = "The output_event_file already exists. Nothing to do."
-            self.log(msg)
-            return
 
         self.log("Starting relocator...")
         self._parse_station_files()
@@ -129,15 +311,26 @@ class HypoDDRelocator(object):
         self._write_ph2dt_inp_file()
         self._create_event_id_map()
         self._write_catalog_input_file()
-        self._compile_hypodd()
+        self._compile_ph2dt()
         self._run_ph2dt()
         self._parse_waveform_files()
         self._cross_correlate_picks(outfile=output_cross_correlation_file)
         self._write_hypoDD_inp_file()
+        self._compile_hypodd()
         self._run_hypodd()
+        if self._is_stage_current("output", [
+                self.stage_fingerprints["hypodd"],
+                get_files_fingerprint(self.event_files),
+                os.path.abspath(self.output_event_file),
+                self.output_format],
+                [self.output_event_file], adopt=False):
+            msg = "The output_event_file is up to date. Nothing to do."
+            self.log(msg)
+            return
         self._create_output_event_file()
         if create_plots:
             self._create_plots()
+        self._finish_stage("output")
 
     def add_event_files(self, event_files):
         """
@@ -179,7 +372,14 @@ class HypoDDRelocator(object):
         """
         Adds all files in waveform_files to self.waveform_files. All files will
         be verified to exist but no further checks are done.
+
+        Not available if another waveform source is used, see
+        setup_waveform_source().
         """
+        if not isinstance(self.waveform_source, FileListSource):
+            msg = ("Waveform files cannot be added to a %s." %
+                   self.waveform_source.__class__.__name__)
+            raise HypoDDException(msg)
         if isinstance(waveform_files, basestring):
             waveform_files = [waveform_files]
         for waveform_file in waveform_files:
@@ -243,6 +443,53 @@ class HypoDDRelocator(object):
             if not os.path.exists(self.paths[path]):
                 os.makedirs(self.paths[path])
 
+    def _is_stage_current(self, stage, inputs, output_files, adopt=True):
+        """
+        Fingerprint the inputs of a stage and check if its output files are
+        up to date. Stages that are not current are invalidated so partially
+        written outputs are never reused. Call _finish_stage() once all
+        outputs are written.
+
+        Outputs of working directories written by earlier versions, which
+        have no fingerprints at all, are adopted if they all exist within
+        the working directory and no earlier stage had to be rerun. Any
+        other outputs without a fingerprint are recomputed.
+
+        :param stage: Name of the stage.
+        :param inputs: List of everything the outputs depend on, e.g.
+            parameters and the fingerprints of files and other stages.
+        :param output_files: List of all output files of the stage.
+        :param adopt: Whether outputs without a fingerprint may be adopted
+            at all.
+        """
+        fingerprint = get_fingerprint(stage, inputs)
+        self.stage_fingerprints[stage] = fingerprint
+        if self.stage_cache.is_current(stage, fingerprint, output_files):
+            return True
+        if self.stage_cache.is_unknown(stage) and output_files and \
+                all(os.path.exists(_i) for _i in output_files):
+            working_dir = os.path.join(os.path.abspath(self.working_dir), "")
+            if adopt and self._adopt_outputs and not self._rerun_stages and \
+                    all(os.path.abspath(_i).startswith(working_dir)
+                        for _i in output_files):
+                self.log("Adopting existing output files of stage '%s' "
+                         "which have no recorded fingerprint." % stage,
+                         level="warning")
+                self._finish_stage(stage)
+                return True
+            self.log("The existing output files of stage '%s' have no "
+                     "recorded fingerprint. The stage will be rerun." % stage,
+                     level="warning")
+        self._rerun_stages.add(stage)
+        self.stage_cache.invalidate(stage)
+        return False
+
+    def _finish_stage(self, stage):
+        """
+        Record the fingerprint of a stage after all its outputs are written.
+        """
+        self.stage_cache.record(stage, self.stage_fingerprints[stage])
+
     def log(self, string, level="info"):
         """
         Prints a colorful and fancy string and logs the same string.
@@ -268,7 +515,9 @@ class HypoDDRelocator(object):
         serialized_station_file = os.path.join(self.paths["working_files"],
                                                "stations.json")
         # If already parsed before, just read the serialized station file.
-        if os.path.exists(serialized_station_file):
+        if self._is_stage_current(
+                "stations", [get_files_fingerprint(self.station_files)],
+                [serialized_station_file]):
             self.log("Stations already parsed. Will load the serialized " +
                      "information.")
             with open(serialized_station_file, "r") as open_file:
@@ -293,6 +542,7 @@ class HypoDDRelocator(object):
                         "elevation": int(round(blockette.elevation))}
         with open(serialized_station_file, "w") as open_file:
             json.dump(self.stations, open_file)
+        self._finish_stage("stations")
         self.log("Done parsing stations.")
 
     def _write_station_input_file(self):
@@ -304,8 +554,10 @@ class HypoDDRelocator(object):
         """
         station_dat_file = os.path.join(self.paths["input_files"],
                                         "station.dat")
-        if os.path.exists(station_dat_file):
-            self.log("station.dat input file already exists.")
+        if self._is_stage_current("station.dat",
+                                  [self.stage_fingerprints["stations"]],
+                                  [station_dat_file]):
+            self.log("station.dat input file is up to date.")
             return
         station_strings = []
         for key, value in self.stations.iteritems():
@@ -314,6 +566,7 @@ class HypoDDRelocator(object):
         station_string = "\n".join(station_strings)
         with open(station_dat_file, "w") as open_file:
             open_file.write(station_string)
+        self._finish_stage("station.dat")
         self.log("Created station.dat input file.")
 
     def _write_catalog_input_file(self, phase_weighting=None):
@@ -334,8 +587,11 @@ class HypoDDRelocator(object):
             phase_weighting = self.phase_weighting
         phase_dat_file = os.path.join(self.paths["input_files"],
                                       "phase.dat")
-        if os.path.exists(phase_dat_file):
-            self.log("phase.dat input file already exists.")
+        if self._is_stage_current("phase.dat", [
+                self.stage_fingerprints["events"],
+                get_function_fingerprint(phase_weighting)],
+                [phase_dat_file]):
+            self.log("phase.dat input file is up to date.")
             return
         event_strings = []
         for event in self.events:
@@ -397,125 +653,229 @@ class HypoDDRelocator(object):
         # Write the phase.dat file.
         with open(phase_dat_file, "w") as open_file:
             open_file.write(event_string)
+        self._finish_stage("phase.dat")
         self.log("Created phase.dat input file.")
 
     def _read_event_information(self):
         """
-        Read all event files and extract the needed information and serialize
-        it as a JSON object. This is not necessarily needed but eases
-        development as the JSON file is just much faster to read then the full
-        event files.
+        Read all event files and extract the needed information and store it
+        as an EventTable in working_dir/working_files/event_table. The table
+        is memory mapped on later runs which is much faster than reading the
+        full event files.
+
+        The absolute paths of all parsed event files are stored in
+        working_dir/working_files/event_files.json. In incremental mode only
+        files not listed there are read and their events are appended.
         """
-        serialized_event_file = os.path.join(self.paths["working_files"],
-                                             "events.json")
-        if os.path.exists(serialized_event_file):
+        event_table_dir = os.path.join(self.paths["working_files"],
+                                       "event_table")
+        parsed_event_files_file = os.path.join(self.paths["working_files"],
+                                               "event_files.json")
+        self._migrate_serialized_events(event_table_dir)
+        if self._is_stage_current("events", [
+                self.stage_fingerprints["stations"],
+                get_files_fingerprint(self.event_files)],
+                [os.path.join(event_table_dir, "table.json")]):
             self.log("Events already parsed. Will load the serialized " +
                      "information.")
-            with open(serialized_event_file, "r") as open_file:
-                self.events = json.load(open_file)
-            # Loop and convert all time values to UTCDateTime.
-            for event in self.events:
-                event["origin_time"] = UTCDateTime(event["origin_time"])
-                for pick in event["picks"]:
-                    pick["pick_time"] = UTCDateTime(pick["pick_time"])
+            self.events = EventTable.load(event_table_dir)
             self.log("Reading serialized event file successful.")
             return
-        self.log("Reading all events...")
-        catalog = Catalog()
-        for event in self.event_files:
-            catalog += read_events(event)
-        self.events = []
+        event_files = self.event_files
+        parsed_event_files = []
+        # The events are collected as tables. The workers only send back the
+        # compact tables of their files, not the event dictionaries.
+        tables = []
+        if self.incremental and os.path.exists(
+                os.path.join(event_table_dir, "table.json")):
+            tables.append(EventTable.load(event_table_dir))
+            if os.path.exists(parsed_event_files_file):
+                with open(parsed_event_files_file, "r") as open_file:
+                    parsed_event_files = json.load(open_file)
+            already_parsed = set(parsed_event_files)
+            event_files = [_i for _i in self.event_files
+                           if os.path.abspath(_i) not in already_parsed]
+            self.log("Incremental mode: Reading %i new event files..." %
+                     len(event_files))
+        else:
+            self.log("Reading all events...")
+        # Events already known are not added again.
+        known_event_ids = set()
+        for table in tables:
+            known_event_ids.update(table.get_event_ids())
         # Keep track of the number of discarded picks.
         discarded_picks = 0
-        # Loop over all events.
-        for event in catalog:
-            current_event = {}
-            self.events.append(current_event)
-            current_event["event_id"] = str(event.resource_id)
-            # Take the value from the first event.
-            current_event["magnitude"] = event.magnitudes[0].mag
-            # Always take the first origin.
-            origin = event.origins[0]
-            current_event["origin_time"] = origin.time
-            # Origin time error.
-            if origin.time_errors.uncertainty is not None:
-                current_event["origin_time_error"] = \
-                    origin.time_errors.uncertainty
-            else:
-                current_event["origin_time_error"] = 0.0
-            current_event["origin_latitude"] = origin.latitude
-            # Origin latitude error.
-            if origin.latitude_errors.uncertainty is not None:
-                current_event["origin_latitude_error"] = \
-                    origin.latitude_errors.uncertainty
-            else:
-                current_event["origin_latitude_error"] = 0.0
-            current_event["origin_longitude"] = origin.longitude
-            # Origin longitude error.
-            if origin.longitude_errors.uncertainty is not None:
-                current_event["origin_longitude_error"] = \
-                    origin.longitude_errors.uncertainty
-            else:
-                current_event["origin_longitude_error"] = 0.0
-            current_event["origin_depth"] = origin.depth
-            # Origin depth error.
-            if origin.depth_errors.uncertainty is not None:
-                current_event["origin_depth_error"] = \
-                    origin.depth_errors.uncertainty
-            else:
-                current_event["origin_depth_error"] = 0.0
-            # Also append all picks.
-            current_event["picks"] = []
-            for pick in event.picks:
-                current_pick = {}
-                current_pick["id"] = str(pick.resource_id)
-                current_pick["pick_time"] = pick.time
-                if hasattr(pick.time_errors, "uncertainty"):
-                    current_pick["pick_time_error"] = \
-                        pick.time_errors.uncertainty
-                else:
-                    current_pick["pick_time_error"] = None
-                current_pick["station_id"] = "%s.%s" % \
-                    (pick.waveform_id.network_code,
-                     pick.waveform_id.station_code)
-                current_pick["phase"] = pick.phase_hint
-                # Assert that information for the station of the pick is
+        # The files are read in parallel but the events are processed in the
+        # order of the files.
+        if self.n_workers > 1 and len(event_files) > 1:
+            pool = multiprocessing.Pool(self.n_workers)
+            file_tables = pool.imap(read_event_table, event_files)
+        else:
+            pool = None
+            file_tables = itertools.imap(read_event_table, event_files)
+        try:
+            for table in file_tables:
+                positions = []
+                for position, event_id in enumerate(table.get_event_ids()):
+                    if event_id in known_event_ids:
+                        msg = "Event %s is already known and will not be " \
+                            "added again." % event_id
+                        self.log(msg, level="warning")
+                        continue
+                    known_event_ids.add(event_id)
+                    positions.append(position)
+                offsets = np.asarray(table.columns["pick_offsets"])
+                positions = np.array(positions, dtype=np.int64)
+                pick_count = int(
+                    (offsets[positions + 1] - offsets[positions]).sum())
+                # Assert that information for the station of every pick is
                 # available.
-                if not current_pick["station_id"] in self.stations.keys():
-                    discarded_picks += 0
-                    continue
-                current_event["picks"].append(current_pick)
+                known_stations = np.array(
+                    [_i in self.stations for _i in table.stations],
+                    dtype=np.bool_)
+                table = table.select(
+                    positions, known_stations[table.columns["pick_station"]])
+                discarded_picks += pick_count - len(table.columns["pick_id"])
+                tables.append(table)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         # Sort events by origin time
-        self.events.sort(key=lambda event: event["origin_time"])
-        # Serialize the event dict. Copy it so the times can be converted to
-        # strings.
-        events = copy.deepcopy(self.events)
-        for event in events:
-            event["origin_time"] = str(event["origin_time"])
-            for pick in event["picks"]:
-                pick["pick_time"] = str(pick["pick_time"])
-        with open(serialized_event_file, "w") as open_file:
-            json.dump(events, open_file)
+        self.events = EventTable.concatenate(tables)
+        self.events = self.events.select(np.argsort(
+            self.events.get_column("origin_time"), kind="mergesort"))
+        self.events.save(event_table_dir)
+        for event_file in event_files:
+            if os.path.abspath(event_file) not in parsed_event_files:
+                parsed_event_files.append(os.path.abspath(event_file))
+        with open(parsed_event_files_file, "w") as open_file:
+            json.dump(parsed_event_files, open_file)
+        self._finish_stage("events")
         self.log("Reading all events successful.")
         self.log(("%i picks discarded because of " % discarded_picks) +
                  "unavailable station information.")
 
+    def _migrate_serialized_events(self, event_table_dir):
+        """
+        Convert the events.json file of working directories created by
+        earlier versions to an event table.
+        """
+        filename = os.path.join(self.paths["working_files"], "events.json")
+        if not os.path.exists(filename) or os.path.exists(event_table_dir):
+            return
+        self.log("Converting events.json to an event table...")
+        with open(filename, "r") as open_file:
+            events = json.load(open_file)
+        # Loop and convert all time values to UTCDateTime.
+        for event in events:
+            event["origin_time"] = UTCDateTime(event["origin_time"])
+            for pick in event["picks"]:
+                pick["pick_time"] = UTCDateTime(pick["pick_time"])
+        EventTable.from_events(events).save(event_table_dir)
+        os.remove(filename)
+
     def _create_event_id_map(self):
         """
         HypoDD can only deal with numeric event ids. Map all events to a number
-        from 1 to number_of_events.
+        starting from 1.
 
         This method will create the self.map dictionary with a two way mapping.
 
         self.event_map["event_id_string"] = number
         self.event_map[number] = "event_id_string"
+
+        The mapping is stored in working_dir/working_files/event_id_map.json
+        and reused by later runs so the numbers of known events never change.
+        Events not in the stored mapping get the next free numbers in the
+        order of self.events.
         """
+        event_id_map_file = os.path.join(self.paths["working_files"],
+                                         "event_id_map.json")
+        stored_map = {}
+        if os.path.exists(event_id_map_file):
+            with open(event_id_map_file, "r") as open_file:
+                stored_map = json.load(open_file)
+        next_number = max(stored_map.values()) + 1 if stored_map else 1
+        new_events = False
+        event_ids = self.events.get_event_ids()
+        for event_id in event_ids:
+            if event_id in stored_map:
+                continue
+            stored_map[event_id] = next_number
+            next_number += 1
+            new_events = True
+        if new_events or not os.path.exists(event_id_map_file):
+            with open(event_id_map_file, "w") as open_file:
+                json.dump(stored_map, open_file)
         self.event_map = {}
-        # Just create this every time as it is very fast.
-        for _i, event in enumerate(self.events):
-            event_id = event["event_id"]
-            self.event_map[event_id] = _i + 1
-            self.event_map[_i + 1] = event_id
+        for event_id in event_ids:
+            number = stored_map[event_id]
+            self.event_map[event_id] = number
+            self.event_map[number] = event_id
+        self._create_event_lookup_tables()
+
+    def _create_event_lookup_tables(self):
+        """
+        Create the lookup table used to find events by mapped event number in
+        constant time.
+
+        self._event_index[number] = position in self.events
+        """
+        self._event_index = {}
+        for _i, event_id in enumerate(self.events.get_event_ids()):
+            self._event_index[self.event_map[event_id]] = _i
+
+    def _get_event(self, event_number):
+        """
+        Returns the event dictionary for the mapped event number or None.
+        """
+        position = self._event_index.get(event_number)
+        if position is None:
+            return None
+        return self.events[position]
+
+    def _get_pick(self, event_number, station_id, phase):
+        """
+        Returns the first pick of the event with the given station id and
+        phase or None.
+        """
+        position = self._event_index.get(event_number)
+        if position is None:
+            return None
+        return self.events.get_pick(position, station_id, phase)
+
+    def _get_pick_pairs(self, event_1, event_2):
+        """
+        Returns a list of (index_1, index_2) tuples with the event table
+        indices of every pick of the first event and the matching pick of
+        the second event or None if one of the events is unknown.
+        """
+        position_1 = self._event_index.get(event_1)
+        position_2 = self._event_index.get(event_2)
+        if position_1 is None or position_2 is None:
+            return None
+        return self.events.match_picks(position_1, position_2)
+
+    def get_event(self, event_number):
+        """
+        Returns a copy of the event dictionary belonging to the numeric event
+        id used in the HypoDD files or None if it is unknown.
+
+        Only available after the event id map has been created.
+        """
+        return copy.deepcopy(self._get_event(event_number))
+
+    def get_pick(self, event_number, station_id, phase):
+        """
+        Returns a copy of the pick dictionary of the event with the numeric
+        event id for the given station id (network.station) and phase or
+        None if there is no such pick. If an event has more than one pick
+        for a station and phase, the first one is returned.
+
+        Only available after the event id map has been created.
+        """
+        return copy.deepcopy(self._get_pick(event_number, station_id, phase))
 
     def _write_ph2dt_inp_file(self):
         """
@@ -527,33 +887,29 @@ class HypoDDRelocator(object):
         values = {}
         if "MAXDIST" not in self.forced_configuration_values:
             # Calculate MAXDIST so that all event-station pairs are definitely
-            # inluded. This is a very simple way of doing it.
-            lats = []
-            longs = []
-            depths = []
-            for event in self.events:
-                lats.append(event["origin_latitude"])
-                longs.append(event["origin_longitude"])
-                # Convert to km.
-                depths.append(event["origin_depth"] / 1000.0)
+            # inluded. The diagonal of the bounding box of all events and
+            # stations is an upper bound of all distances.
+            lats = list(self.events.get_column("origin_latitude"))
+            longs = list(self.events.get_column("origin_longitude"))
+            # Convert to km.
+            depths = list(self.events.get_column("origin_depth") / 1000.0)
             for _, station in self.stations.iteritems():
                 lats.append(station["latitude"])
                 longs.append(station["longitude"])
-                # station elevation is in meter.
-                depths.append(station["elevation"] / 1000.0)
-            lat_range = (max(lats) - min(lats)) * 111.0
-            long_range = (max(longs) - min(longs)) * 111.0
-            depth_range = max(depths) - min(depths)
-            maxdist = math.sqrt(lat_range ** 2 + long_range ** 2 +
-                                depth_range ** 2)
+                # station elevation is in meter and points upwards.
+                depths.append(-station["elevation"] / 1000.0)
+            maxdist = get_maximum_distance(to_cartesian(lats, longs, depths))
             values["MAXDIST"] = int(math.ceil(maxdist))
             self.log("MAXDIST for ph2dt.inp calculated to %i." %
                      values["MAXDIST"])
             self.forced_configuration_values["MAXDIST"] = values["MAXDIST"]
 
         ph2dt_inp_file = os.path.join(self.paths["input_files"], "ph2dt.inp")
-        if os.path.exists(ph2dt_inp_file):
-            self.log("ph2dt.inp input file already exists.")
+        if self._is_stage_current("ph2dt.inp", [
+                self.stage_fingerprints["stations"],
+                self.stage_fingerprints["events"],
+                self.forced_configuration_values], [ph2dt_inp_file]):
+            self.log("ph2dt.inp input file is up to date.")
             return
         # Determine the necessary variables. See the documentation of the
         # set_forced_configuration_value method for the reasoning.
@@ -565,24 +921,22 @@ class HypoDDRelocator(object):
         values["MAXOBS"] = 50
         if "MAXSEP" not in self.forced_configuration_values:
             # Set MAXSEP to the 10-percentile of all inter-event distances.
-            distances = []
-            for event_1 in self.events:
-                # Will produce one 0 distance pair but that should not matter.
-                for event_2 in self.events:
-                    lat_range = abs(event_1["origin_latitude"] -
-                                    event_2["origin_latitude"]) * 111.0
-                    long_range = abs(event_1["origin_longitude"] -
-                                     event_2["origin_longitude"]) * 111.0
-                    depth_range = abs(event_1["origin_depth"] -
-                                      event_2["origin_depth"])
-                    distances.append(math.sqrt(lat_range ** 2 +
-                                           long_range ** 2 + depth_range ** 2))
-            # Get the percentile value.
-            distances.sort()
-            maxsep = distances[int(math.floor(len(distances) * 0.10))]
+            # Large catalogs use an estimate from randomly sampled pairs. Use
+            # a fixed seed so the value does not change between runs.
+            points = to_cartesian(
+                self.events.get_column("origin_latitude"),
+                self.events.get_column("origin_longitude"),
+                self.events.get_column("origin_depth") / 1000.0)
+            maxsep, error = get_distance_percentile(points, 10.0,
+                                                    random_state=12345)
             values["MAXSEP"] = maxsep
-            self.log("MAXSEP for ph2dt.inp calculated to %f." %
-                     values["MAXSEP"])
+            if error:
+                self.log("MAXSEP for ph2dt.inp estimated to %f. The fraction "
+                         "of closer event pairs is 0.1 +/- %.4f." %
+                         (values["MAXSEP"], error))
+            else:
+                self.log("MAXSEP for ph2dt.inp calculated to %f." %
+                         values["MAXSEP"])
         # Use any potential forced values to overwrite the automatically set
         # ones.
         keys = ["MINWGHT", "MAXDIST", "MAXSEP", "MAXNGH", "MINLNK",
@@ -599,46 +953,198 @@ class HypoDDRelocator(object):
         ph2dt_string = ph2dt_string.format(**values)
         with open(ph2dt_inp_file, "w") as open_file:
             open_file.write(ph2dt_string)
+        self._finish_stage("ph2dt.inp")
         self.log("Writing ph2dt.inp successful")
 
+    def _get_compiler(self, logfile):
+        """
+        Returns a HypoDDCompiler logging to the open file logfile.
+        """
+        def logfunc(line):
+            logfile.write(line)
+            logfile.write(os.linesep)
+        return HypoDDCompiler(working_dir=self.working_dir,
+                              log_function=logfunc)
+
+    def _compile_ph2dt(self):
+        """
+        Makes sure the ph2dt binary exists if it is used. ph2dt does not
+        depend on the hypoDD array dimensions, so the default configuration
+        is compiled. _compile_hypodd() later replaces both binaries with a
+        build fitting the problem.
+        """
+        if self.ph2dt_engine != "binary" or \
+                os.path.exists(os.path.join(self.paths["bin"], "ph2dt")):
+            return
+        logfile = os.path.join(self.working_dir, "compilation.log")
+        self.log("Initating ph2dt compilation (logfile: %s)..." % logfile)
+        with open(logfile, "w") as fh:
+            compiler = self._get_compiler(fh)
+            compiler.configure(profile=self.compile_profile,
+                               jobs=self.compile_jobs)
+            compiler.make()
+
     def _compile_hypodd(self):
         """
-        Compiles HypoDD and ph2dt using
+        Compiles HypoDD and ph2dt with array dimensions fitting the input
+        files, see _get_hypodd_array_sizes().
         """
+        sizes = self._get_hypodd_array_sizes()
+        memory = estimate_static_memory(**sizes) / 1024.0 ** 2
+        self.log("HypoDD array dimensions: %s. Estimated memory usage: "
+                 "%.1f MB." % (", ".join("%s=%i" % (_i, sizes[_i])
+                                         for _i in sorted(sizes)), memory))
+        budget = self.hypodd_memory_budget
+        if budget is None:
+            budget = self._get_physical_memory()
+        if budget is not None and memory > budget:
+            msg = ("HypoDD would need about %.1f MB of memory but the "
+                   "memory budget is %.1f MB. Use setup_partitioning() to "
+                   "split the problem or raise the budget with "
+                   "setup_hypodd_arrays().") % (memory, budget)
+            raise HypoDDException(msg)
+
         logfile = os.path.join(self.working_dir, "compilation.log")
         self.log("Initating HypoDD compilation (logfile: %s)..." % logfile)
         with open(logfile, "w") as fh:
-            def logfunc(line):
-                fh.write(line)
-                fh.write(os.linesep)
-            compiler = HypoDDCompiler(working_dir=self.working_dir,
-                                      log_function=logfunc)
-            compiler.configure(MAXEVE=len(self.events) + 30,
-                               #MAXEVE0=len(self.events) + 30,
-                               MAXEVE0=200,
-                               MAXDATA=100000,
-                               MAXDATA0=60000,
-                               MAXCL=20,
-                               MAXSTA=len(self.stations) + 10)
+            compiler = self._get_compiler(fh)
+            compiler.configure(profile=self.compile_profile,
+                               jobs=self.compile_jobs, **sizes)
             compiler.make()
 
+    def _get_hypodd_array_sizes(self):
+        """
+        Determine the hypoDD array dimensions from the input files.
+
+        The numbers of events and observations are counted in event.sel,
+        dt.ct and dt.cc, the number of clusters is the number of groups of
+        events connected by pairs with at least OBSCC + OBSCT observations.
+        For a partitioned relocation the largest partition determines each
+        dimension. All values get the configured relative headroom. The SVD
+        arrays are reduced to the minimum as hypoDD.inp always selects LSQR.
+
+        The sizes are recorded in the stage cache and only determined again
+        if the events, dt.ct, dt.cc or the settings changed.
+
+        Returns a dictionary with the keyword arguments of
+        HypoDDCompiler.configure().
+        """
+        inputs = [self.stage_fingerprints.get(_i)
+                  for _i in ["events", "ph2dt", "dt.cc"]]
+        fingerprint = None
+        if None not in inputs:
+            fingerprint = get_fingerprint(
+                inputs, self.partitioning, self.hypodd_array_headroom,
+                _OBSCC, _OBSCT)
+        cached = self.stage_cache.get("hypodd array sizes")
+        if fingerprint is not None and cached is not None and \
+                cached["fingerprint"] == fingerprint:
+            return dict((str(_i), _j) for _i, _j in
+                        cached["sizes"].iteritems())
+        # Number of observations for every event pair.
+        pair_counts = {}
+        for filename in ["dt.ct", "dt.cc"]:
+            filename = os.path.join(self.paths["input_files"], filename)
+            if not os.path.exists(filename):
+                continue
+            for event_pair, block in self._read_dt_blocks(filename):
+                pair_counts[event_pair] = pair_counts.get(event_pair, 0) + \
+                    block.count("\n")
+        with open(os.path.join(self.paths["input_files"], "event.sel"),
+                  "r") as open_file:
+            event_ids = [int(_i.split()[-1]) for _i in open_file
+                         if _i.strip()]
+        with open(os.path.join(self.paths["input_files"], "station.sel"),
+                  "r") as open_file:
+            station_count = len([_i for _i in open_file if _i.strip()])
+
+        if self.partitioning is not None:
+            groups = [_i["events"] for _i in self._get_partitions()]
+        else:
+            groups = [set(event_ids)]
+        memberships = {}
+        for index, group in enumerate(groups):
+            for event in group:
+                memberships.setdefault(event, []).append(index)
+        data = [0] * len(groups)
+        # Union find of the linked events of every group.
+        parents = [{} for _ in groups]
+
+        def find(group_parents, event):
+            while group_parents.get(event, event) != event:
+                # Path halving.
+                group_parents[event] = group_parents.get(
+                    group_parents[event], group_parents[event])
+                event = group_parents[event]
+            return event
+
+        for (event_1, event_2), count in pair_counts.iteritems():
+            for index in memberships.get(event_1, []):
+                if event_2 not in groups[index]:
+                    continue
+                data[index] += count
+                if count < _OBSCC + _OBSCT:
+                    continue
+                root_1 = find(parents[index], event_1)
+                root_2 = find(parents[index], event_2)
+                if root_1 != root_2:
+                    parents[index][max(root_1, root_2)] = min(root_1, root_2)
+                    parents[index].setdefault(min(root_1, root_2),
+                                              min(root_1, root_2))
+        max_events = max(len(_i) for _i in groups) if groups else 0
+        max_data = max(data) if data else 0
+        max_clusters = max([len(set(find(_i, _j) for _j in _i))
+                            for _i in parents] or [0])
+
+        def with_headroom(value, minimum):
+            return max(int(math.ceil(value * (1.0 +
+                                              self.hypodd_array_headroom))),
+                       value + minimum)
+        sizes = {"MAXEVE": with_headroom(max_events, 30),
+                 "MAXDATA": with_headroom(max_data, 1000),
+                 "MAXEVE0": 2,
+                 "MAXDATA0": 1,
+                 "MAXLAY": 30,
+                 "MAXSTA": with_headroom(station_count, 10),
+                 "MAXCL": with_headroom(max_clusters, 10)}
+        if fingerprint is not None:
+            self.stage_cache.record("hypodd array sizes", {
+                "fingerprint": fingerprint, "sizes": sizes})
+        return sizes
+
+    def _get_physical_memory(self):
+        """
+        Returns the physical memory in MB or None if it cannot be determined.
+        """
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * \
+                os.sysconf("SC_PHYS_PAGES") / 1024.0 ** 2
+        except (AttributeError, ValueError, OSError):
+            return None
+
     def _run_hypodd(self):
         """
         Runs HypoDD with the necessary input files.
+
+        If partitioning has been set up with setup_partitioning(), every
+        partition is relocated in its own job directory and the results are
+        merged afterwards.
         """
         # Check if all the hypodd output files are already existant. If they
         # do, do not run it again.
         output_files = ["hypoDD.loc", "hypoDD.reloc", "hypoDD.sta",
                         "hypoDD.res", "hypoDD.src"]
-        files_exists = True
-        for o_file in output_files:
-            if os.path.exists(os.path.join(self.paths["output_files"],
-                                           o_file)):
-                continue
-            files_exists = False
-            break
-        if files_exists is True:
-            self.log("HypoDD output files already existant.")
+        if self._is_stage_current("hypodd", [
+                self.stage_fingerprints["ph2dt"],
+                self.stage_fingerprints["dt.cc"],
+                self.stage_fingerprints["hypoDD.inp"],
+                get_file_content_fingerprint(os.path.join(
+                    self.paths["bin"], "hypoDD.inc")),
+                self.compile_profile,
+                self.partitioning],
+                [os.path.join(self.paths["output_files"], _i)
+                 for _i in output_files]):
+            self.log("HypoDD output files are up to date.")
             return
         # Otherwise just run it.
         self.log("Running HypoDD...")
@@ -647,11 +1153,6 @@ class HypoDDRelocator(object):
         if not os.path.exists(hypodd_path):
             msg = "hypodd could not be found. Did the compilation succeed?"
             raise HypoDDException(msg)
-        # Create directory to run ph2dt in.
-        hypodd_dir = os.path.join(self.working_dir, "hypodd_temp_dir")
-        if os.path.exists(hypodd_dir):
-            shutil.rmtree(hypodd_dir)
-        os.makedirs(hypodd_dir)
         # Check if all necessary files are there.
         necessary_files = ["dt.cc", "dt.ct", "event.sel", "station.sel",
                            "hypoDD.inp"]
@@ -660,22 +1161,21 @@ class HypoDDRelocator(object):
                                                filename)):
                 msg = "{file} does not exists for HypoDD"
                 raise HypoDDException(msg.format(file=filename))
+        if self.partitioning is not None:
+            self._run_hypodd_partitioned(hypodd_path, output_files)
+            self._finish_stage("hypodd")
+            self.log("Partitioned HypoDD run was successful!")
+            return
+        # Create directory to run HypoDD in.
+        hypodd_dir = os.path.join(self.working_dir, "hypodd_temp_dir")
+        if os.path.exists(hypodd_dir):
+            shutil.rmtree(hypodd_dir)
+        os.makedirs(hypodd_dir)
         # Copy the files.
         for filename in necessary_files:
             shutil.copyfile(os.path.join(self.paths["input_files"], filename),
                             os.path.join(hypodd_dir, filename))
-        # Run ph2dt
-        retcode = subprocess.Popen([hypodd_path, "hypoDD.inp"],
-                                   cwd=hypodd_dir).wait()
-        if retcode != 0:
-            msg = "Problem running HypoDD."
-            raise HypoDDException(msg)
-        # Check if all are there.
-        for o_file in output_files:
-            if not os.path.exists(os.path.join(hypodd_dir, o_file)):
-                msg = "HypoDD output file {filename} was not created."
-                msg = msg.format(filename=o_file)
-                raise HypoDDException(msg)
+        self._run_hypodd_job(hypodd_path, hypodd_dir, output_files)
         # Copy the output files.
         for o_file in output_files:
             shutil.copyfile(os.path.join(hypodd_dir, o_file),
@@ -685,10 +1185,129 @@ class HypoDDRelocator(object):
         if os.path.exists(log_file):
             shutil.move(log_file,
                         os.path.join(self.working_dir, "hypoDD_log.txt"))
-        # Remove the temporary ph2dt running directory.
+        # Remove the temporary HypoDD running directory.
         shutil.rmtree(hypodd_dir)
+        self._finish_stage("hypodd")
         self.log("HypoDD run was successful!")
 
+    def _run_hypodd_job(self, hypodd_path, job_dir, output_files,
+                        stdout=None):
+        """
+        Run HypoDD in a directory containing all input files and check that
+        all output files have been created.
+
+        :param stdout: Open file the output of HypoDD is redirected to.
+            Defaults to the standard output.
+        """
+        retcode = subprocess.Popen([hypodd_path, "hypoDD.inp"],
+                                   cwd=job_dir, stdout=stdout).wait()
+        if retcode != 0:
+            msg = "Problem running HypoDD."
+            raise HypoDDException(msg)
+        # Check if all are there.
+        for o_file in output_files:
+            if not os.path.exists(os.path.join(job_dir, o_file)):
+                msg = "HypoDD output file {filename} was not created."
+                msg = msg.format(filename=o_file)
+                raise HypoDDException(msg)
+
+    def _get_partitions(self):
+        """
+        Assign all events to the partitions configured with
+        setup_partitioning(). See partitioning.assign_partitions().
+        """
+        event_ids = sorted(self.event_map[_i]
+                           for _i in self.events.get_event_ids())
+        positions = [self._event_index[_i] for _i in event_ids]
+        points = to_cartesian(
+            self.events.get_column("origin_latitude")[positions],
+            self.events.get_column("origin_longitude")[positions],
+            self.events.get_column("origin_depth")[positions] / 1000.0)
+        return assign_partitions(event_ids, points,
+                                 self.partitioning["tile_size"],
+                                 self.partitioning["halo"])
+
+    def _run_hypodd_partitioned(self, hypodd_path, output_files):
+        """
+        Split the catalog into spatial partitions, relocate every partition
+        in its own job directory and merge the results into the output
+        files. Up to n_workers HypoDD processes run at the same time.
+        """
+        partitions = self._get_partitions()
+        self.log("Split %i events into %i partitions." %
+                 (len(self.events), len(partitions)))
+
+        partition_dir = os.path.join(self.working_dir, "hypodd_partitions")
+        if os.path.exists(partition_dir):
+            shutil.rmtree(partition_dir)
+        log_dir = os.path.join(self.working_dir, "hypoDD_logs")
+        if os.path.exists(log_dir):
+            shutil.rmtree(log_dir)
+        os.makedirs(log_dir)
+
+        jobs = []
+        for partition in partitions:
+            name = "partition_%i_%i" % partition["key"]
+            job_dir = os.path.join(partition_dir, name)
+            os.makedirs(job_dir)
+            pair_count = write_partition_inputs(
+                self.paths["input_files"], job_dir, partition,
+                dt_files=["dt.cc", "dt.ct"], event_file="event.sel",
+                other_files=["station.sel", "hypoDD.inp"])
+            if len(partition["events"]) < 2 or not pair_count:
+                self.log("%s with %i core events has no event pairs and "
+                         "will not be relocated." %
+                         (name, len(partition["core"])), level="warning")
+                jobs.append(None)
+                continue
+            jobs.append((name, job_dir))
+
+        def run_job(job):
+            if job is None:
+                return None
+            name, job_dir = job
+            try:
+                with open(os.path.join(log_dir, name + ".stdout.txt"),
+                          "w") as stdout:
+                    self._run_hypodd_job(hypodd_path, job_dir, output_files,
+                                         stdout=stdout)
+            except HypoDDException as e:
+                return e
+            finally:
+                log_file = os.path.join(job_dir, "hypoDD.log")
+                if os.path.exists(log_file):
+                    shutil.move(log_file,
+                                os.path.join(log_dir, name + ".log.txt"))
+            return job_dir
+
+        # The work is done by the HypoDD processes, threads are sufficient to
+        # wait for them.
+        pool = ThreadPool(min(self.n_workers, max(len(jobs), 1)))
+        try:
+            results = pool.map(run_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        job_dirs = []
+        for job, result in zip(jobs, results):
+            if isinstance(result, HypoDDException):
+                self.log("HypoDD failed for %s: %s The events of this "
+                         "partition are only relocated if they are part of "
+                         "the halo of another partition." % (job[0], result),
+                         level="warning")
+                result = None
+            job_dirs.append(result)
+        if not any(job_dirs):
+            msg = "HypoDD failed for all partitions."
+            raise HypoDDException(msg)
+        relocated = merge_partition_outputs(partitions, job_dirs,
+                                            self.paths["output_files"])
+        self.log("Merged the results of %i partitions. %i of %i events have "
+                 "been relocated." % (len([_i for _i in job_dirs if _i]),
+                                      relocated, len(self.events)))
+        shutil.rmtree(partition_dir)
+
     def _run_ph2dt(self):
         """
         Runs ph2dt with the necessary input files.
@@ -696,19 +1315,18 @@ class HypoDDRelocator(object):
         # Check if all the ph2dt output files are already existant. If they do,
         # do not run it again.
         output_files = ["station.sel", "event.sel", "event.dat", "dt.ct"]
-        files_exists = True
-        for o_file in output_files:
-            if os.path.exists(os.path.join(self.paths["input_files"], o_file)):
-                continue
-            files_exists = False
-            break
-        if files_exists is True:
-            self.log("ph2dt output files already existant.")
+        if self._is_stage_current("ph2dt", [
+                self.stage_fingerprints["station.dat"],
+                self.stage_fingerprints["phase.dat"],
+                self.stage_fingerprints["ph2dt.inp"], self.ph2dt_engine],
+                [os.path.join(self.paths["input_files"], _i)
+                 for _i in output_files]):
+            self.log("ph2dt output files are up to date.")
             return
         # Otherwise just run it.
         self.log("Running ph2dt...")
         ph2dt_path = os.path.abspath(os.path.join(self.paths["bin"], "ph2dt"))
-        if not os.path.exists(ph2dt_path):
+        if self.ph2dt_engine == "binary" and not os.path.exists(ph2dt_path):
             msg = "ph2dt could not be found. Did the compilation succeed?"
             raise HypoDDException(msg)
         # Create directory to run ph2dt in.
@@ -733,18 +1351,38 @@ class HypoDDRelocator(object):
         shutil.copyfile(station_file, os.path.join(ph2dt_dir, "station.dat"))
         shutil.copyfile(phase_file, os.path.join(ph2dt_dir, "phase.dat"))
         shutil.copyfile(input_file, os.path.join(ph2dt_dir, "ph2dt.inp"))
-        # Run ph2dt
-        retcode = subprocess.Popen([ph2dt_path, "ph2dt.inp"],
-                                   cwd=ph2dt_dir).wait()
-        if retcode != 0:
-            msg = "Problem running ph2dt."
-            raise HypoDDException(msg)
+        previous_events = self._get_processed_events("ph2dt")
+        if self.ph2dt_engine == "native":
+            # In incremental mode only the new events need to be searched
+            # for neighbors.
+            events_to_link = None
+            if self.incremental and previous_events:
+                events_to_link = set(
+                    self.event_map[_i]
+                    for _i in self.events.get_event_ids()) - previous_events
+            stats = run_ph2dt(ph2dt_dir, events_to_link=events_to_link)
+            self.log("Selected {pairs} event pairs with {links} links for "
+                     "{events} events.".format(**stats))
+        else:
+            # Run ph2dt
+            retcode = subprocess.Popen([ph2dt_path, "ph2dt.inp"],
+                                       cwd=ph2dt_dir).wait()
+            if retcode != 0:
+                msg = "Problem running ph2dt."
+                raise HypoDDException(msg)
         # Check if all are there.
         for o_file in output_files:
             if not os.path.exists(os.path.join(ph2dt_dir, o_file)):
                 msg = "ph2dt output file {filename} does not exists."
                 msg = msg.format(filename=o_file)
                 raise HypoDDException(msg)
+        # In incremental mode the pairs of the previous run are kept and ph2dt
+        # only contributes the pairs involving new events.
+        dt_ct_file = os.path.join(self.paths["input_files"], "dt.ct")
+        if self.incremental and previous_events and \
+                os.path.exists(dt_ct_file):
+            self._merge_dt_ct(dt_ct_file, os.path.join(ph2dt_dir, "dt.ct"),
+                              previous_events)
         # Copy the output files.
         for o_file in output_files:
             shutil.copyfile(os.path.join(ph2dt_dir, o_file),
@@ -756,18 +1394,131 @@ class HypoDDRelocator(object):
                         os.path.join(self.working_dir, "ph2dt_log.txt"))
         # Remove the temporary ph2dt running directory.
         shutil.rmtree(ph2dt_dir)
+        self._set_processed_events("ph2dt")
+        self._finish_stage("ph2dt")
         self.log("ph2dt run successful.")
 
+    def _read_dt_blocks(self, filename):
+        """
+        Generator yielding ((event_id_1, event_id_2), block) for every event
+        pair in a dt.ct or dt.cc file. The block is the header line and all
+        observation lines of the pair as one string.
+        """
+        event_pair = None
+        lines = []
+        with open(filename, "r") as open_file:
+            for line in open_file:
+                line = line.rstrip("\r\n")
+                if line.strip().startswith("#"):
+                    if event_pair is not None:
+                        yield event_pair, "\n".join(lines)
+                    # Remove leading hashtag. dt.cc headers have an
+                    # additional origin time correction.
+                    event_pair = tuple(map(int, line.strip()[1:].split()[:2]))
+                    lines = []
+                if event_pair is not None and line.strip():
+                    lines.append(line)
+        if event_pair is not None:
+            yield event_pair, "\n".join(lines)
+
+    def _merge_dt_ct(self, old_dt_ct, new_dt_ct, previous_events):
+        """
+        Merge the pairs of a new ph2dt run into the dt.ct file of a previous
+        run. All previous pairs are kept and of the new ones only those with
+        at least one event not in previous_events are added. The result is
+        written to new_dt_ct.
+
+        Pairs are compared regardless of the order of their events, so a
+        pair is never added twice with its events swapped. The kept block
+        keeps its orientation.
+        """
+        blocks = []
+        known_pairs = set()
+        for event_pair, block in self._read_dt_blocks(old_dt_ct):
+            blocks.append(block)
+            known_pairs.add(tuple(sorted(event_pair)))
+        new_pairs = 0
+        for event_pair, block in self._read_dt_blocks(new_dt_ct):
+            if tuple(sorted(event_pair)) in known_pairs:
+                continue
+            if event_pair[0] in previous_events and \
+                    event_pair[1] in previous_events:
+                continue
+            blocks.append(block)
+            known_pairs.add(tuple(sorted(event_pair)))
+            new_pairs += 1
+        with open(new_dt_ct, "w") as open_file:
+            open_file.write("\n".join(blocks))
+            open_file.write("\n")
+        self.log("Incremental mode: Added %i event pairs to dt.ct." %
+                 new_pairs)
+
+    def _get_processed_events(self, stage):
+        """
+        Returns the set of event numbers the given stage has processed in the
+        last run or None if unknown. See _set_processed_events().
+        """
+        filename = os.path.join(self.paths["working_files"],
+                                "processed_events.json")
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "r") as open_file:
+            processed_events = json.load(open_file)
+        if stage not in processed_events:
+            return None
+        return set(processed_events[stage])
+
+    def _set_processed_events(self, stage):
+        """
+        Store the numbers of all current events as processed by the given
+        stage in working_dir/working_files/processed_events.json. Used by the
+        incremental mode to determine the new events.
+        """
+        filename = os.path.join(self.paths["working_files"],
+                                "processed_events.json")
+        processed_events = {}
+        if os.path.exists(filename):
+            with open(filename, "r") as open_file:
+                processed_events = json.load(open_file)
+        processed_events[stage] = sorted(
+            self.event_map[_i] for _i in self.events.get_event_ids())
+        with open(filename, "w") as open_file:
+            json.dump(processed_events, open_file)
+
     def _parse_waveform_files(self):
         """
         Read all specified waveform files and store information about them in
         working_dir/working_files/waveform_information.json
+
+        An interval index for fast lookups is stored alongside in
+        working_dir/working_files/waveform_index.json.
+
+        Only the headers of the files are read, distributed over n_workers
+        processes. The size, modification time and traces of every scanned
+        file are kept in working_dir/working_files/waveform_registry.json so
+        later runs only scan new or changed files.
+
+        The byte offsets and time spans of the records of all miniSEED files
+        are stored in working_dir/working_files/waveform_records, see
+        waveform_records.py.
         """
         serialized_waveform_information_file = \
             os.path.join(self.paths["working_files"],
                          "waveform_information.json")
+        serialized_waveform_index_file = \
+            os.path.join(self.paths["working_files"], "waveform_index.json")
+        waveform_files = self.waveform_source.get_inventory_files()
+        if waveform_files is None:
+            # Sources without files to scan only need their fingerprint.
+            self._is_stage_current(
+                "waveforms", [self.waveform_source.get_fingerprint()], [])
+            self._finish_stage("waveforms")
+            self.log("The waveform source needs no waveform parsing.")
+            return
         # If already parsed before, just read the serialized waveform file.
-        if os.path.exists(serialized_waveform_information_file):
+        if self._is_stage_current(
+                "waveforms", [self.waveform_source.get_fingerprint()],
+                [serialized_waveform_information_file]):
             self.log("Waveforms already parsed. Will load the serialized " +
                      "information.")
             with open(serialized_waveform_information_file, "r") as open_file:
@@ -777,31 +1528,88 @@ class HypoDDRelocator(object):
                     for item in value:
                         item["starttime"] = UTCDateTime(item["starttime"])
                         item["endtime"] = UTCDateTime(item["endtime"])
-                return
-        file_count = len(self.waveform_files)
-        self.log("Parsing %i waveform files..." % file_count)
-        self.waveform_information = {}
-        pbar = progressbar.ProgressBar(widgets=[progressbar.Percentage(),
-                    progressbar.Bar(), progressbar.ETA()], maxval=file_count)
-        pbar.start()
-        # Use a progress bar for displaying.
-        for _i, waveform_file in enumerate(self.waveform_files):
+            if os.path.exists(serialized_waveform_index_file):
+                self.waveform_index = WaveformIndex.load(
+                    serialized_waveform_index_file)
+                self.waveform_source.set_index(self.waveform_index)
+            else:
+                self._build_waveform_index(serialized_waveform_index_file)
+            return
+        registry_file = os.path.join(self.paths["working_files"],
+                                     "waveform_registry.json")
+        registry = {}
+        if os.path.exists(registry_file):
+            with open(registry_file, "r") as open_file:
+                registry = json.load(open_file)
+        # Determine all files that are new or changed since the last scan.
+        filenames = []
+        file_stats = {}
+        files_to_scan = []
+        for waveform_file in waveform_files:
+            filename = os.path.abspath(waveform_file)
+            if filename in file_stats:
+                continue
+            stat = os.stat(filename)
+            file_stats[filename] = (stat.st_size, stat.st_mtime)
+            filenames.append(filename)
+            entry = registry.get(filename)
+            if entry is None or entry["size"] != stat.st_size or \
+                    entry["mtime"] != stat.st_mtime:
+                files_to_scan.append(filename)
+        file_count = len(files_to_scan)
+        self.log("Parsing %i new or changed of %i waveform files..." %
+                 (file_count, len(filenames)))
+        if file_count:
+            pbar = progressbar.ProgressBar(widgets=[progressbar.Percentage(),
+                progressbar.Bar(), progressbar.ETA()], maxval=file_count)
+            pbar.start()
+            scan_args = [(_i, self.record_index.directory)
+                         for _i in files_to_scan]
+            pool = None
+            if self.n_workers > 1 and file_count > 1:
+                pool = multiprocessing.Pool(self.n_workers)
+                results = pool.imap(_scan_waveform_file, scan_args,
+                                    chunksize=_WAVEFORM_SCAN_CHUNKSIZE)
+            else:
+                results = itertools.imap(_scan_waveform_file, scan_args)
             try:
-                st = read(waveform_file)
-            except:
-                msg = "Waveform file %s could not be read." % waveform_file
-                self.log(msg, level="warning")
+                for _i, (filename, traces) in enumerate(results):
+                    if traces is None:
+                        msg = "Waveform file %s could not be read." % filename
+                        self.log(msg, level="warning")
+                    size, mtime = file_stats[filename]
+                    registry[filename] = {"size": size, "mtime": mtime,
+                                          "traces": traces}
+                    if (_i + 1) % _WAVEFORM_REGISTRY_SAVE_INTERVAL == 0:
+                        self._save_waveform_registry(registry_file, registry)
+                    pbar.update(_i + 1)
+                if pool is not None:
+                    pool.close()
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+            pbar.finish()
+        # Files that are no longer part of the waveform files are forgotten.
+        current_files = set(filenames)
+        for filename in registry.keys():
+            if filename not in current_files:
+                del registry[filename]
+                self.record_index.remove(filename)
+        self._save_waveform_registry(registry_file, registry)
+        self.waveform_information = {}
+        for filename in filenames:
+            traces = registry[filename]["traces"]
+            if traces is None:
                 continue
-            for trace in st:
+            for trace_id, starttime, endtime in traces:
                 # Append empty list if the id is not yet stored.
-                if trace.id not in self.waveform_information:
-                    self.waveform_information[trace.id] = []
-                self.waveform_information[trace.id].append(
-                    {"starttime": trace.stats.starttime,
-                     "endtime": trace.stats.endtime,
-                     "filename": os.path.abspath(waveform_file)})
-            pbar.update(_i + 1)
-        pbar.finish()
+                if trace_id not in self.waveform_information:
+                    self.waveform_information[trace_id] = []
+                self.waveform_information[trace_id].append(
+                    {"starttime": UTCDateTime(starttime),
+                     "endtime": UTCDateTime(endtime),
+                     "filename": filename})
         # Serialze it as a json object.
         waveform_information = copy.deepcopy(self.waveform_information)
         for value in waveform_information.values():
@@ -810,11 +1618,44 @@ class HypoDDRelocator(object):
                 item["endtime"] = str(item["endtime"])
         with open(serialized_waveform_information_file, "w") as open_file:
             json.dump(waveform_information, open_file)
+        self._build_waveform_index(serialized_waveform_index_file)
+        self._finish_stage("waveforms")
         self.log("Successfully parsed all waveform files.")
 
+    def _save_waveform_registry(self, filename, registry):
+        """
+        Serialize the waveform registry. The file is replaced atomically so
+        an interrupted write does not lose the previous scans.
+        """
+        with open(filename + ".tmp", "w") as open_file:
+            json.dump(registry, open_file)
+        os.rename(filename + ".tmp", filename)
+
+    def _build_waveform_index(self, filename):
+        """
+        Build the interval index of self.waveform_information used by
+        _find_data() and serialize it to filename.
+        """
+        self.waveform_index = WaveformIndex.from_waveform_information(
+            self.waveform_information)
+        self.waveform_index.save(filename)
+        self.waveform_source.set_index(self.waveform_index)
+
     def save_cross_correlation_results(self, filename):
-        with open(filename, "w") as open_file:
-            json.dump(self.cc_results, open_file)
+        """
+        Save the cross correlation results of this relocator.
+
+        If the filename ends with .sqlite, .sqlite3 or .db the results are
+        appended to a (possibly existing) compact SQLite store, see
+        cc_store.py. Otherwise they are written as one JSON file.
+        """
+        if is_store_filename(filename):
+            store = CrossCorrelationStore(filename)
+            store.add_results(self.cc_results)
+            store.close()
+        else:
+            with open(filename, "w") as open_file:
+                json.dump(self.cc_results, open_file)
         self.log("Successfully saved cross correlation results to file: %s." %
                  filename)
 
@@ -822,20 +1663,50 @@ class HypoDDRelocator(object):
         """
         Load previously computed and saved cross correlation results.
 
+        SQLite stores (files ending with .sqlite, .sqlite3 or .db) are not
+        read into memory. They are attached and queried for every pick pair
+        that is not in self.cc_results.
+
         :param purge: If True any already present cross correlation
             information will be discarded, if False loaded information will be
             used to update any currently present information.
         """
+        if is_store_filename(filename):
+            if purge:
+                self.cc_results = {}
+                self.cc_stores = []
+            # Results loaded last take precedence.
+            self.cc_stores.insert(0, CrossCorrelationStore(filename))
+            self.log("Attached cross correlation results store: %s." %
+                     filename)
+            return
         with open(filename, "r") as open_file:
             cc_ = json.load(open_file)
         if purge:
             self.cc_results = cc_
+            self.cc_stores = []
         else:
             for id1, items in cc_.iteritems():
                 self.cc_results.setdefault(id1, {}).update(items)
         self.log("Successfully loaded cross correlation results from file: "
                  "%s." % filename)
 
+    def _get_cc_result(self, pick_id_1, pick_id_2):
+        """
+        Look up the previously computed result for the ordered pick pair in
+        self.cc_results and all attached stores.
+
+        Returns a tuple (found, result).
+        """
+        items = self.cc_results.get(pick_id_1, {})
+        if pick_id_2 in items:
+            return True, items[pick_id_2]
+        for store in self.cc_stores:
+            cc_result = store.get(pick_id_1, pick_id_2)
+            if cc_result is not None:
+                return True, cc_result
+        return False, None
+
     def _cross_correlate_picks(self, outfile=None):
         """
         Reads the event pairs matched in dt.ct which are selected by ph2dt and
@@ -844,29 +1715,45 @@ class HypoDDRelocator(object):
         :param outfile: Filename of cross correlation results output.
         """
         ct_file_path = os.path.join(self.paths["input_files"], "dt.cc")
-        if os.path.exists(ct_file_path):
-            self.log("ct.cc input file already exists")
+        # The blocks of the event pairs only depend on the events, the
+        # waveforms and the parameters, not on the pairs selected by ph2dt.
+        inputs_fingerprint = get_fingerprint(
+            self.stage_fingerprints.get("events"),
+            self.stage_fingerprints.get("waveforms"))
+        if self._is_stage_current("dt.cc", [
+                self.stage_fingerprints.get("ph2dt"), inputs_fingerprint,
+                self.cc_param], [ct_file_path]):
+            self.log("dt.cc input file is up to date.")
             return
         # This is by far the lengthiest operation and will be broken up in
-        # smaller steps
-        cc_dir = os.path.join(self.paths["working_files"], "cc_files")
-        if not os.path.exists(cc_dir):
-            os.makedirs(cc_dir)
+        # smaller steps. Every finished event pair is appended to the journal.
+        # Blocks calculated with different parameters are discarded.
+        journal = CrossCorrelationJournal(os.path.join(
+            self.paths["working_files"], "dt.cc.journal"),
+            fingerprint=get_fingerprint(self.cc_param))
+        # Changed events or waveforms invalidate all blocks and snippets. In
+        # incremental mode they are kept as the new events and waveforms do
+        # not influence the existing pairs.
+        previous_inputs = self.stage_cache.get("dt.cc inputs")
+        if not self.incremental and previous_inputs is not None and \
+                previous_inputs != inputs_fingerprint:
+            self.log("Events or waveforms changed. Discarding all previous "
+                     "cross correlations.")
+            journal.clear()
+            WaveformSnippets.delete(self._get_snippet_filename())
+        self.stage_cache.record("dt.cc inputs", inputs_fingerprint)
         # Read the dt.ct file and get all event pairs.
         dt_ct_path = os.path.join(self.paths["input_files"], "dt.ct")
         if not os.path.exists(dt_ct_path):
             msg = "dt.ct does not exists. Did ph2dt run successfully?"
             raise HypoDDException(msg)
-        event_id_pairs = []
-        with open(dt_ct_path, "r") as open_file:
-            for line in open_file:
-                line = line.strip()
-                if not line.startswith("#"):
-                    continue
-                # Remove leading hashtag.
-                line = line[1:]
-                event_id_1, event_id_2 = map(int, line.split())
-                event_id_pairs.append((event_id_1, event_id_2))
+        event_id_pairs = [event_pair for event_pair, _ in
+                          self._read_dt_blocks(dt_ct_path)]
+        # In incremental mode only pairs involving at least one event that
+        # was not cross correlated before are calculated.
+        previous_events = None
+        if self.incremental:
+            previous_events = self._get_processed_events("dt.cc")
         # Now for every event pair, calculate cross correlated differential
         # travel times for every pick.
         # Setup a progress bar.
@@ -876,258 +1763,594 @@ class HypoDDRelocator(object):
             progressbar.Bar(), progressbar.ETA()], maxval=len(event_id_pairs))
         pbar_progress = 1
         pbar.start()
-        for event_1, event_2 in event_id_pairs:
-            # Update the progress bar.
-            pbar.update(pbar_progress)
-            pbar_progress += 1
-            # filename for event_pair
-            event_pair_file = os.path.join(cc_dir, "%i_%i.txt" %
-                                           (event_1, event_2))
-            if os.path.exists(event_pair_file):
+        # Only the event pairs not yet in the journal still need to be
+        # calculated. This allows interrupted runs to be resumed.
+        open_event_id_pairs = []
+        skipped_pairs = 0
+        for event_pair in event_id_pairs:
+            if event_pair in journal:
+                pbar.update(pbar_progress)
+                pbar_progress += 1
+                continue
+            if previous_events and event_pair[0] in previous_events and \
+                    event_pair[1] in previous_events:
+                skipped_pairs += 1
+                pbar.update(pbar_progress)
+                pbar_progress += 1
+                continue
+            open_event_id_pairs.append(event_pair)
+        # Cut and filter the waveform snippets of all picks once. The pairs
+        # only work on these.
+        self._extract_pick_snippets(open_event_id_pairs)
+        # The results of this run are only kept if they are saved
+        # afterwards. Otherwise they are dropped once the blocks of their
+        # event pairs are in the journal.
+        new_cc_results = {}
+        pool = None
+        if self.cc_param["cc_engine"] != "fft" and self.n_workers > 1 and \
+                len(open_event_id_pairs) > 1:
+            # The worker processes are forked and thus inherit the relocator
+            # and all its state. Only the results are sent back.
+            global _CC_WORKER_RELOCATOR
+            _CC_WORKER_RELOCATOR = self
+            pool = multiprocessing.Pool(self.n_workers)
+        try:
+            for _i in xrange(0, len(open_event_id_pairs),
+                             _CC_EVENT_PAIR_CHUNKSIZE):
+                chunk = open_event_id_pairs[
+                    _i:_i + _CC_EVENT_PAIR_CHUNKSIZE]
+                if not outfile:
+                    new_cc_results = {}
+                if self.cc_param["cc_engine"] == "fft":
+                    # The batched engine calculates all pick pairs of the
+                    # chunk at once.
+                    self._cross_correlate_picks_batched(chunk,
+                                                        new_cc_results)
+                    for event_pair in chunk:
+                        self._journal_event_pair(journal, event_pair,
+                                                 new_cc_results)
+                else:
+                    self._cross_correlate_picks_scheduled(
+                        chunk, new_cc_results, journal, pool)
+                pbar_progress += len(chunk)
+                pbar.update(pbar_progress - 1)
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+                _CC_WORKER_RELOCATOR = None
+        pbar.finish()
+        if skipped_pairs:
+            self.log("Incremental mode: Skipped %i new pairs of previously "
+                     "cross correlated events." % skipped_pairs)
+        self.log("Finished calculating cross correlations.")
+        if outfile:
+            for id1, items in new_cc_results.iteritems():
+                self.cc_results.setdefault(id1, {}).update(items)
+            self.save_cross_correlation_results(outfile)
+        # Assemble final file. Always use the order of the event pairs in dt.ct
+        # so the result does not depend on how the pairs have been processed.
+        journal.write_dt_cc(ct_file_path, event_id_pairs)
+        journal.close()
+        self._set_processed_events("dt.cc")
+        self._finish_stage("dt.cc")
+
+    def _get_pick_weight_dict(self, phase):
+        """
+        Returns the channel weighting dictionary for the given phase.
+        """
+        if phase == "P":
+            return self.cc_param["cc_p_phase_weighting"]
+        elif phase == "S":
+            return self.cc_param["cc_s_phase_weighting"]
+        return {}
+
+    def _extract_pick_snippets(self, event_id_pairs):
+        """
+        Cut, detrend and filter the waveform snippets for all picks of the
+        given event pairs once and store them in self.snippets.
+
+        The snippets are serialized to working_dir/working_files/snippets.npy
+        and snippets.json so they are only extracted once.
+        """
+        snippet_file = self._get_snippet_filename()
+        parameters = dict((key, self.cc_param[key]) for key in [
+            "cc_time_before", "cc_time_after", "cc_maxlag",
+            "cc_filter_min_freq", "cc_filter_max_freq"])
+        parameters["padding_periods"] = SNIPPET_PADDING_PERIODS
+        # The snippets are memory mapped so the cross correlation workers
+        # share them instead of each holding a copy.
+        self.snippets = WaveformSnippets.load(snippet_file, parameters,
+                                              memory_map=True)
+        # Collect all picks that still need to be processed. Every event is
+        # only looked at once.
+        picks = {}
+        for event_number in set(itertools.chain.from_iterable(
+                event_id_pairs)):
+            position = self._event_index.get(event_number)
+            if position is None:
+                continue
+            for index in self.events.get_pick_indices(position):
+                pick_id = self.events.get_pick_id(index)
+                if pick_id in self.snippets or pick_id in picks:
+                    continue
+                picks[pick_id] = self.events.get_pick_at(index)
+        if not picks:
+            return
+        self.log("Extracting waveform snippets for %i picks..." % len(picks))
+        pbar = progressbar.ProgressBar(widgets=[progressbar.Percentage(),
+            progressbar.Bar(), progressbar.ETA()], maxval=len(picks))
+        pbar.start()
+        # Process the picks station by station and day by day so every
+        # waveform file is only read once while it is in the cache.
+        for _i, pick in enumerate(sort_picks(picks.values())):
+            self._extract_snippets_for_pick(pick)
+            pbar.update(_i + 1)
+        pbar.finish()
+        self.snippets.save(snippet_file)
+        # Replace the freshly cut snippets with the memory mapped ones.
+        self.snippets = WaveformSnippets.load(snippet_file, parameters,
+                                              memory_map=True)
+        statistics = self.waveform_cache.get_statistics()
+        self.waveform_cache.clear()
+        self.record_index.clear()
+        self.log("Extracted waveform snippets. Waveform cache: %i hits, %i "
+                 "misses, %i evictions." % (statistics["hits"],
+                                            statistics["misses"],
+                                            statistics["evictions"]))
+        if self.record_index.reads:
+            self.log("Read %i record ranges with %.1f kB on average." % (
+                self.record_index.reads,
+                self.record_index.bytes_read / 1024.0 /
+                self.record_index.reads))
+
+    def _get_snippet_filename(self):
+        """
+        Returns the base filename of the snippet cache.
+        """
+        return os.path.join(self.paths["working_files"], "snippets")
+
+    def _extract_snippets_for_pick(self, pick):
+        """
+        Cut the snippets of all weighted channels for a single pick.
+        """
+        station_id = pick["station_id"]
+        data_files = self._find_data(station_id,
+                                     pick["pick_time"] -
+                                     self.cc_param["cc_time_before"],
+                                     self.cc_param["cc_time_before"] +
+                                     self.cc_param["cc_time_after"])
+        if data_files is False:
+            self.snippets.add_missing_pick(pick["id"])
+            return
+        starttime, endtime = get_snippet_window(pick["pick_time"],
+                                                self.cc_param)
+        stream = Stream()
+        for key in data_files:
+            stream += self._read_waveform_data(key, starttime, endtime)
+        max_starttime = pick["pick_time"] - self.cc_param["cc_time_before"]
+        min_endtime = pick["pick_time"] + self.cc_param["cc_time_after"]
+        network, station = station_id.split(".")
+        pick_weight_dict = self._get_pick_weight_dict(pick["phase"])
+        for channel, channel_weight in pick_weight_dict.iteritems():
+            if channel_weight == 0.0:
+                continue
+            # Attempt to find the correct trace.
+            st = stream.select(network=network, station=station,
+                               channel="*%s" % channel)
+            for trace in list(st):
+                if trace.stats.starttime > max_starttime or \
+                   trace.stats.endtime < min_endtime:
+                    st.remove(trace)
+            # cleanup merges, in case the event is included in multiple
+            # traces (happens for events with very close origin times)
+            st.merge(-1)
+            if len(st) > 1:
+                msg = "More than one matching trace found for {pick}"
+                self.snippets.add_error(pick["id"], channel, msg)
+                continue
+            elif len(st) == 0:
+                msg = "No matching trace found for {pick}"
+                self.snippets.add_error(pick["id"], channel, msg)
+                continue
+            snippet = cut_snippet(st[0], starttime, endtime,
+                                  self.cc_param["cc_filter_min_freq"],
+                                  self.cc_param["cc_filter_max_freq"])
+            self.snippets.add(pick["id"], channel, snippet)
+
+    def _read_waveform_data(self, key, starttime, endtime):
+        """
+        Returns a stream with the data of a key found by the waveform source
+        which contains at least the span from starttime to endtime.
+
+        Waveform files are read through the record index if possible and
+        through the waveform cache otherwise. Files of sources without a
+        scan are indexed on first use.
+        """
+        source = self.waveform_source
+        if not source.returns_files:
+            return source.read(key, starttime, endtime)
+        # Only decode the records around the pick if possible.
+        stream = self.record_index.read(
+            key, starttime, endtime,
+            scan=source.get_inventory_files() is None)
+        if stream is None:
+            stream = self.waveform_cache.get(key)
+        return stream
+
+    def _get_open_pick_pairs(self, event_id_pairs, cc_results):
+        """
+        Returns the (event_pair, pick_1, pick_2) work items of all pick pairs
+        of the given event pairs without a known cross correlation result,
+        neither in cc_results nor in the previously computed results.
+        """
+        events = self.events
+
+        def get_open_pick_pairs(event_1, event_2):
+            pick_pairs = []
+            for pick_1, pick_2 in self._get_pick_pairs(event_1, event_2) or []:
+                pick_id_1 = events.get_pick_id(pick_1)
+                pick_id_2 = events.get_pick_id(pick_2)
+                if self._get_new_cc_result(cc_results, pick_id_1,
+                                           pick_id_2)[0] or \
+                        self._get_cc_result(pick_id_1, pick_id_2)[0] or \
+                        self._get_cc_result(pick_id_2, pick_id_1)[0]:
+                    continue
+                pick_pairs.append((events.get_pick_at(pick_1),
+                                   events.get_pick_at(pick_2)))
+            return pick_pairs
+        return expand_pick_pairs(event_id_pairs, get_open_pick_pairs)
+
+    def _journal_event_pair(self, journal, event_pair, cc_results):
+        """
+        Write the dt.cc block of an event pair to the journal once all of
+        its pick pairs are cross correlated.
+
+        :param cc_results: The results calculated in this run.
+        """
+        current_pair_strings = self._cross_correlate_event_pair(
+            event_pair[0], event_pair[1], cc_results)
+        if current_pair_strings is None:
+            return
+        journal.append(event_pair, "\n".join(current_pair_strings))
+
+    def _cross_correlate_picks_scheduled(self, event_id_pairs, cc_results,
+                                         journal, pool=None):
+        """
+        Calculate the cross correlations of all not yet known pick pairs of
+        the given event pairs pick pair by pick pair, store them in
+        cc_results and journal the dt.cc block of every event pair as soon as
+        all of its pick pairs are done.
+
+        The pick pairs are grouped by station and day, see cc_schedule.py.
+        If a process pool is given, the groups are distributed over it.
+        """
+        work_items = self._get_open_pick_pairs(event_id_pairs, cc_results)
+        # Number of open pick pairs per event pair.
+        pending = {}
+        for event_pair, _, _ in work_items:
+            pending[event_pair] = pending.get(event_pair, 0) + 1
+        for event_pair in event_id_pairs:
+            if tuple(event_pair) not in pending:
+                self._journal_event_pair(journal, tuple(event_pair),
+                                         cc_results)
+        groups = group_pick_pairs(work_items)
+        if pool is not None:
+            results = pool.imap(_cross_correlate_pick_pairs_worker, groups,
+                                chunksize=_CC_WORKER_CHUNKSIZE)
+        else:
+            results = itertools.imap(self._cross_correlate_pick_pairs,
+                                     groups)
+        for event_pairs, group_results in results:
+            if group_results is not cc_results:
+                for id1, items in group_results.iteritems():
+                    cc_results.setdefault(id1, {}).update(items)
+            for event_pair in event_pairs:
+                pending[event_pair] -= 1
+                if not pending[event_pair]:
+                    self._journal_event_pair(journal, event_pair,
+                                             cc_results)
+
+    def _cross_correlate_pick_pairs(self, work_items):
+        """
+        Serial counterpart of _cross_correlate_pick_pairs_worker().
+        """
+        cc_results = {}
+        for _, pick_1, pick_2 in work_items:
+            self._cross_correlate_pick_pair(pick_1, pick_2, cc_results)
+        return [_i[0] for _i in work_items], cc_results
+
+    def _cross_correlate_picks_batched(self, event_id_pairs, cc_results):
+        """
+        Calculate the cross correlations of all not yet known pick pairs of
+        the given event pairs with the batched FFT engine and store them in
+        cc_results.
+
+        The pick pairs are grouped by trace id, sampling rate, phase and
+        channel and every group is correlated at once. The channels are
+        combined with the same weighting as in the pair loop.
+        """
+        pick_pairs = [_i[1:] for _i in
+                      self._get_open_pick_pairs(event_id_pairs, cc_results)
+                      if self.snippets.has_data(_i[1]["id"]) and
+                      self.snippets.has_data(_i[2]["id"])]
+        if not pick_pairs:
+            return
+        # Group all pick pairs with usable snippets.
+        traces = {}
+        groups = {}
+        for pick_1, pick_2 in pick_pairs:
+            pick_weight_dict = self._get_pick_weight_dict(pick_1["phase"])
+            for channel, channel_weight in pick_weight_dict.iteritems():
+                if channel_weight == 0.0:
+                    continue
+                for pick in (pick_1, pick_2):
+                    if (pick["id"], channel) not in traces:
+                        traces[(pick["id"], channel)] = self.snippets.get(
+                            pick["id"], channel)
+                trace_1 = traces[(pick_1["id"], channel)]
+                trace_2 = traces[(pick_2["id"], channel)]
+                if not isinstance(trace_1, Trace) or \
+                        not isinstance(trace_2, Trace):
+                    continue
+                if trace_1.id != trace_2.id or trace_1.stats.sampling_rate != \
+                        trace_2.stats.sampling_rate:
+                    continue
+                key = (trace_1.id, trace_1.stats.sampling_rate,
+                       pick_1["phase"], channel)
+                groups.setdefault(key, []).append(
+                    (pick_1, pick_2, channel_weight))
+        all_cross_correlations = {}
+        for key, group in groups.iteritems():
+            channel = key[3]
+            # Stack every snippet of the group only once.
+            pick_index = {}
+            snippets = []
+            pick_times = []
+            pairs = []
+            for pick_1, pick_2, _ in group:
+                for pick in (pick_1, pick_2):
+                    if pick["id"] not in pick_index:
+                        pick_index[pick["id"]] = len(snippets)
+                        snippets.append(traces[(pick["id"], channel)])
+                        pick_times.append(pick["pick_time"])
+                pairs.append((pick_index[pick_1["id"]],
+                              pick_index[pick_2["id"]]))
+            pick2_corrs, cross_corr_coeffs, valid = xcorr_pick_pairs(
+                snippets, pick_times, pairs,
+                t_before=self.cc_param["cc_time_before"],
+                t_after=self.cc_param["cc_time_after"],
+                cc_maxlag=self.cc_param["cc_maxlag"])
+            for _i, (pick_1, pick_2, channel_weight) in enumerate(group):
+                if not valid[_i]:
+                    continue
+                all_cross_correlations.setdefault(
+                    (pick_1["id"], pick_2["id"]), []).append(
+                    (float(pick2_corrs[_i]), float(cross_corr_coeffs[_i]),
+                     channel_weight))
+        # Now combine all of them based upon their weight.
+        for pick_1, pick_2 in pick_pairs:
+            cross_correlations = all_cross_correlations.get(
+                (pick_1["id"], pick_2["id"]))
+            if not cross_correlations:
+                cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = \
+                    "No cross correlations performed"
                 continue
-            current_pair_strings = []
-            # Find the corresponding events.
-            event_id_1 = self.event_map[event_1]
-            event_id_2 = self.event_map[event_2]
-            event_1_dict = event_2_dict = None
-            for event in self.events:
-                if event["event_id"] == event_id_1:
-                    event_1_dict = event
-                if event["event_id"] == event_id_2:
-                    event_2_dict = event
-                if event_1_dict is not None and event_2_dict is not None:
-                    break
-            # Some safety measures to ensure the script keeps running even if
-            # something unexpected happens.
-            if event_1_dict is None:
-                msg = "Event %s not be found. This is likely a bug." % \
-                    event_id_1
+            pick2_corr = sum([_i[0] * _i[2] for _i in cross_correlations])
+            cross_corr_coeff = sum([_i[1] * _i[2] for _i in
+                                    cross_correlations])
+            weight = sum([_i[2] for _i in cross_correlations])
+            cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = \
+                (pick2_corr / weight, cross_corr_coeff / weight)
+
+    def _cross_correlate_pick_pair(self, pick_1, pick_2, cc_results):
+        """
+        Calculate the weighted time correction and cross correlation
+        coefficient of the second pick relative to the first one.
+
+        :param pick_1: The first pick.
+        :param pick_2: The pick of the same station and phase of the second
+            event.
+        :param cc_results: Dictionary the result or error message is stored
+            in.
+
+        Returns a (pick2_corr, cross_corr_coeff) tuple or None if the pick
+        pair could not be cross correlated.
+        """
+        # If any pick has no data, skip this pick pair.
+        if not self.snippets.has_data(pick_1["id"]) or \
+                not self.snippets.has_data(pick_2["id"]):
+            return None
+        pick_weight_dict = self._get_pick_weight_dict(pick_1["phase"])
+        all_cross_correlations = []
+        # Loop over all picks and weight them.
+        for channel, channel_weight in pick_weight_dict.iteritems():
+            if channel_weight == 0.0:
+                continue
+            # Get the pre-processed snippets of both picks.
+            trace_1 = self.snippets.get(pick_1["id"], channel)
+            if isinstance(trace_1, basestring):
+                msg = trace_1
+                self.log(msg.format(pick=str(pick_1)), level="warning")
+                cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
+                continue
+            trace_2 = self.snippets.get(pick_2["id"], channel)
+            if isinstance(trace_2, basestring):
+                msg = trace_2
+                self.log(msg.format(pick=str(pick_2)), level="warning")
+                cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
+                continue
+
+            if trace_1.id != trace_2.id:
+                msg = "Non matching ids during cross correlation. "
+                msg += "(%s and %s)" % (trace_1.id, trace_2.id)
                 self.log(msg, level="warning")
+                cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
                 continue
-            if event_2_dict is None:
-                msg = "Event %s not be found. This is likely a bug." % \
-                    event_id_2
+            if trace_1.stats.sampling_rate != \
+                    trace_2.stats.sampling_rate:
+                msg = ("Non matching sampling rates during cross "
+                       "correlation. ")
+                msg += "(%s and %s)" % (trace_1.id, trace_2.id)
                 self.log(msg, level="warning")
+                cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
                 continue
-            # Write the leading string in the dt.cc file.
-            current_pair_strings.append(
-                "# {event_id_1}  {event_id_2} 0.0".format(
-                    event_id_1=event_1, event_id_2=event_2))
-            # Now try to cross-correlate as many picks as possible.
-            for pick_1 in event_1_dict["picks"]:
-                pick_1_station_id = pick_1["station_id"]
-                pick_1_phase = pick_1["phase"]
-                # Try to find the corresponding pick for the second event.
-                pick_2 = None
-                for pick in event_2_dict["picks"]:
-                    if pick["station_id"] == pick_1_station_id and \
-                            pick["phase"] == pick_1_phase:
-                        pick_2 = pick
-                        break
-                # No corresponding pick could be found.
-                if pick_2 is None:
-                    continue
-                # we got some previously computed information..
-                if pick_2['id'] in self.cc_results.get(pick_1['id'], {}):
-                    cc_result = self.cc_results.get(pick_1['id'], {})[pick_2['id']]
-                    # .. and it's actual data
-                    if isinstance(cc_result, (list, tuple)) and len(cc_result) == 2:
-                        pick2_corr, cross_corr_coeff = cc_result
-                    # .. but it's only an error message or None for a silent skip
-                    else:
-                        self.log("Skipping pick pair due to error message in preloaded cross correlation result: %s" % str(cc_result))
-                        continue
-                # we got some previously computed information (but picks were order other way round)..
-                elif pick_1['id'] in self.cc_results.get(pick_2['id'], {}):
-                    cc_result = self.cc_results.get(pick_2['id'], {})[pick_1['id']]
-                    # .. and it's actual data
-                    if isinstance(cc_result, (list, tuple)) and len(cc_result) == 2:
-                        # revert time correction for other pick order!
-                        pick2_corr, cross_corr_coeff = -cc_result[0], cc_result[1]
-                    # .. but it's only an error message or None for a silent skip
-                    else:
-                        self.log("Skipping pick pair due to error message in preloaded cross correlation result: %s" % str(cc_result))
+
+            # Call the cross correlation function.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                try:
+                    pick2_corr, cross_corr_coeff = \
+                        xcorr_pick_correction(
+                            pick_1["pick_time"], trace_1,
+                            pick_2["pick_time"], trace_2,
+                            t_before=self.cc_param["cc_time_before"],
+                            t_after=self.cc_param["cc_time_after"],
+                            cc_maxlag=self.cc_param["cc_maxlag"],
+                            plot=False)
+                except Exception, err:
+                    # XXX: Maybe maxlag is too short?
+                    if not err.message.startswith("Less than 3"):
+                        msg = "Error during cross correlating: "
+                        msg += err.message
+                        self.log(msg, level="error")
+                        cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
                         continue
+            all_cross_correlations.append((pick2_corr, cross_corr_coeff,
+                                           channel_weight))
+        if len(all_cross_correlations) == 0:
+            cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = "No cross correlations performed"
+            return None
+        # Now combine all of them based upon their weight.
+        pick2_corr = sum([_i[0] * _i[2] for _i in all_cross_correlations])
+        cross_corr_coeff = sum([_i[1] * _i[2] for _i in
+                                all_cross_correlations])
+        weight = sum([_i[2] for _i in all_cross_correlations])
+        pick2_corr /= weight
+        cross_corr_coeff /= weight
+        cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = (pick2_corr, cross_corr_coeff)
+        return pick2_corr, cross_corr_coeff
+
+    def _get_new_cc_result(self, cc_results, pick_id_1, pick_id_2):
+        """
+        Look up the result of a pick pair calculated in this run in either
+        pick order.
+
+        Returns a tuple of a boolean whether the result was found and the
+        result with the time correction relative to the first pick.
+        """
+        if pick_id_2 in cc_results.get(pick_id_1, {}):
+            return True, cc_results[pick_id_1][pick_id_2]
+        if pick_id_1 in cc_results.get(pick_id_2, {}):
+            cc_result = cc_results[pick_id_2][pick_id_1]
+            if isinstance(cc_result, (list, tuple)):
+                cc_result = (-cc_result[0], cc_result[1])
+            return True, cc_result
+        return False, None
+
+    def _cross_correlate_event_pair(self, event_1, event_2, cc_results):
+        """
+        Calculate the cross correlated differential travel times for all
+        common picks of one event pair.
+
+        :param event_1: Mapped (numeric) id of the first event.
+        :param event_2: Mapped (numeric) id of the second event.
+        :param cc_results: Dictionary with the pick pair results of this run.
+            New results are stored in it. Previously computed results are
+            looked up in self.cc_results and the stores.
+
+        Returns the list of lines of the dt.cc block of this event pair or
+        None if the event pair could not be processed.
+        """
+        current_pair_strings = []
+        # Find the corresponding events and their common picks. Only the
+        # columns of the event table are read, pick dictionaries are only
+        # created for pick pairs that still need to be cross correlated.
+        pick_pairs = self._get_pick_pairs(event_1, event_2)
+        # Some safety measures to ensure the script keeps running even if
+        # something unexpected happens.
+        if pick_pairs is None:
+            for event_number in (event_1, event_2):
+                if event_number not in self._event_index:
+                    msg = "Event %s not be found. This is likely a bug." % \
+                        self.event_map.get(event_number, event_number)
+                    self.log(msg, level="warning")
+                    return None
+        events = self.events
+        # Write the leading string in the dt.cc file.
+        current_pair_strings.append(
+            "# {event_id_1}  {event_id_2} 0.0".format(
+                event_id_1=event_1, event_id_2=event_2))
+        # Now try to cross-correlate as many picks as possible.
+        for pick_1, pick_2 in pick_pairs:
+            pick_id_1 = events.get_pick_id(pick_1)
+            pick_id_2 = events.get_pick_id(pick_2)
+            # Results of this run have precedence.
+            found_new, cc_result = self._get_new_cc_result(
+                cc_results, pick_id_1, pick_id_2)
+            found = found_reversed = False
+            if not found_new:
+                # we got some previously computed information..
+                found, cc_result = self._get_cc_result(pick_id_1, pick_id_2)
+                if not found:
+                    found_reversed, cc_result = self._get_cc_result(
+                        pick_id_2, pick_id_1)
+            if found_new:
+                # Errors of this run were already logged when they occurred.
+                if not isinstance(cc_result, (list, tuple)):
+                    continue
+                pick2_corr, cross_corr_coeff = cc_result
+            elif found:
+                # .. and it's actual data
+                if isinstance(cc_result, (list, tuple)) and len(cc_result) == 2:
+                    pick2_corr, cross_corr_coeff = cc_result
+                # .. but it's only an error message or None for a silent skip
                 else:
-                    station_id = pick_1["station_id"]
-                    # Try to find data for both picks.
-                    data_files_1 = self._find_data(station_id,
-                                               pick_1["pick_time"] -
-                                               self.cc_param["cc_time_before"],
-                                               self.cc_param["cc_time_before"] +
-                                               self.cc_param["cc_time_after"])
-                    data_files_2 = self._find_data(station_id,
-                                               pick_2["pick_time"] -
-                                               self.cc_param["cc_time_before"],
-                                               self.cc_param["cc_time_before"] +
-                                               self.cc_param["cc_time_after"])
-                    # If any pick has no data, skip this pick pair.
-                    if data_files_1 is False or data_files_2 is False:
-                        continue
-                    # Read all files.
-                    stream_1 = Stream()
-                    stream_2 = Stream()
-                    for waveform_file in data_files_1:
-                        stream_1 += read(waveform_file)
-                    for waveform_file in data_files_2:
-                        stream_2 += read(waveform_file)
-                    # Get the corresponing pick weighting dictionary.
-                    if pick_1_phase == "P":
-                        pick_weight_dict = self.cc_param[
-                            "cc_p_phase_weighting"]
-                    elif pick_1_phase == "S":
-                        pick_weight_dict = self.cc_param[
-                            "cc_s_phase_weighting"]
-                    all_cross_correlations = []
-                    # Loop over all picks and weight them.
-                    for channel, channel_weight in pick_weight_dict.iteritems():
-                        if channel_weight == 0.0:
-                            continue
-                        # Filter the files to obtain the correct trace.
-                        network, station = station_id.split(".")
-                        st_1 = stream_1.select(network=network, station=station,
-                                               channel="*%s" % channel)
-                        st_2 = stream_2.select(network=network, station=station,
-                                               channel="*%s" % channel)
-                        max_starttime_st_1 = pick_1["pick_time"] - \
-                            self.cc_param["cc_time_before"]
-                        min_endtime_st_1 = pick_1["pick_time"] + \
-                            self.cc_param["cc_time_after"]
-                        max_starttime_st_2 = pick_2["pick_time"] - \
-                            self.cc_param["cc_time_before"]
-                        min_endtime_st_2 = pick_2["pick_time"] + \
-                            self.cc_param["cc_time_after"]
-                        # Attempt to find the correct trace.
-                        for trace in st_1:
-                            if trace.stats.starttime > max_starttime_st_1 or \
-                               trace.stats.endtime < min_endtime_st_1:
-                                st_1.remove(trace)
-                        for trace in st_2:
-                            if trace.stats.starttime > max_starttime_st_2 or \
-                               trace.stats.endtime < min_endtime_st_2:
-                                st_2.remove(trace)
-
-                        # cleanup merges, in case the event is included in
-                        # multiple traces (happens for events with very close
-                        # origin times)
-                        st_1.merge(-1)
-                        st_2.merge(-1)
-
-                        if len(st_1) > 1:
-                            msg = "More than one matching trace found for {pick}"
-                            self.log(msg.format(pick=str(pick_1)), level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        elif len(st_1) == 0:
-                            msg = "No matching trace found for {pick}"
-                            self.log(msg.format(pick=str(pick_1)), level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        trace_1 = st_1[0]
-
-                        if len(st_2) > 1:
-                            msg = "More than one matching trace found for {pick}"
-                            self.log(msg.format(pick=str(pick_1)), level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        elif len(st_2) == 0:
-                            msg = "No matching trace found for {pick}"
-                            self.log(msg.format(pick=str(pick_1)), level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        trace_2 = st_2[0]
-
-                        if trace_1.id != trace_2.id:
-                            msg = "Non matching ids during cross correlation. "
-                            msg += "(%s and %s)" % (trace_1.id, trace_2.id)
-                            self.log(msg, level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        if trace_1.stats.sampling_rate != \
-                                trace_2.stats.sampling_rate:
-                            msg = ("Non matching sampling rates during cross "
-                                   "correlation. ")
-                            msg += "(%s and %s)" % (trace_1.id, trace_2.id)
-                            self.log(msg, level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-
-                        # Call the cross correlation function.
-                        with warnings.catch_warnings():
-                            warnings.simplefilter("ignore")
-                            try:
-                                pick2_corr, cross_corr_coeff = \
-                                    xcorr_pick_correction(
-                                        pick_1["pick_time"], trace_1,
-                                        pick_2["pick_time"], trace_2,
-                                        t_before=self.cc_param["cc_time_before"],
-                                        t_after=self.cc_param["cc_time_after"],
-                                        cc_maxlag=self.cc_param["cc_maxlag"],
-                                        filter="bandpass",
-                                        filter_options={
-                                            "freqmin":
-                                            self.cc_param["cc_filter_min_freq"],
-                                            "freqmax":
-                                            self.cc_param["cc_filter_max_freq"]},
-                                        plot=False)
-                            except Exception, err:
-                                # XXX: Maybe maxlag is too short?
-                                if not err.message.startswith("Less than 3"):
-                                    msg = "Error during cross correlating: "
-                                    msg += err.message
-                                    self.log(msg, level="error")
-                                    self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                                    continue
-                        all_cross_correlations.append((pick2_corr,
-                                               cross_corr_coeff, channel_weight))
-                    if len(all_cross_correlations) == 0:
-                        self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = "No cross correlations performed"
-                        continue
-                    # Now combine all of them based upon their weight.
-                    pick2_corr = sum([_i[0] * _i[2] for _i in
-                                      all_cross_correlations])
-                    cross_corr_coeff = sum([_i[1] * _i[2] for _i in
-                                            all_cross_correlations])
-                    weight = sum([_i[2] for _i in all_cross_correlations])
-                    pick2_corr /= weight
-                    cross_corr_coeff /= weight
-                    self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = (pick2_corr, cross_corr_coeff)
-                # If the cross_corr_coeff is under the allowed limit, discard
-                # it.
-                if cross_corr_coeff < \
-                        self.cc_param["cc_min_allowed_cross_corr_coeff"]:
+                    self.log("Skipping pick pair due to error message in preloaded cross correlation result: %s" % str(cc_result))
                     continue
-                # Otherwise calculate the corrected differential travel time.
-                diff_travel_time = (pick_2["pick_time"] + pick2_corr -
-                    event_2_dict["origin_time"]) - (pick_1["pick_time"] -
-                    event_1_dict["origin_time"])
-                string = "{station_id} {travel_time:.6f} {weight:.4f} {phase}"
-                string = string.format(
-                    station_id=pick_1["station_id"],
-                    travel_time=diff_travel_time,
-                    weight=cross_corr_coeff,
-                    phase=pick_1["phase"])
-                current_pair_strings.append(string)
-            # Write the file.
-            with open(event_pair_file, "w") as open_file:
-                open_file.write("\n".join(current_pair_strings))
-        pbar.finish()
-        self.log("Finished calculating cross correlations.")
-        if outfile:
-            self.save_cross_correlation_results(outfile)
-        # Assemble final file.
-        final_string = []
-        for cc_file in glob.iglob(os.path.join(cc_dir, "*.txt")):
-            with open(cc_file, "r") as open_file:
-                final_string.append(open_file.read().strip())
-        final_string = "\n".join(final_string)
-        with open(ct_file_path, "w") as open_file:
-            open_file.write(final_string)
+            # we got some previously computed information (but picks were order other way round)..
+            elif found_reversed:
+                # .. and it's actual data
+                if isinstance(cc_result, (list, tuple)) and len(cc_result) == 2:
+                    # revert time correction for other pick order!
+                    pick2_corr, cross_corr_coeff = -cc_result[0], cc_result[1]
+                # .. but it's only an error message or None for a silent skip
+                else:
+                    self.log("Skipping pick pair due to error message in preloaded cross correlation result: %s" % str(cc_result))
+                    continue
+            else:
+                cc_result = self._cross_correlate_pick_pair(
+                    events.get_pick_at(pick_1), events.get_pick_at(pick_2),
+                    cc_results)
+                if cc_result is None:
+                    continue
+                pick2_corr, cross_corr_coeff = cc_result
+            # If the cross_corr_coeff is under the allowed limit, discard
+            # it.
+            if cross_corr_coeff < \
+                    self.cc_param["cc_min_allowed_cross_corr_coeff"]:
+                continue
+            # Otherwise calculate the corrected differential travel time.
+            diff_travel_time = (
+                events.get_pick_time(pick_2) + pick2_corr -
+                events.get_origin_time(self._event_index[event_2])) - (
+                events.get_pick_time(pick_1) -
+                events.get_origin_time(self._event_index[event_1]))
+            string = "{station_id} {travel_time:.6f} {weight:.4f} {phase}"
+            string = string.format(
+                station_id=events.get_pick_station(pick_1),
+                travel_time=diff_travel_time,
+                weight=cross_corr_coeff,
+                phase=events.get_pick_phase(pick_1))
+            current_pair_strings.append(string)
+        return current_pair_strings
 
     def _find_data(self, station_id, starttime, duration):
         """"
-        Parses the self.waveform_information dictionary and returns a list of
-        filenames containing traces of the seeked information.
+        Queries the waveform source and returns a list of the keys, e.g.
+        filenames, of the data containing traces of the seeked information.
 
         Returns False if it could not find any corresponding waveforms.
 
@@ -1136,29 +2359,21 @@ class HypoDDRelocator(object):
         :param duration: The minimum duration of the data.
         """
         endtime = starttime + duration
-        # Find all possible keys for the station_id.
-        id_pattern = "{station_id}.*.*[E,N,Z]".format(station_id=station_id)
-        station_keys = [_i for _i in self.waveform_information.keys()
-                        if fnmatch.fnmatch(_i, id_pattern)]
-        filenames = []
-        for key in station_keys:
-            for waveform in self.waveform_information[key]:
-                if waveform["starttime"] > starttime:
-                    continue
-                if waveform["endtime"] < endtime:
-                    continue
-                filenames.append(waveform["filename"])
-        if len(filenames) == 0:
+        keys = self.waveform_source.find(station_id, starttime, endtime)
+        if len(keys) == 0:
             return False
-        return list(set(filenames))
+        return keys
 
     def _write_hypoDD_inp_file(self):
         """
         Writes the hypoDD.inp file.
         """
         hypodd_inp_path = os.path.join(self.paths["input_files"], "hypoDD.inp")
-        if os.path.exists(hypodd_inp_path):
-            self.log("hypoDD.inp input file already exists.")
+        if self._is_stage_current("hypoDD.inp", [
+                self._get_forward_model_string(),
+                self.forced_configuration_values["MAXDIST"]],
+                [hypodd_inp_path]):
+            self.log("hypoDD.inp input file is up to date.")
             return
         # Use this way of defining the string to avoid leading whitespaces.
         hypodd_inp = "\n".join([
@@ -1187,10 +2402,9 @@ class HypoDDRelocator(object):
         values["IPHA"] = 3
         # Max distance between centroid of event cluster and stations.
         values["DIST"] = self.forced_configuration_values["MAXDIST"]
-        # Always set it to 8.
-        values["OBSCC"] = 8
         # If IDAT=3, the sum of OBSCC and OBSCT is taken for both.
-        values["OBSCT"] = 0
+        values["OBSCC"] = _OBSCC
+        values["OBSCT"] = _OBSCT
         # Set min/max distances/azimuthal gap to -999 (not used)
         values["MINDS"] = -999
         values["MAXDS"] = -999
@@ -1216,6 +2430,7 @@ class HypoDDRelocator(object):
         hypodd_inp = hypodd_inp.format(**values)
         with open(hypodd_inp_path, "w") as open_file:
             open_file.write(hypodd_inp)
+        self._finish_stage("hypoDD.inp")
         self.log("Created hypoDD.inp input file.")
 
     def setup_velocity_model(self, model_type, **kwargs):
@@ -1267,6 +2482,123 @@ class HypoDDRelocator(object):
             msg.format(model_type=model_type)
             raise HypoDDException(msg)
 
+    def setup_partitioning(self, tile_size, halo=0.0):
+        """
+        Relocate the catalog in independent spatial partitions instead of a
+        single HypoDD run. Very large catalogs can otherwise only be handled
+        with huge static arrays and a single long running process.
+
+        The events are assigned to square tiles with an edge length of
+        tile_size in the horizontal plane. Every tile is relocated in its own
+        job directory together with the events within halo around it. The
+        partitions are run in parallel with n_workers processes, see
+        start_relocation().
+
+        The merged output contains the location of every event from the
+        partition it is a core event of. Halo events only contribute if they
+        have not been relocated in their own partition, in this case the
+        partition with the lowest tile key is used. Cluster ids are
+        renumbered to be unique across all partitions.
+
+        :type tile_size: float
+        :param tile_size: The edge length of the tiles in km.
+        :type halo: float
+        :param halo: Width of the overlap around every tile in km. Should be
+            at least in the order of MAXSEP. Defaults to 0.0.
+        """
+        tile_size = float(tile_size)
+        halo = float(halo)
+        if tile_size <= 0.0:
+            msg = "tile_size has to be positive."
+            raise HypoDDException(msg)
+        if halo < 0.0:
+            msg = "halo must not be negative."
+            raise HypoDDException(msg)
+        self.partitioning = {"tile_size": tile_size, "halo": halo}
+
+    def setup_hypodd_arrays(self, headroom=0.2, memory_budget=None):
+        """
+        Configure how hypoDD is compiled. hypoDD uses static arrays, their
+        dimensions are derived from the number of events, stations,
+        observations and clusters in the input files. The estimated memory
+        footprint is checked against a budget before compiling so problems
+        that are too large fail before any time is spent on them.
+
+        :type headroom: float
+        :param headroom: Relative headroom added to all array dimensions.
+            Defaults to 0.2.
+        :type memory_budget: float
+        :param memory_budget: The memory hypoDD may use in MB. Defaults to
+            the physical memory of the machine.
+        """
+        if headroom < 0.0:
+            msg = "headroom must not be negative."
+            raise HypoDDException(msg)
+        if memory_budget is not None and memory_budget <= 0.0:
+            msg = "memory_budget has to be positive."
+            raise HypoDDException(msg)
+        self.hypodd_array_headroom = float(headroom)
+        self.hypodd_memory_budget = memory_budget
+
+    def setup_compilation(self, profile="default", jobs=None):
+        """
+        Configure how hypoDD and ph2dt are compiled. The binaries are cached
+        per profile, see hypodd_compiler.py.
+
+        :type profile: str
+        :param profile: The compile profile. "debug" compiles without
+            optimization and with bounds checking, "default" uses the flags
+            of the HypoDD Makefiles and "aggressive" optimizes for the CPU of
+            the machine. Defaults to "default".
+        :type jobs: int
+        :param jobs: Number of parallel make jobs. Defaults to the number of
+            CPUs.
+        """
+        if profile not in COMPILE_PROFILES:
+            msg = "Unknown compile profile %s. Available profiles: %s" % (
+                profile, ", ".join(sorted(COMPILE_PROFILES)))
+            raise HypoDDException(msg)
+        if jobs is not None and jobs < 1:
+            msg = "jobs has to be at least 1."
+            raise HypoDDException(msg)
+        self.compile_profile = profile
+        self.compile_jobs = jobs
+
+    def setup_waveform_source(self, source):
+        """
+        Use another source of the waveform data than the waveform files, e.g.
+        an SDS archive. See waveform_sources.py.
+
+        >>> relocator.setup_waveform_source(SDSSource("/data/sds"))
+
+        :type source: WaveformSource
+        :param source: The waveform source.
+        """
+        if not isinstance(source, WaveformSource):
+            msg = "source must be a WaveformSource."
+            raise HypoDDException(msg)
+        if self.waveform_files and source is not self.waveform_source:
+            msg = ("The added waveform files are ignored with another "
+                   "waveform source.")
+            self.log(msg, level="warning")
+        self.waveform_source = source
+
+    def setup_waveform_cache(self, max_memory=512):
+        """
+        Configure the cache of decoded waveform files used while the
+        waveform snippets of the picks are extracted. Picks of the same
+        station and day then only read their waveform file once.
+
+        :type max_memory: float
+        :param max_memory: Maximum memory used by the cached waveform data in
+            MB. 0 disables the cache. Defaults to 512.
+        """
+        if max_memory < 0:
+            msg = "max_memory must not be negative."
+            raise HypoDDException(msg)
+        self.waveform_cache = WaveformCache(
+            max_bytes=int(max_memory * 1024 ** 2))
+
     def _get_forward_model_string(self):
         """
         Returns the forward model specification for hypoDD.inp.
@@ -1277,79 +2609,125 @@ class HypoDDRelocator(object):
             raise HypoDDException(msg)
         return self.forward_model_string
 
-    def _create_output_event_file(self):
+    def _read_hypodd_reloc(self):
         """
-        Write the final output file in QuakeML format.
+        Read the final hypoDD.reloc file.
+
+        Returns a dictionary mapping the numeric event ids to the records of
+        the file, see hypodd_output.RELOC_DTYPE.
         """
-        self.log("Writing final output file...")
-        hypodd_reloc = os.path.join(os.path.join(self.working_dir,
-            "output_files", "hypoDD.reloc"))
+        relocations = read_reloc(os.path.join(self.paths["output_files"],
+                                              "hypoDD.reloc"))
+        return dict((int(_i["id"]), _i) for _i in relocations)
 
-        cat = Catalog()
-        self.output_catalog = cat
-        for filename in self.event_files:
-            cat += read_events(filename)
+    def _create_output_event_file(self):
+        """
+        Write the final output file in QuakeML or CSV format.
 
-        with open(hypodd_reloc, "r") as open_file:
-            for line in open_file:
-                event_id, lat, lon, depth, _, _, _, _, _, _, year, month, \
-                    day, hour, minute, second, _, _, _, _, _, _, _, \
-                    cluster_id = line.split()
-                event_id = self.event_map[int(event_id)]
-                cluster_id = int(cluster_id)
-                res_id = ResourceIdentifier(event_id)
-                lat, lon, depth = map(float, [lat, lon, depth])
-                # Convert back to meters.
-                depth *= 1000.0
-                event = res_id.getReferredObject()
-                # Create new origin.
-                new_origin = Origin()
-                sec = int(float(second))
-                # Correct for a bug in hypoDD which can write 60 seconds...
-                add_minute = False
-                if sec >= 60:
-                    sec = 0
-                    add_minute = True
-                new_origin.time = UTCDateTime(int(year), int(month), int(day),
-                    int(hour), int(minute), sec,
-                    int((float(second) % 1.0) * 1E6))
-                if add_minute is True:
-                    new_origin.time = new_origin.time + 60.0
-                new_origin.latitude = lat
-                new_origin.longitude = lon
-                new_origin.depth = depth
-                new_origin.method_id = "HypoDD"
-                # Put the cluster id in the comments to be able to use it later
-                # on.
-                new_origin.comments.append(Comment(
-                    text="HypoDD cluster id: %i" % cluster_id))
-                event.origins.append(new_origin)
-        cat.write(self.output_event_file, format="quakeml")
-
-        self.log("Finished! Final output file: %s" % self.output_event_file)
+        The QuakeML file is written one event at a time. Every event of the
+        input files is written with the HypoDD origin appended if it has been
+        relocated. The CSV file is created from the event table and does not
+        need the input files.
+        """
+        self.log("Writing final output file...")
+        relocations = self._read_hypodd_reloc()
+        if self.output_format == "csv":
+            count = write_csv(self.output_event_file,
+                              self._iter_output_rows(relocations))
+        else:
+            origins = {}
+            for event_number, relocation in relocations.iteritems():
+                if event_number in self.event_map:
+                    origins[self.event_map[event_number]] = \
+                        create_hypodd_origin(relocation)
+            count = write_quakeml(self.event_files, self.output_event_file,
+                                  origins)
+        self._collect_output_summary(relocations)
+        self.log("Finished! Final output file: %s (%i events, %i "
+                 "relocated)" % (self.output_event_file, count,
+                                 len(relocations)))
+
+    def _iter_output_rows(self, relocations):
+        """
+        Generator yielding one row of the CSV output per event, see
+        event_writer.CSV_COLUMNS. Depths and errors are in meters.
+        """
+        for event in self.events:
+            event_number = self.event_map[event["event_id"]]
+            row = {
+                "event_id": event["event_id"],
+                "hypodd_id": event_number,
+                "relocated": 0,
+                "original_origin_time": str(event["origin_time"]),
+                "original_latitude": event["origin_latitude"],
+                "original_longitude": event["origin_longitude"],
+                "original_depth": event["origin_depth"],
+                "magnitude": event["magnitude"]}
+            relocation = relocations.get(event_number)
+            if relocation is not None:
+                row["relocated"] = 1
+                row["origin_time"] = str(get_relocated_time(relocation))
+                row["latitude"] = float(relocation["latitude"])
+                row["longitude"] = float(relocation["longitude"])
+                row["depth"] = float(relocation["depth"]) * 1000.0
+                for axis in "xyz":
+                    row["error_" + axis] = \
+                        float(relocation["error_" + axis])
+                row["cluster_id"] = int(relocation["cluster_id"])
+            yield row
+
+    def _collect_output_summary(self, relocations):
+        """
+        Collect the original and relocated locations and the cluster ids of
+        all events for the plots in self.output_summary. Events that have
+        not been relocated keep their original location and have a cluster
+        id of None.
+        """
+        summary = {
+            "original_latitudes": self.events.get_column("origin_latitude"),
+            "original_longitudes":
+                self.events.get_column("origin_longitude"),
+            "original_depths":
+                self.events.get_column("origin_depth") / 1000.0}
+        summary["relocated_latitudes"] = list(summary["original_latitudes"])
+        summary["relocated_longitudes"] = \
+            list(summary["original_longitudes"])
+        summary["relocated_depths"] = list(summary["original_depths"])
+        summary["cluster_ids"] = [None] * len(self.events)
+        for event_number, relocation in relocations.iteritems():
+            position = self._event_index.get(event_number)
+            if position is None:
+                continue
+            summary["relocated_latitudes"][position] = \
+                float(relocation["latitude"])
+            summary["relocated_longitudes"][position] = \
+                float(relocation["longitude"])
+            summary["relocated_depths"][position] = \
+                float(relocation["depth"])
+            summary["cluster_ids"][position] = int(relocation["cluster_id"])
+        self.output_summary = summary
 
     def _create_plots(self):
         """
-        Creates some plots of the relocated event Catalog.
+        Creates some plots of the relocated events.
         """
         import matplotlib.pylab as plt
         from matplotlib.cm import get_cmap
         from matplotlib.colors import ColorConverter
 
-        catalog = self.output_catalog
+        summary = self.output_summary
         # Generate the output plot filenames.
         original_filename = os.path.join(self.paths["output_files"],
             "original_event_location.pdf")
         relocated_filename = os.path.join(self.paths["output_files"],
             "relocated_event_location.pdf")
 
-        # Some lists to store everything in.
-        original_latitudes = []
-        original_longitudes = []
-        original_depths = []
-        relocated_latitudes = []
-        relocated_longitudes = []
-        relocated_depths = []
+        original_latitudes = summary["original_latitudes"]
+        original_longitudes = summary["original_longitudes"]
+        original_depths = summary["original_depths"]
+        relocated_latitudes = summary["relocated_latitudes"]
+        relocated_longitudes = summary["relocated_longitudes"]
+        relocated_depths = summary["relocated_depths"]
         # The colors will be used to distinguish between different event types.
         # grey: event will/have not been relocated.
         # red: relocated with cluster id 1
@@ -1364,34 +2742,10 @@ class HypoDDRelocator(object):
         color_invalid = ColorConverter().to_rgba("grey")
         cmap = get_cmap("Paired", 12)
 
-        colors = []
-        magnitudes = []
-
-        for event in catalog:
-            # The first event is always the original one.
-            original_latitudes.append(event.origins[0].latitude)
-            original_longitudes.append(event.origins[0].longitude)
-            original_depths.append(event.origins[0].depth / 1000.0)
-            # The last one can either be a relocated one or an original one.
-            relocated_latitudes.append(event.origins[-1].latitude)
-            relocated_longitudes.append(event.origins[-1].longitude)
-            relocated_depths.append(event.origins[-1].depth / 1000.0)
-            magnitudes.append(event.magnitudes[0])
-            # Use color to Code the different events. Colorcode by event
-            # cluster or indicate if an event did not get relocated.
-            if event.origins[-1].method_id is None or \
-               "HYPODD" not in str(event.origins[-1].method_id).upper():
-                colors.append(color_invalid)
-            # Otherwise get the cluster id, stored in the comments.
-            else:
-                for comment in event.origins[-1].comments:
-                    comment = comment.text
-                    if comment and "HypoDD cluster id" in comment:
-                        cluster_id = int(comment.split(":")[-1])
-                        break
-                else:
-                    cluster_id = 0
-                colors.append(cmap(int(cluster_id)))
+        # Use color to Code the different events. Colorcode by event cluster
+        # or indicate if an event did not get relocated.
+        colors = [color_invalid if _i is None else cmap(_i)
+                  for _i in summary["cluster_ids"]]
 
         # Plot the original event location.
         plt.subplot(221)
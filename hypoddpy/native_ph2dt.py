@@ -0,0 +1,347 @@
+"""
+Python implementation of the catalog pair selection of ph2dt.
+
+Reads the same ph2dt.inp, station.dat and phase.dat files as the ph2dt
+binary and writes dt.ct, event.dat, event.sel and station.sel in the same
+formats. In contrast to the binary it has no compile-time array limits and
+finds the neighbors of every event with a KD-tree over the hypocenters
+instead of comparing all event pairs.
+
+The selection follows the rules described in the HypoDD manual:
+
+    * Only picks with a weight of at least MINWGHT are used.
+    * The neighbors of every event are the events within MAXSEP km, visited
+      from the closest to the most distant one.
+    * A link is a station and phase picked for both events of a pair. Only
+      stations within MAXDIST km of the center of the pair are used. If there
+      are more than MAXOBS links the closest stations are kept.
+    * A pair with at least MINOBS links is written to dt.ct.
+    * A pair with at least MINLNK links is a strong neighbor. The search for
+      neighbors of an event stops after MAXNGH strong neighbors.
+
+Each event pair is only written once. The weight of a link is the mean of the
+weights of both picks.
+"""
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from geometry import to_cartesian
+
+
+# Number of nearest neighbors initially requested from the KD-tree for each
+# event. It is doubled until enough strong neighbors have been found.
+INITIAL_NEIGHBOR_COUNT = 32
+
+
+def read_ph2dt_inp(filename):
+    """
+    Read a ph2dt.inp file.
+
+    Returns a dictionary with the station and phase filenames and the
+    MINWGHT, MAXDIST, MAXSEP, MAXNGH, MINLNK, MINOBS and MAXOBS values.
+    """
+    with open(filename, "r") as open_file:
+        lines = [_i.strip() for _i in open_file if _i.strip() and
+                 not _i.strip().startswith("*")]
+    values = lines[2].split()
+    return {
+        "station_file": lines[0],
+        "phase_file": lines[1],
+        "MINWGHT": float(values[0]),
+        "MAXDIST": float(values[1]),
+        "MAXSEP": float(values[2]),
+        "MAXNGH": int(values[3]),
+        "MINLNK": int(values[4]),
+        "MINOBS": int(values[5]),
+        "MAXOBS": int(values[6])}
+
+
+def read_station_file(filename):
+    """
+    Read a station.dat file.
+
+    Returns a list of (station_id, latitude, longitude, elevation) tuples
+    with the elevation in meters.
+    """
+    stations = []
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            items = line.split()
+            if not items:
+                continue
+            elevation = float(items[3]) if len(items) > 3 else 0.0
+            stations.append((items[0], float(items[1]), float(items[2]),
+                             elevation))
+    return stations
+
+
+def read_phase_file(filename):
+    """
+    Read a phase.dat file.
+
+    Returns a list of event dictionaries with the keys "id", "header" (the
+    list of values of the event line) and "picks" (list of (station_id,
+    travel_time, weight, phase) tuples).
+    """
+    events = []
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            items = line.split()
+            if not items:
+                continue
+            if items[0] == "#":
+                events.append({"id": int(items[14]), "header": items[1:14],
+                               "picks": []})
+                continue
+            events[-1]["picks"].append((items[0], float(items[1]),
+                                        float(items[2]), items[3]))
+    return events
+
+
+def _format_event_line(event):
+    """
+    Format an event in the event.dat format, e.g.
+    yyyymmdd hhmmssss lat lon depth mag eh ez rms id
+    """
+    year, month, day, hour, minute, second, lat, lon, depth, mag, eh, ez, \
+        rms = event["header"]
+    date = "%04i%02i%02i" % (int(year), int(month), int(day))
+    time = "%02i%02i%04i" % (int(hour), int(minute),
+                             int(round(float(second) * 100)))
+    return "%s  %s %10.4f %11.4f %9.3f %5.1f %7.2f %7.2f %7.2f %10i" % (
+        date, time, float(lat), float(lon), float(depth), float(mag),
+        float(eh), float(ez), float(rms), event["id"])
+
+
+def _iter_neighbor_batches(tree, point, maxsep, count):
+    """
+    Yields arrays with the indices of all events within maxsep of point from
+    the closest to the most distant one. The first batch contains the
+    INITIAL_NEIGHBOR_COUNT closest events, every following batch as many
+    events as all previous ones together.
+    """
+    k = min(INITIAL_NEIGHBOR_COUNT, count)
+    yielded = 0
+    while True:
+        distances, indices = tree.query(point, k=k,
+                                        distance_upper_bound=maxsep)
+        distances = np.atleast_1d(distances)[yielded:]
+        indices = np.atleast_1d(indices)[yielded:]
+        yield indices[np.isfinite(distances)]
+        # All events within maxsep have been found.
+        if not np.isfinite(distances[-1]) or k == count:
+            return
+        yielded = k
+        k = min(2 * k, count)
+
+
+def build_pairs(events, stations, params, events_to_link=None):
+    """
+    Select the event pairs and their links.
+
+    :param events: Event list as returned by read_phase_file().
+    :param stations: Station list as returned by read_station_file().
+    :param params: Dictionary as returned by read_ph2dt_inp().
+    :param events_to_link: Optional set of event ids. If given only these
+        events are searched for neighbors, so every pair contains at least
+        one of them.
+
+    Returns a list of (event_index_1, event_index_2, links) tuples with links
+    being a list of (station_id, travel_time_1, travel_time_2, weight,
+    phase) tuples sorted by the distance of the stations.
+    """
+    if not events:
+        return []
+    reference_latitude = np.mean([float(_i["header"][6]) for _i in events])
+    event_points = to_cartesian(
+        [float(_i["header"][6]) for _i in events],
+        [float(_i["header"][7]) for _i in events],
+        [float(_i["header"][8]) for _i in events],
+        reference_latitude=reference_latitude)
+    station_points = to_cartesian(
+        [_i[1] for _i in stations], [_i[2] for _i in stations],
+        [-_i[3] / 1000.0 for _i in stations],
+        reference_latitude=reference_latitude)
+    station_index = dict((station[0], _i)
+                         for _i, station in enumerate(stations))
+
+    # All usable picks are stored in flat arrays, the picks of event i are
+    # at offsets[i]:offsets[i + 1]. Every station and phase combination is
+    # encoded as one integer key. Only the first pick of every key is used.
+    phases = []
+    keys = []
+    travel_times = []
+    weights = []
+    offsets = [0]
+    for event in events:
+        current_keys = set()
+        for station_id, travel_time, weight, phase in event["picks"]:
+            if weight < params["MINWGHT"]:
+                continue
+            if station_id not in station_index:
+                continue
+            if phase not in phases:
+                phases.append(phase)
+            key = (station_index[station_id], phases.index(phase))
+            if key in current_keys:
+                continue
+            current_keys.add(key)
+            keys.append(key)
+            travel_times.append(travel_time)
+            weights.append(weight)
+        offsets.append(len(keys))
+    phase_count = max(len(phases), 1)
+    keys = np.array([_i[0] * phase_count + _i[1] for _i in keys],
+                    dtype=np.int64)
+    travel_times = np.array(travel_times, dtype=np.float64)
+    weights = np.array(weights, dtype=np.float64)
+    offsets = np.array(offsets, dtype=np.int64)
+    key_count = len(stations) * phase_count
+    station_ids = [_i[0] for _i in stations]
+
+    tree = cKDTree(event_points)
+    count = len(events)
+    linked_pairs = set()
+    pairs = []
+    for i in xrange(count):
+        if events_to_link is not None and \
+                events[i]["id"] not in events_to_link:
+            continue
+        # Dense lookup tables of the picks of event i.
+        picks_i = slice(offsets[i], offsets[i + 1])
+        has_pick = np.zeros(key_count, dtype=np.bool_)
+        has_pick[keys[picks_i]] = True
+        position_i = np.zeros(key_count, dtype=np.int64)
+        position_i[keys[picks_i]] = np.arange(offsets[i], offsets[i + 1])
+
+        strong_neighbors = 0
+        for neighbors in _iter_neighbor_batches(
+                tree, event_points[i], params["MAXSEP"], count):
+            neighbors = neighbors[neighbors != i]
+            if not len(neighbors):
+                continue
+            # Gather the picks of all neighbors of the batch.
+            lengths = offsets[neighbors + 1] - offsets[neighbors]
+            neighbor = np.repeat(np.arange(len(neighbors)), lengths)
+            position_j = np.arange(lengths.sum()) - \
+                np.repeat(lengths.cumsum() - lengths, lengths) + \
+                np.repeat(offsets[neighbors], lengths)
+            # Only keep the links, e.g. the keys picked for both events and
+            # recorded by stations within MAXDIST of the pair center.
+            mask = has_pick[keys[position_j]]
+            neighbor = neighbor[mask]
+            position_j = position_j[mask]
+            link_keys = keys[position_j]
+            centers = (event_points[i] + event_points[neighbors[neighbor]]) \
+                / 2.0
+            distances = np.sqrt(((station_points[link_keys // phase_count] -
+                                  centers) ** 2).sum(axis=1))
+            mask = distances <= params["MAXDIST"]
+            neighbor = neighbor[mask]
+            position_j = position_j[mask]
+            link_keys = link_keys[mask]
+            distances = distances[mask]
+            # Sort the links of every neighbor by station distance and only
+            # keep the closest MAXOBS.
+            order = np.lexsort((link_keys, distances, neighbor))
+            neighbor = neighbor[order]
+            position_j = position_j[order]
+            link_count = np.bincount(neighbor, minlength=len(neighbors))
+            first_link = link_count.cumsum() - link_count
+            link_count = np.minimum(link_count, params["MAXOBS"])
+            # The search stops after MAXNGH strong neighbors.
+            strong = link_count >= params["MINLNK"]
+            strong_before = strong_neighbors + strong.cumsum() - strong
+            processed = strong_before < params["MAXNGH"]
+            strong_neighbors += int(strong[processed].sum())
+            written = []
+            for _k in np.nonzero(processed &
+                                 (link_count >= params["MINOBS"]))[0]:
+                j = int(neighbors[_k])
+                pair = (min(i, j), max(i, j))
+                if pair in linked_pairs:
+                    continue
+                linked_pairs.add(pair)
+                written.append(_k)
+            if not written:
+                if strong_neighbors >= params["MAXNGH"]:
+                    break
+                continue
+            # Assemble the links of all written pairs of the batch at once.
+            rank = np.arange(len(neighbor)) - first_link[neighbor]
+            is_written = np.zeros(len(neighbors), dtype=np.bool_)
+            is_written[written] = True
+            mask = is_written[neighbor] & (rank < link_count[neighbor])
+            position_2 = position_j[mask]
+            link_keys = keys[position_2]
+            position_1 = position_i[link_keys]
+            links = zip(
+                [station_ids[_k] for _k in
+                 (link_keys // phase_count).tolist()],
+                travel_times[position_1].tolist(),
+                travel_times[position_2].tolist(),
+                ((weights[position_1] + weights[position_2]) / 2.0).tolist(),
+                [phases[_k] for _k in (link_keys % phase_count).tolist()])
+            start = 0
+            for _k in written:
+                pairs.append((i, int(neighbors[_k]),
+                              links[start:start + link_count[_k]]))
+                start += link_count[_k]
+            if strong_neighbors >= params["MAXNGH"]:
+                break
+    return pairs
+
+
+def run_ph2dt(directory, events_to_link=None):
+    """
+    Run the pair selection in directory. It needs to contain ph2dt.inp and
+    the station and phase files named in it. dt.ct, event.dat, event.sel and
+    station.sel are written to directory.
+
+    :param events_to_link: Optional set of event ids, see build_pairs().
+        event.sel and station.sel then contain all events and stations as
+        pairs of the other events might exist elsewhere.
+
+    Returns a dictionary with the number of events, pairs and links.
+    """
+    params = read_ph2dt_inp(os.path.join(directory, "ph2dt.inp"))
+    stations = read_station_file(os.path.join(directory,
+                                              params["station_file"]))
+    events = read_phase_file(os.path.join(directory, params["phase_file"]))
+    pairs = build_pairs(events, stations, params,
+                        events_to_link=events_to_link)
+
+    selected_events = set()
+    selected_stations = set()
+    link_count = 0
+    with open(os.path.join(directory, "dt.ct"), "w") as open_file:
+        for i, j, links in pairs:
+            selected_events.update((i, j))
+            open_file.write("# %9i %9i\n" % (events[i]["id"],
+                                             events[j]["id"]))
+            for station_id, travel_time_1, travel_time_2, weight, phase in \
+                    links:
+                selected_stations.add(station_id)
+                open_file.write("%-7s %11.6f %11.6f %7.4f %s\n" % (
+                    station_id, travel_time_1, travel_time_2, weight, phase))
+            link_count += len(links)
+    if events_to_link is not None:
+        selected_events = set(range(len(events)))
+        selected_stations = set(_i[0] for _i in stations)
+
+    with open(os.path.join(directory, "event.dat"), "w") as open_file:
+        for event in events:
+            open_file.write(_format_event_line(event) + "\n")
+    with open(os.path.join(directory, "event.sel"), "w") as open_file:
+        for _i, event in enumerate(events):
+            if _i in selected_events:
+                open_file.write(_format_event_line(event) + "\n")
+    with open(os.path.join(directory, "station.sel"), "w") as open_file:
+        for station_id, latitude, longitude, elevation in stations:
+            if station_id in selected_stations:
+                open_file.write("%-7s %10.4f %11.4f %6i\n" % (
+                    station_id, latitude, longitude, int(round(elevation))))
+    return {"events": len(selected_events), "pairs": len(pairs),
+            "links": link_count}
@@ -0,0 +1,201 @@
+"""
+Spatial partitioning of a catalog into independently relocated sub-problems.
+
+The events are assigned to square tiles in the local Cartesian system of
+geometry.py. Every tile is one partition consisting of
+
+    * the core events located inside the tile and
+    * the halo events located within a given distance outside of the tile.
+
+The halo events stabilize the relocation of the core events close to the
+tile borders. Each partition gets its own subset of the HypoDD input files
+and is relocated in its own directory.
+
+Merging the results is deterministic: The location of every event is taken
+from the partition it is a core event of. Only if it has not been relocated
+there, the location from the first partition (in the order of the tile keys)
+that relocated it as a halo event is used. Cluster ids are renumbered so they
+are unique across all partitions.
+"""
+import os
+
+import numpy as np
+
+from hypodd_output import iter_line_chunks, parse_lines, RES_DTYPE
+
+
+def assign_partitions(event_ids, points, tile_size, halo=0.0):
+    """
+    Assign events to tiles.
+
+    :param event_ids: List of the numeric event ids.
+    :param points: Array of shape (N, 3) with the Cartesian coordinates of
+        the events in km, see geometry.to_cartesian().
+    :param tile_size: Edge length of the tiles in km.
+    :param halo: Width of the halo around each tile in km.
+
+    Returns a list of partitions sorted by tile key. Every partition is a
+    dictionary with the keys "key" (tuple of the x and y tile index), "core"
+    (set of the ids of the core events) and "events" (set of the ids of the
+    core and halo events). Tiles without core events are omitted.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    partitions = {}
+    if not len(points):
+        return []
+    tiles = np.floor(points[:, :2] / tile_size).astype(np.int64)
+    for event_id, tile in zip(event_ids, tiles):
+        key = (int(tile[0]), int(tile[1]))
+        partition = partitions.setdefault(
+            key, {"key": key, "core": set(), "events": set()})
+        partition["core"].add(event_id)
+        partition["events"].add(event_id)
+    if halo > 0:
+        for key, partition in partitions.iteritems():
+            lower = np.array(key, dtype=np.float64) * tile_size - halo
+            upper = lower + tile_size + 2 * halo
+            inside = np.all((points[:, :2] >= lower) &
+                            (points[:, :2] < upper), axis=1)
+            partition["events"].update(
+                event_ids[_i] for _i in np.nonzero(inside)[0])
+    return [partitions[key] for key in sorted(partitions)]
+
+
+def write_partition_inputs(input_dir, output_dir, partition, dt_files,
+                           event_file, other_files):
+    """
+    Write the input files of one partition.
+
+    :param input_dir: Directory with the input files of the full catalog.
+    :param output_dir: The job directory of the partition.
+    :param partition: Partition as returned by assign_partitions().
+    :param dt_files: Names of the dt.cc and dt.ct files. Only the event pairs
+        with both events in the partition are written.
+    :param event_file: Name of the event.sel file. Only the events of the
+        partition are written.
+    :param other_files: Names of all files that are copied unchanged.
+
+    Returns the number of event pairs written to all dt files.
+    """
+    events = partition["events"]
+    pair_count = 0
+    for filename in dt_files:
+        with open(os.path.join(input_dir, filename), "r") as in_file:
+            with open(os.path.join(output_dir, filename), "w") as out_file:
+                keep = False
+                for line in in_file:
+                    if line.strip().startswith("#"):
+                        event_1, event_2 = map(
+                            int, line.strip()[1:].split()[:2])
+                        keep = event_1 in events and event_2 in events
+                        pair_count += keep
+                    if keep:
+                        out_file.write(line)
+    with open(os.path.join(input_dir, event_file), "r") as in_file:
+        with open(os.path.join(output_dir, event_file), "w") as out_file:
+            for line in in_file:
+                items = line.split()
+                if items and int(items[-1]) in events:
+                    out_file.write(line)
+    for filename in other_files:
+        with open(os.path.join(input_dir, filename), "r") as in_file:
+            with open(os.path.join(output_dir, filename), "w") as out_file:
+                out_file.write(in_file.read())
+    return pair_count
+
+
+def _replace_cluster_id(line, cluster_id):
+    """
+    Replace the last column of a line of hypoDD.reloc, hypoDD.loc or
+    hypoDD.sta with a new cluster id.
+    """
+    head, old = line.rstrip("\r\n").rsplit(None, 1)
+    return head + " " + str(cluster_id).rjust(len(old)) + "\n"
+
+
+def merge_partition_outputs(partitions, job_dirs, output_dir):
+    """
+    Merge the HypoDD output files of all partitions.
+
+    :param partitions: List of partitions as returned by assign_partitions().
+    :param job_dirs: The job directory of every partition. None for
+        partitions that have not been relocated.
+    :param output_dir: Directory the merged hypoDD.reloc, hypoDD.loc,
+        hypoDD.res, hypoDD.sta and hypoDD.src files are written to.
+
+    Returns the number of relocated events.
+    """
+    reloc_lines = {}
+    loc_lines = {}
+    for index, (partition, job_dir) in enumerate(zip(partitions, job_dirs)):
+        if job_dir is None:
+            continue
+        for filename, lines in (("hypoDD.reloc", reloc_lines),
+                                ("hypoDD.loc", loc_lines)):
+            with open(os.path.join(job_dir, filename), "r") as open_file:
+                for line in open_file:
+                    items = line.split()
+                    if not items:
+                        continue
+                    event_id = int(items[0])
+                    # Core events always take precedence, otherwise the
+                    # first partition wins.
+                    is_core = event_id in partition["core"]
+                    if event_id in lines and (lines[event_id][0] or
+                                              not is_core):
+                        continue
+                    lines[event_id] = (is_core, (index, int(items[-1])),
+                                       line)
+
+    # Number the clusters of the merged events in the order of the
+    # partitions and their original cluster ids.
+    cluster_ids = {}
+    for cluster in sorted(set(_i[1] for _i in reloc_lines.itervalues())):
+        cluster_ids[cluster] = len(cluster_ids) + 1
+
+    def get_cluster_id(cluster):
+        if cluster not in cluster_ids:
+            cluster_ids[cluster] = len(cluster_ids) + 1
+        return cluster_ids[cluster]
+
+    for filename, lines in (("hypoDD.reloc", reloc_lines),
+                            ("hypoDD.loc", loc_lines)):
+        with open(os.path.join(output_dir, filename), "w") as open_file:
+            for event_id in sorted(lines):
+                _, cluster, line = lines[event_id]
+                open_file.write(_replace_cluster_id(
+                    line, get_cluster_id(cluster)))
+
+    # The residuals of every pair are taken from the partition the first
+    # event of the pair is a core event of. Station statistics and sources
+    # are collected from all partitions.
+    with open(os.path.join(output_dir, "hypoDD.res"), "w") as res_file, \
+            open(os.path.join(output_dir, "hypoDD.sta"), "w") as sta_file, \
+            open(os.path.join(output_dir, "hypoDD.src"), "w") as src_file:
+        header_written = False
+        for index, (partition, job_dir) in enumerate(zip(partitions,
+                                                         job_dirs)):
+            if job_dir is None:
+                continue
+            core = np.array(sorted(partition["core"]), dtype=np.int64)
+            for lines in iter_line_chunks(os.path.join(job_dir,
+                                                       "hypoDD.res")):
+                header = [_i for _i in lines if _i.startswith("STA DT ")]
+                if header and not header_written:
+                    res_file.write(header[0])
+                    header_written = True
+                lines = [_i for _i in lines
+                         if _i.strip() and not _i.startswith("STA DT ")]
+                keep = np.in1d(parse_lines(lines, RES_DTYPE)["event_1"],
+                               core)
+                res_file.writelines(lines[_i] for _i in np.nonzero(keep)[0])
+            with open(os.path.join(job_dir, "hypoDD.sta"), "r") as open_file:
+                for line in open_file:
+                    items = line.split()
+                    if not items:
+                        continue
+                    sta_file.write(_replace_cluster_id(
+                        line, get_cluster_id((index, int(items[-1])))))
+            with open(os.path.join(job_dir, "hypoDD.src"), "r") as open_file:
+                src_file.write(open_file.read())
+    return len(reloc_lines)
@@ -0,0 +1,155 @@
+"""
+Fingerprints of the inputs of the single relocation stages.
+
+Every stage of the relocation (parsing the stations, writing phase.dat,
+running ph2dt, cross correlating, ...) calculates a fingerprint of everything
+its output depends on: Its parameters, the input files given by the user and
+the fingerprints of the stages it builds upon. The fingerprint of a
+successfully finished stage is recorded in a JSON file in the working
+directory. On the next run a stage is only skipped if its fingerprint did not
+change and all of its output files still exist. As the fingerprints are
+chained, a changed stage causes all depending stages to be rerun as well.
+
+Input files are fingerprinted by their absolute path, size and modification
+time so large waveform archives do not have to be read for that.
+
+Working directories created before fingerprints were recorded have output
+files without any fingerprint. Such outputs are adopted once, see
+StageCache.is_unknown().
+"""
+import hashlib
+import json
+import os
+
+
+def get_fingerprint(*parts):
+    """
+    Returns a hex digest of any number of JSON serializable objects. Objects
+    that are not JSON serializable are converted with str().
+    """
+    serialized = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(serialized).hexdigest()
+
+
+def get_files_fingerprint(filenames):
+    """
+    Fingerprint a list of files by their absolute paths, sizes and
+    modification times. Missing files are included with a size and
+    modification time of None.
+    """
+    stats = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+            stats.append((os.path.abspath(filename), stat.st_size,
+                          stat.st_mtime))
+        except OSError:
+            stats.append((os.path.abspath(filename), None, None))
+    return get_fingerprint(stats)
+
+
+def get_file_content_fingerprint(filename):
+    """
+    Fingerprint a single small file by its content. Returns None if the file
+    does not exist.
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as open_file:
+        return hashlib.sha1(open_file.read()).hexdigest()
+
+
+def get_function_fingerprint(func):
+    """
+    Fingerprint a Python function by its byte code, constants and names.
+    Callables without byte code are identified by their name.
+    """
+    def _code_parts(code):
+        consts = []
+        for const in code.co_consts:
+            if hasattr(const, "co_code"):
+                consts.append(_code_parts(const))
+            else:
+                consts.append(repr(const))
+        return [code.co_code.encode("hex"), consts, list(code.co_names)]
+
+    code = getattr(func, "func_code", None)
+    if code is None:
+        return get_fingerprint(getattr(func, "__name__", repr(type(func))))
+    return get_fingerprint(_code_parts(code))
+
+
+class StageCache(object):
+    """
+    Records the fingerprints of the finished stages in a JSON file.
+
+    Usage
+    =====
+
+    >>> cache = StageCache("stage_fingerprints.json")
+    >>> fingerprint = get_fingerprint({"param": 1.0})
+    >>> if not cache.is_current("stage", fingerprint, ["output.txt"]):
+    ...     cache.invalidate("stage")
+    ...     # Run the stage and write output.txt
+    ...     cache.record("stage", fingerprint)
+    """
+    def __init__(self, filename):
+        """
+        :param filename: The JSON file the fingerprints are stored in.
+        """
+        self.filename = filename
+        self._fingerprints = {}
+        if os.path.exists(filename):
+            with open(filename, "r") as open_file:
+                self._fingerprints = json.load(open_file)
+
+    def get(self, stage):
+        """
+        Returns the recorded fingerprint of a stage or None.
+        """
+        return self._fingerprints.get(stage)
+
+    def is_unknown(self, stage):
+        """
+        True if nothing has ever been recorded for the stage, not even an
+        invalidation.
+        """
+        return stage not in self._fingerprints
+
+    def is_current(self, stage, fingerprint, output_files):
+        """
+        True if the recorded fingerprint of the stage equals fingerprint and
+        all output files exist.
+        """
+        if self._fingerprints.get(stage) != fingerprint:
+            return False
+        for filename in output_files:
+            if not os.path.exists(filename):
+                return False
+        return True
+
+    def record(self, stage, fingerprint):
+        """
+        Record the fingerprint of a finished stage.
+        """
+        self._fingerprints[stage] = fingerprint
+        self._write()
+
+    def invalidate(self, stage):
+        """
+        Reset the recorded fingerprint of a stage. Must be called before the
+        outputs of a stage are rewritten so an interrupted stage is never
+        considered current.
+        """
+        if self._fingerprints.get(stage, False) is not None:
+            self._fingerprints[stage] = None
+            self._write()
+
+    def _write(self):
+        # Write to a temporary file first so an interrupted write never
+        # leaves a corrupt file behind.
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "w") as open_file:
+            json.dump(self._fingerprints, open_file, indent=4,
+                      sort_keys=True)
+        os.rename(temp_filename, self.filename)
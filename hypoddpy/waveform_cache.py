@@ -0,0 +1,108 @@
+"""
+Memory bounded LRU cache of decoded waveform files.
+
+Picks of the same station and day are usually all contained in one waveform
+file. Without a cache that file is read and decoded again for every pick.
+The cache keeps the decoded streams of the most recently used files in memory
+until a byte budget is reached and then evicts the least recently used ones.
+
+The number of hits, misses and evictions is counted so the effectiveness of
+the cache can be judged, e.g. for different budgets or pick orders.
+"""
+from collections import OrderedDict
+
+from obspy.core import read, Stream, Trace
+
+
+# Default budget of the decoded waveform data in bytes.
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+
+def get_stream_size(stream):
+    """
+    Returns the memory used by the data of all traces of a stream in bytes.
+    """
+    return sum(trace.data.nbytes for trace in stream)
+
+
+class WaveformCache(object):
+    """
+    LRU cache of decoded waveform files keyed by filename.
+
+    Usage
+    =====
+
+    >>> cache = WaveformCache(max_bytes=256 * 1024 ** 2)
+    >>> stream = cache.get("BW.FURT..EHZ.D.2010.005")
+    >>> cache.get_statistics()
+    {'hits': 0, 'misses': 1, 'evictions': 0, 'bytes': 6912000, 'files': 1}
+
+    The traces of the returned streams have their own headers but share
+    their data arrays with the cache. The data must not be modified in
+    place.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, reader=read):
+        """
+        :param max_bytes: Maximum size of all cached waveform data in bytes.
+            Streams larger than this are never cached.
+        :param reader: Function returning the stream of a filename.
+        """
+        self.max_bytes = max_bytes
+        self.reader = reader
+        self._streams = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, filename):
+        return filename in self._streams
+
+    def __len__(self):
+        return len(self._streams)
+
+    def get(self, filename):
+        """
+        Returns the stream of a file. The file is only read if it is not
+        cached.
+        """
+        entry = self._streams.pop(filename, None)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            stream = self.reader(filename)
+            entry = (stream, get_stream_size(stream))
+            if entry[1] > self.max_bytes:
+                return stream
+            self.bytes += entry[1]
+            self._evict()
+        # The last entry is the most recently used one.
+        self._streams[filename] = entry
+        return Stream(traces=[Trace(data=_i.data, header=_i.stats.copy())
+                              for _i in entry[0]])
+
+    def _evict(self):
+        """
+        Remove the least recently used streams until the budget is met.
+        """
+        while self.bytes > self.max_bytes and self._streams:
+            _, (_, size) = self._streams.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all streams. The counters are kept.
+        """
+        self._streams.clear()
+        self.bytes = 0
+
+    def get_statistics(self):
+        """
+        Returns a dictionary with the hits, misses, evictions, the number of
+        cached files and their size in bytes.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "bytes": self.bytes,
+                "files": len(self._streams)}
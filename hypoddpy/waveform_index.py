@@ -0,0 +1,108 @@
+"""
+Interval index for looking up the waveform files covering a time span.
+
+The index maps every station (network.station) to its trace ids and every
+trace id to the time spans of all files containing data for it. The spans are
+sorted by starttime so the files covering a given time span can be found with
+a binary search instead of scanning all known files.
+"""
+import bisect
+import json
+
+
+class WaveformIndex(object):
+    """
+    Index of station -> trace id -> sorted (starttime, endtime, filename)
+    entries. All times are stored as POSIX timestamps.
+    """
+    def __init__(self):
+        self._index = {}
+
+    @classmethod
+    def from_waveform_information(cls, waveform_information):
+        """
+        Build the index from the waveform information dictionary of the
+        relocator, e.g. trace_id -> list of dictionaries with starttime,
+        endtime and filename.
+        """
+        index = cls()
+        for trace_id, items in waveform_information.iteritems():
+            station_id = ".".join(trace_id.split(".")[:2])
+            entries = sorted(
+                (_to_timestamp(item["starttime"]),
+                 _to_timestamp(item["endtime"]),
+                 item["filename"]) for item in items)
+            index._add(station_id, trace_id, entries)
+        return index
+
+    def _add(self, station_id, trace_id, entries):
+        starts = [_i[0] for _i in entries]
+        ends = [_i[1] for _i in entries]
+        filenames = [_i[2] for _i in entries]
+        # Running maximum of the endtimes. Allows to stop the backwards scan
+        # as soon as no earlier span can reach the requested endtime anymore.
+        max_ends = []
+        current_max = None
+        for end in ends:
+            current_max = end if current_max is None else max(current_max,
+                                                               end)
+            max_ends.append(current_max)
+        self._index.setdefault(station_id, {})[trace_id] = \
+            (starts, ends, max_ends, filenames)
+
+    def find(self, station_id, starttime, endtime, components="ENZ"):
+        """
+        Returns a sorted list of all files with data for the station that
+        fully cover the span from starttime to endtime. Only channels whose
+        last letter is in components are considered.
+        """
+        starttime = _to_timestamp(starttime)
+        endtime = _to_timestamp(endtime)
+        filenames = set()
+        for trace_id, entries in self._index.get(station_id, {}).iteritems():
+            if trace_id[-1] not in components:
+                continue
+            starts, ends, max_ends, files = entries
+            # All spans starting before or at starttime.
+            _i = bisect.bisect_right(starts, starttime) - 1
+            while _i >= 0 and max_ends[_i] >= endtime:
+                if ends[_i] >= endtime:
+                    filenames.add(files[_i])
+                _i -= 1
+        return sorted(filenames)
+
+    def save(self, filename):
+        """
+        Serialize the index as a JSON file.
+        """
+        index = {}
+        for station_id, trace_ids in self._index.iteritems():
+            index[station_id] = {}
+            for trace_id, entries in trace_ids.iteritems():
+                starts, ends, _, filenames = entries
+                index[station_id][trace_id] = [starts, ends, filenames]
+        with open(filename, "w") as open_file:
+            json.dump(index, open_file)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an index serialized with save().
+        """
+        with open(filename, "r") as open_file:
+            serialized = json.load(open_file)
+        index = cls()
+        for station_id, trace_ids in serialized.iteritems():
+            for trace_id, (starts, ends, filenames) in trace_ids.iteritems():
+                index._add(station_id, trace_id,
+                           zip(starts, ends, filenames))
+        return index
+
+
+def _to_timestamp(time):
+    """
+    Returns the POSIX timestamp of a UTCDateTime. Floats are passed through.
+    """
+    if isinstance(time, float):
+        return time
+    return time.timestamp
@@ -0,0 +1,449 @@
+"""
+Record level index of miniSEED files for ranged reads.
+
+A miniSEED file is a sequence of independent records of usually 512 or 4096
+bytes. The correlation window around a pick is well below a second, so
+decoding a whole day file to get it wastes almost all of the work. While the
+waveform files are scanned, the fixed header of every record is parsed and
+the trace id, time span, sampling rate, byte offset and length of every
+record are stored per file. Reading a time window then only decodes the few
+records covering it, taken directly from a memory map of the file. The time
+spans of the traces in a file are derived from the same scan, see
+get_trace_spans(), so the file does not have to be parsed again.
+
+Files that are not miniSEED or lack the record length (blockette 1000) get no
+index and are read in full.
+"""
+from collections import OrderedDict
+import calendar
+import hashlib
+import io
+import mmap
+import os
+import struct
+
+import numpy as np
+from obspy.core import read, Stream
+
+
+RECORD_DTYPE = np.dtype([("id", "S15"), ("starttime", np.float64),
+                         ("endtime", np.float64), ("offset", np.int64),
+                         ("length", np.int32), ("sampling_rate", np.float64)])
+
+# Number of per file indices kept in memory.
+DEFAULT_MAX_FILES = 64
+
+_FIXED_HEADER_LENGTH = 48
+_DATA_QUALITY_CODES = "DRQM"
+_HEADER_DTYPE = np.dtype([
+    ("sequence_number", "S6"), ("quality", "S1"), ("reserved", "S1"),
+    ("station", "S5"), ("location", "S2"), ("channel", "S3"),
+    ("network", "S2"), ("year", "u2"), ("day", "u2"), ("hour", "u1"),
+    ("minute", "u1"), ("second", "u1"), ("unused", "u1"),
+    ("fraction", "u2"), ("npts", "u2"), ("factor", "i2"),
+    ("multiplier", "i2"), ("activity", "u1"), ("io_flags", "u1"),
+    ("quality_flags", "u1"), ("blockette_count", "u1"),
+    ("correction", "i4"), ("data_offset", "u2"), ("first_blockette", "u2")])
+_BLOCKETTE_1000_DTYPE = np.dtype([
+    ("blockette_type", "u2"), ("next_blockette", "u2"), ("encoding", "u1"),
+    ("word_order", "u1"), ("record_length", "u1")])
+_BLOCKETTE_1001_DTYPE = np.dtype([
+    ("blockette_type", "u2"), ("next_blockette", "u2"),
+    ("timing_quality", "u1"), ("microseconds", "i1")])
+
+
+def _get_sampling_rate(factor, multiplier):
+    """
+    Returns the sampling rate of a sample rate factor and multiplier as
+    defined by the SEED manual.
+    """
+    if factor == 0 or multiplier == 0:
+        return 0.0
+    if factor > 0 and multiplier > 0:
+        return float(factor * multiplier)
+    if factor > 0:
+        return -float(factor) / multiplier
+    if multiplier > 0:
+        return -float(multiplier) / factor
+    return 1.0 / (factor * multiplier)
+
+
+def _get_byte_order(header):
+    """
+    Returns the struct byte order of a fixed header. The record start year
+    and day of year must be plausible in the returned byte order.
+    """
+    for byte_order in ">", "<":
+        year, day = struct.unpack_from(byte_order + "HH", header, 20)
+        if 1900 <= year <= 2100 and 1 <= day <= 366:
+            return byte_order
+    msg = "Invalid record start time."
+    raise ValueError(msg)
+
+
+def _find_blockette(data, offset, byte_order, first_blockette,
+                    wanted_type=1000):
+    """
+    Returns the position of the blockette of the given type within a record
+    or None. Blockettes 1000 and 1001 are both at least 7 bytes long.
+    """
+    blockette = first_blockette
+    # Blockette offsets are relative to the record and only go forward.
+    while blockette >= _FIXED_HEADER_LENGTH and \
+            offset + blockette + 7 <= len(data):
+        blockette_type, next_blockette = struct.unpack_from(
+            byte_order + "HH", data, offset + blockette)
+        if blockette_type == wanted_type:
+            return blockette
+        if next_blockette <= blockette:
+            break
+        blockette = next_blockette
+    return None
+
+
+def _get_record_length(data, offset, byte_order, first_blockette):
+    """
+    Returns the record length from blockette 1000 of a record or None.
+    """
+    blockette = _find_blockette(data, offset, byte_order, first_blockette)
+    if blockette is None:
+        return None
+    return 2 ** ord(data[offset + blockette + 6])
+
+
+def _get_year_start(year, year_starts):
+    """
+    Returns the timestamp of the start of a year, cached in year_starts.
+    """
+    if year not in year_starts:
+        year_starts[year] = calendar.timegm((year, 1, 1, 0, 0, 0))
+    return year_starts[year]
+
+
+def _scan_fixed_length_records(data):
+    """
+    Parse the headers of all records at once assuming every record has the
+    length and the blockette layout of the first one, which is what almost
+    all writers do.
+
+    Returns an array with RECORD_DTYPE or None if the assumption does not
+    hold.
+    """
+    header = data[:_FIXED_HEADER_LENGTH]
+    byte_order = _get_byte_order(header)
+    first_blockette = struct.unpack_from(byte_order + "H", header, 46)[0]
+    blockette = _find_blockette(data, 0, byte_order, first_blockette)
+    if blockette is None:
+        return None
+    length = 2 ** ord(data[blockette + 6])
+    if len(data) % length or \
+            length < blockette + _BLOCKETTE_1000_DTYPE.itemsize:
+        return None
+    headers = np.ndarray((len(data) // length,),
+                         dtype=_HEADER_DTYPE.newbyteorder(byte_order),
+                         buffer=data, strides=(length,))
+    blockettes = np.ndarray(
+        (len(headers),), dtype=_BLOCKETTE_1000_DTYPE.newbyteorder(byte_order),
+        buffer=data, offset=blockette, strides=(length,))
+    if not np.all(np.in1d(headers["quality"], list(_DATA_QUALITY_CODES))) \
+            or not np.all(headers["first_blockette"] == first_blockette) \
+            or not np.all(blockettes["blockette_type"] == 1000) \
+            or not np.all(blockettes["record_length"] ==
+                          blockettes["record_length"][0]) \
+            or not np.all((headers["year"] >= 1900) &
+                          (headers["year"] <= 2100)):
+        return None
+    # The microseconds of blockette 1001 must be at the same position in
+    # every record as well.
+    microseconds = 0
+    blockette = _find_blockette(data, 0, byte_order, first_blockette, 1001)
+    if blockette is not None:
+        if length < blockette + _BLOCKETTE_1001_DTYPE.itemsize:
+            return None
+        blockettes = np.ndarray(
+            (len(headers),),
+            dtype=_BLOCKETTE_1001_DTYPE.newbyteorder(byte_order),
+            buffer=data, offset=blockette, strides=(length,))
+        if not np.all(blockettes["blockette_type"] == 1001):
+            return None
+        microseconds = blockettes["microseconds"]
+    years, year_index = np.unique(headers["year"], return_inverse=True)
+    year_starts = {}
+    starttimes = np.array([_get_year_start(_i, year_starts) for _i in years],
+                          dtype=np.float64)[year_index]
+    starttimes += (headers["day"] - 1.0) * 86400.0 + \
+        headers["hour"] * 3600.0 + headers["minute"] * 60.0 + \
+        headers["second"] + headers["fraction"] * 1E-4 + microseconds * 1E-6
+    # Apply the time correction unless it already is.
+    starttimes += np.where(headers["activity"] & 2, 0,
+                           headers["correction"]) * 1E-4
+    rates, rate_index = np.unique(
+        headers[["factor", "multiplier"]].astype(
+            [("factor", np.int64), ("multiplier", np.int64)]),
+        return_inverse=True)
+    sampling_rates = np.array([_get_sampling_rate(*_i) for _i in rates],
+                              dtype=np.float64)[rate_index]
+    # The station, location, channel and network codes are contiguous.
+    codes = np.ndarray((len(headers),), dtype="S12", buffer=data, offset=8,
+                       strides=(length,))
+    codes, code_index = np.unique(codes, return_inverse=True)
+    ids = np.array([".".join(_i[_j:_k].strip() for _j, _k in
+                             [(10, 12), (0, 5), (5, 7), (7, 10)])
+                    for _i in codes], dtype="S15")[code_index]
+    valid = (headers["npts"] > 0) & (sampling_rates > 0)
+    records = np.empty(np.count_nonzero(valid), dtype=RECORD_DTYPE)
+    records["id"] = ids[valid]
+    records["starttime"] = starttimes[valid]
+    records["endtime"] = starttimes[valid] + \
+        headers["npts"][valid] / sampling_rates[valid]
+    records["offset"] = np.nonzero(valid)[0] * length
+    records["length"] = length
+    records["sampling_rate"] = sampling_rates[valid]
+    return records
+
+
+def _scan_variable_length_records(data):
+    """
+    Parse the headers of all records one by one.
+
+    Returns an array with RECORD_DTYPE.
+    """
+    records = []
+    year_starts = {}
+    offset = 0
+    while offset + _FIXED_HEADER_LENGTH <= len(data):
+        header = data[offset:offset + _FIXED_HEADER_LENGTH]
+        if header[6] not in _DATA_QUALITY_CODES:
+            msg = "Not a data record at byte %i." % offset
+            raise ValueError(msg)
+        byte_order = _get_byte_order(header)
+        year, day, hour, minute, second, _, fraction, npts, factor, \
+            multiplier, activity, _, _, _, correction, _, \
+            first_blockette = struct.unpack_from(
+                byte_order + "HHBBBBHHhhBBBBiHH", header, 20)
+        length = _get_record_length(data, offset, byte_order,
+                                    first_blockette)
+        if length is None:
+            msg = "No blockette 1000 in record at byte %i." % offset
+            raise ValueError(msg)
+        microseconds = 0
+        blockette = _find_blockette(data, offset, byte_order,
+                                    first_blockette, 1001)
+        if blockette is not None:
+            microseconds = struct.unpack_from(
+                "b", data, offset + blockette + 5)[0]
+        starttime = _get_year_start(year, year_starts) + (
+            (day - 1) * 86400 + hour * 3600 + minute * 60 + second +
+            fraction * 1E-4 + microseconds * 1E-6)
+        # Apply the time correction unless it already is.
+        if not activity & 2:
+            starttime += correction * 1E-4
+        sampling_rate = _get_sampling_rate(factor, multiplier)
+        if npts and sampling_rate:
+            trace_id = ".".join(header[_i:_j].strip() for _i, _j in
+                                [(18, 20), (8, 13), (13, 15), (15, 18)])
+            records.append((trace_id, starttime,
+                            starttime + npts / sampling_rate, offset,
+                            length, sampling_rate))
+        offset += length
+    return np.array(records, dtype=RECORD_DTYPE)
+
+
+def scan_records(filename):
+    """
+    Parse the fixed header of all records of a miniSEED file.
+
+    Returns an array with RECORD_DTYPE sorted by trace id and starttime. The
+    endtime of a record is the time of the sample after its last sample.
+
+    Raises ValueError if the file is not a miniSEED file with a record
+    length in every record.
+    """
+    with open(filename, "rb") as open_file:
+        if os.fstat(open_file.fileno()).st_size < _FIXED_HEADER_LENGTH:
+            msg = "File too small."
+            raise ValueError(msg)
+        data = mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[6] not in _DATA_QUALITY_CODES:
+            msg = "Not a data record at byte 0."
+            raise ValueError(msg)
+        records = _scan_fixed_length_records(data)
+        if records is None:
+            records = _scan_variable_length_records(data)
+    finally:
+        data.close()
+    return np.sort(records, order=["id", "starttime"])
+
+
+def get_trace_spans(records):
+    """
+    Merge the records returned by scan_records() into traces.
+
+    Consecutive records of a trace id with the same sampling rate are merged
+    if the second one starts within half a sample of the end of the first
+    one, like ObsPy does when reading the file.
+
+    Returns a list of (trace_id, starttime, endtime) tuples with the times
+    as timestamps. The endtime is the time of the last sample, counted from
+    the starttime with the samples of all merged records.
+    """
+    if not len(records):
+        return []
+    ids = records["id"]
+    rates = records["sampling_rate"]
+    starts = np.ones(len(records), dtype=np.bool_)
+    starts[1:] = (ids[1:] != ids[:-1]) | (rates[1:] != rates[:-1]) | (
+        np.abs(records["starttime"][1:] - records["endtime"][:-1]) >
+        0.5 / rates[1:])
+    first = np.nonzero(starts)[0]
+    npts = np.add.reduceat(np.round(
+        (records["endtime"] - records["starttime"]) * rates), first)
+    starttimes = records["starttime"][first]
+    return zip(ids[first].tolist(), starttimes.tolist(),
+               (starttimes + (npts - 1) / rates[first]).tolist())
+
+
+def select_records(records, starttime, endtime):
+    """
+    Returns the records covering the time span from starttime to endtime
+    sorted by their offset.
+
+    One more record is added on both sides of every covered run of records
+    of a trace, so samples next to the boundaries are always included.
+    """
+    indices = np.nonzero((records["starttime"] <= endtime) &
+                         (records["endtime"] >= starttime))[0]
+    if not len(indices):
+        return records[:0]
+    ids = records["id"]
+    indices = [indices]
+    for shift in -1, 1:
+        neighbours = indices[0] + shift
+        valid = (neighbours >= 0) & (neighbours < len(records))
+        neighbours = neighbours[valid]
+        indices.append(neighbours[ids[neighbours] ==
+                                  ids[indices[0][valid]]])
+    selected = records[np.unique(np.concatenate(indices))]
+    return np.sort(selected, order="offset")
+
+
+class RecordIndex(object):
+    """
+    Per file record indices of miniSEED files stored in a directory.
+
+    Usage
+    =====
+
+    >>> index = RecordIndex("working_files/waveform_records")
+    >>> index.save("BW.FURT..EHZ.D.2010.005",
+    ...            scan_records("BW.FURT..EHZ.D.2010.005"))
+    >>> stream = index.read("BW.FURT..EHZ.D.2010.005",
+    ...                     UTCDateTime(2010, 1, 5, 12),
+    ...                     UTCDateTime(2010, 1, 5, 12, 0, 2))
+
+    read() returns None for files without an index. The most recently used
+    indices are kept in memory.
+    """
+    def __init__(self, directory, max_files=DEFAULT_MAX_FILES):
+        """
+        :param directory: Directory of the index files. Created if
+            necessary.
+        :param max_files: Number of indices kept in memory.
+        """
+        self.directory = directory
+        self.max_files = max_files
+        self._records = OrderedDict()
+        self.reads = 0
+        self.bytes_read = 0
+
+    def get_index_filename(self, filename):
+        """
+        Returns the name of the index file of a waveform file.
+        """
+        key = hashlib.md5(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.directory, key + ".npy")
+
+    def save(self, filename, records):
+        """
+        Store the records of a waveform file, see scan_records().
+        """
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created by another process in the meantime.
+                if not os.path.isdir(self.directory):
+                    raise
+        np.save(self.get_index_filename(filename), records)
+        self._records.pop(filename, None)
+
+    def remove(self, filename):
+        """
+        Remove the index of a waveform file if it exists.
+        """
+        self._records.pop(filename, None)
+        index_filename = self.get_index_filename(filename)
+        if os.path.exists(index_filename):
+            os.remove(index_filename)
+
+    def get(self, filename, scan=False):
+        """
+        Returns the records of a waveform file or None if it has no index.
+
+        :param scan: Scan the file on first use and only keep its index in
+            memory instead of loading a stored index. For files that were not
+            scanned beforehand.
+        """
+        records = self._records.pop(filename, None)
+        if records is None:
+            if scan:
+                try:
+                    records = scan_records(filename)
+                except ValueError:
+                    # Remember files that are not miniSEED.
+                    records = False
+            else:
+                index_filename = self.get_index_filename(filename)
+                if not os.path.exists(index_filename):
+                    return None
+                records = np.load(index_filename)
+        # The last entry is the most recently used one.
+        self._records[filename] = records
+        while len(self._records) > self.max_files:
+            self._records.popitem(last=False)
+        if records is False:
+            return None
+        return records
+
+    def read(self, filename, starttime, endtime, scan=False):
+        """
+        Returns a stream with the records of a waveform file covering the
+        time span from starttime to endtime or None if the file has no
+        index.
+
+        :param scan: See get().
+        """
+        records = self.get(filename, scan=scan)
+        if records is None:
+            return None
+        records = select_records(records, float(starttime.timestamp),
+                                 float(endtime.timestamp))
+        if not len(records):
+            return Stream()
+        with open(filename, "rb") as open_file:
+            data = mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            buf = "".join(data[_i:_i + _j] for _i, _j in
+                          zip(records["offset"], records["length"]))
+        finally:
+            data.close()
+        self.reads += 1
+        self.bytes_read += len(buf)
+        return read(io.BytesIO(buf), format="MSEED")
+
+    def clear(self):
+        """
+        Remove all indices from memory. The counters are kept.
+        """
+        self._records.clear()
@@ -0,0 +1,220 @@
+"""
+Compact cache of the pre-processed waveform snippets around picks.
+
+The cross correlation only ever looks at a short time window around every
+pick. Instead of reading and filtering the full waveform files for every pick
+pair, the window of every pick and channel is cut, detrended, tapered and
+filtered exactly once and stored here. The pairwise cross correlation then
+only works on these snippets.
+
+Snippets are padded on both sides so the filter transients do not reach the
+part of the snippet used for the cross correlation.
+
+On disk the cache consists of two files:
+
+    * "filename".npy - All snippets concatenated into one float32 array.
+    * "filename".json - The parameters used to create the snippets and the
+      index into the data array, e.g. the offset and length of the snippet
+      of every pick and channel.
+
+The data array can be loaded memory mapped. All processes working on the
+same cache, like the forked cross correlation workers, then share one copy
+of the snippets in the page cache instead of each holding its own.
+"""
+import json
+import os
+
+import numpy as np
+from obspy import Trace, UTCDateTime
+from obspy.signal.invsim import cosine_taper
+
+
+# Number of periods of the lower filter corner frequency added as padding on
+# both sides of each snippet to absorb the filter transients.
+SNIPPET_PADDING_PERIODS = 3.0
+
+
+def get_snippet_window(pick_time, cc_param):
+    """
+    Returns the start- and endtime of the snippet for a pick.
+
+    The window covers cc_time_before/cc_time_after plus cc_maxlag on both
+    sides plus the filter padding.
+    """
+    padding = SNIPPET_PADDING_PERIODS / cc_param["cc_filter_min_freq"]
+    starttime = pick_time - cc_param["cc_time_before"] - \
+        cc_param["cc_maxlag"] - padding
+    endtime = pick_time + cc_param["cc_time_after"] + \
+        cc_param["cc_maxlag"] + padding
+    return starttime, endtime
+
+
+def cut_snippet(trace, starttime, endtime, freqmin, freqmax):
+    """
+    Cut the given time window out of the trace and pre-process it the same
+    way xcorr_pick_correction() pre-processes the full trace.
+
+    Returns a new trace with float32 data.
+    """
+    snippet = trace.slice(starttime, endtime).copy()
+    snippet.data = snippet.data.astype(np.float64)
+    snippet.detrend(type="demean")
+    snippet.data *= cosine_taper(len(snippet), 0.1)
+    snippet.filter("bandpass", freqmin=freqmin, freqmax=freqmax)
+    snippet.data = np.require(snippet.data, dtype=np.float32)
+    return snippet
+
+
+class WaveformSnippets(object):
+    """
+    Stores the pre-processed waveform snippet of every pick and channel.
+
+    For every pick either no data at all is available or there is one entry
+    per channel. A channel entry is either the snippet or an error message
+    explaining why no snippet could be cut.
+    """
+    def __init__(self, parameters):
+        """
+        :param parameters: Dictionary with all parameters that influence the
+            snippets. A stored cache will only be reused if they are
+            identical.
+        """
+        self.parameters = parameters
+        self._picks = {}
+
+    def __contains__(self, pick_id):
+        """
+        True if the pick has already been processed.
+        """
+        return pick_id in self._picks
+
+    def __len__(self):
+        return len(self._picks)
+
+    def add_missing_pick(self, pick_id):
+        """
+        Mark a pick for which no waveform data could be found.
+        """
+        self._picks[pick_id] = None
+
+    def add(self, pick_id, channel, snippet):
+        """
+        Store the snippet trace of one pick and channel.
+        """
+        self._picks.setdefault(pick_id, {})[channel] = (
+            snippet.id, float(snippet.stats.starttime.timestamp),
+            float(snippet.stats.sampling_rate),
+            np.require(snippet.data, dtype=np.float32))
+
+    def add_error(self, pick_id, channel, msg):
+        """
+        Store the reason why no snippet exists for one pick and channel.
+        """
+        self._picks.setdefault(pick_id, {})[channel] = msg
+
+    def has_data(self, pick_id):
+        """
+        True if waveform data has been found for the pick.
+        """
+        return self._picks.get(pick_id) is not None
+
+    def get(self, pick_id, channel):
+        """
+        Returns the snippet of the pick and channel as a Trace, the error
+        message as a string or None if nothing is known.
+        """
+        channels = self._picks.get(pick_id)
+        if not channels:
+            return None
+        entry = channels.get(channel)
+        if entry is None or isinstance(entry, basestring):
+            return entry
+        trace_id, starttime, sampling_rate, data = entry
+        network, station, location, channel = trace_id.split(".")
+        # Always a copy, also of memory mapped data.
+        return Trace(data=np.array(data, dtype=np.float64), header={
+            "network": network, "station": station, "location": location,
+            "channel": channel, "sampling_rate": sampling_rate,
+            "starttime": UTCDateTime(starttime)})
+
+    def save(self, filename):
+        """
+        Write the cache to filename.npy and filename.json.
+
+        Both files are replaced atomically, so caches loaded memory mapped
+        from them before stay valid.
+        """
+        index = {}
+        arrays = []
+        offset = 0
+        for pick_id, channels in self._picks.iteritems():
+            if channels is None:
+                index[pick_id] = None
+                continue
+            index[pick_id] = {}
+            for channel, entry in channels.iteritems():
+                if isinstance(entry, basestring):
+                    index[pick_id][channel] = entry
+                    continue
+                trace_id, starttime, sampling_rate, data = entry
+                index[pick_id][channel] = [trace_id, starttime,
+                                           sampling_rate, offset, len(data)]
+                arrays.append(data)
+                offset += len(data)
+        if arrays:
+            data = np.concatenate(arrays)
+        else:
+            data = np.empty(0, dtype=np.float32)
+        with open(filename + ".npy.tmp", "wb") as open_file:
+            np.save(open_file, data)
+        with open(filename + ".json.tmp", "w") as open_file:
+            json.dump({"parameters": self.parameters, "index": index},
+                      open_file)
+        os.rename(filename + ".npy.tmp", filename + ".npy")
+        os.rename(filename + ".json.tmp", filename + ".json")
+
+    @staticmethod
+    def delete(filename):
+        """
+        Remove a cache stored with save().
+        """
+        for extension in [".npy", ".json"]:
+            if os.path.exists(filename + extension):
+                os.remove(filename + extension)
+
+    @classmethod
+    def load(cls, filename, parameters, memory_map=False):
+        """
+        Load a cache stored with save().
+
+        Returns an empty cache if no cache exists or if it has been created
+        with different parameters.
+
+        :param memory_map: Memory map the snippet data read-only instead of
+            reading it into memory.
+        """
+        snippets = cls(parameters)
+        if not os.path.exists(filename + ".json") or \
+                not os.path.exists(filename + ".npy"):
+            return snippets
+        with open(filename + ".json", "r") as open_file:
+            info = json.load(open_file)
+        # Round trip the parameters through JSON so they compare properly.
+        if info["parameters"] != json.loads(json.dumps(parameters)):
+            return snippets
+        data = np.load(filename + ".npy",
+                       mmap_mode="r" if memory_map else None)
+        for pick_id, channels in info["index"].iteritems():
+            if channels is None:
+                snippets._picks[pick_id] = None
+                continue
+            snippets._picks[pick_id] = {}
+            for channel, entry in channels.iteritems():
+                if isinstance(entry, basestring):
+                    snippets._picks[pick_id][channel] = entry
+                    continue
+                trace_id, starttime, sampling_rate, offset, npts = entry
+                snippets._picks[pick_id][channel] = (
+                    str(trace_id), starttime, sampling_rate,
+                    data[offset:offset + npts])
+        return snippets
@@ -0,0 +1,245 @@
+"""
+Sources of the waveform data the snippets around the picks are cut from.
+
+A source finds the data of a station covering a time span. Three sources are
+available:
+
+    * FileListSource - An explicit list of waveform files. All files are
+      scanned once and looked up with an interval index, see
+      HypoDDRelocator.add_waveform_files().
+    * SDSSource - A SeisComP Data Structure archive. The paths of the day
+      files are computed from the network, station, channel and day of a
+      pick, so nothing has to be scanned upfront.
+    * InMemorySource - Traces kept in memory, e.g. for tests.
+
+File based sources return filenames which the relocator reads through its
+waveform cache and record index. Other sources read the data themselves.
+"""
+import hashlib
+import os
+
+from obspy.core import Stream, UTCDateTime
+
+from stage_cache import get_files_fingerprint, get_fingerprint
+
+
+class WaveformSource(object):
+    """
+    Base class of all waveform sources.
+
+    Subclasses implement get_fingerprint() and find() and, unless they
+    return filenames, read().
+    """
+    # If True, find() returns filenames of waveform files readable by ObsPy.
+    returns_files = True
+
+    def get_fingerprint(self):
+        """
+        Returns a fingerprint of the data of the source. Cached cross
+        correlations are discarded once it changes.
+        """
+        raise NotImplementedError
+
+    def get_inventory_files(self):
+        """
+        Returns the list of files that need to be scanned before find() can
+        be used or None if the source needs no scan.
+        """
+        return None
+
+    def find(self, station_id, starttime, endtime, components="ENZ"):
+        """
+        Returns a sorted list of the keys, e.g. filenames, of all data of a
+        station that might cover the span from starttime to endtime.
+
+        :param station_id: Station id in the form network.station
+        :param components: Only channels whose last letter is in components
+            are considered.
+        """
+        raise NotImplementedError
+
+    def read(self, key, starttime, endtime):
+        """
+        Returns a stream with the data of a key returned by find(). It
+        contains at least the span from starttime to endtime if available.
+        """
+        raise NotImplementedError
+
+
+class FileListSource(WaveformSource):
+    """
+    Waveform files given as a list. The files must be scanned and the
+    resulting index set with set_index() before find() can be used.
+    """
+    def __init__(self, filenames=None):
+        """
+        :param filenames: List of waveform files. The list is used as is, so
+            files appended to it later are part of the source.
+        """
+        self.filenames = filenames if filenames is not None else []
+        self.index = None
+
+    def get_fingerprint(self):
+        return get_files_fingerprint(self.filenames)
+
+    def get_inventory_files(self):
+        return self.filenames
+
+    def set_index(self, index):
+        """
+        Set the interval index of the scanned files, see waveform_index.py.
+        """
+        self.index = index
+
+    def find(self, station_id, starttime, endtime, components="ENZ"):
+        if self.index is None:
+            msg = "The waveform files have not been scanned yet."
+            raise ValueError(msg)
+        return self.index.find(station_id, starttime, endtime,
+                               components=components)
+
+
+class SDSSource(WaveformSource):
+    """
+    A SeisComP Data Structure archive, i.e. day files at
+
+        root/YEAR/NET/STA/CHAN.TYPE/NET.STA.LOC.CHAN.TYPE.YEAR.DAY
+
+    Only the channel directories of a station and, unless the location
+    codes are given, the day files of a channel are listed, once per year.
+
+    Usage
+    =====
+
+    >>> source = SDSSource("/data/sds")
+    >>> source.find("BW.FURT", UTCDateTime(2010, 1, 5, 12),
+    ...             UTCDateTime(2010, 1, 5, 12, 0, 1))
+    ['/data/sds/2010/BW/FURT/EHE.D/BW.FURT..EHE.D.2010.005', ...]
+    """
+    def __init__(self, root, data_type="D", locations=None):
+        """
+        :param root: Root directory of the archive.
+        :param data_type: The SDS data type of the files.
+        :param locations: List of location codes to use. Defaults to all
+            location codes in the archive.
+        """
+        self.root = root
+        self.data_type = data_type
+        self.locations = locations
+        self._channels = {}
+        self._locations = {}
+
+    def get_fingerprint(self):
+        return get_fingerprint("SDS", os.path.abspath(self.root),
+                               self.data_type, self.locations)
+
+    def get_filename(self, network, station, location, channel, year,
+                     julday):
+        """
+        Returns the path of a day file in the archive.
+        """
+        return os.path.join(
+            self.root, "%04i" % year, network, station,
+            "%s.%s" % (channel, self.data_type),
+            "%s.%s.%s.%s.%s.%04i.%03i" % (network, station, location, channel,
+                                          self.data_type, year, julday))
+
+    def _get_channels(self, year, network, station):
+        """
+        Returns the channels of a station in a year.
+        """
+        key = (year, network, station)
+        if key not in self._channels:
+            directory = os.path.join(self.root, "%04i" % year, network,
+                                     station)
+            suffix = "." + self.data_type
+            channels = []
+            if os.path.isdir(directory):
+                channels = sorted(_i[:-len(suffix)] for _i in
+                                  os.listdir(directory) if _i.endswith(suffix))
+            self._channels[key] = channels
+        return self._channels[key]
+
+    def _get_locations(self, year, network, station, channel):
+        """
+        Returns the location codes of a channel in a year.
+        """
+        if self.locations is not None:
+            return self.locations
+        key = (year, network, station, channel)
+        if key not in self._locations:
+            directory = os.path.join(
+                self.root, "%04i" % year, network, station,
+                "%s.%s" % (channel, self.data_type))
+            locations = set()
+            for filename in os.listdir(directory):
+                parts = filename.split(".")
+                if len(parts) == 7 and parts[:2] == [network, station] and \
+                        parts[3] == channel:
+                    locations.add(parts[2])
+            self._locations[key] = sorted(locations)
+        return self._locations[key]
+
+    def find(self, station_id, starttime, endtime, components="ENZ"):
+        network, station = station_id.split(".")
+        filenames = []
+        day = UTCDateTime(starttime.date)
+        while day <= endtime:
+            for channel in self._get_channels(day.year, network, station):
+                if channel[-1] not in components:
+                    continue
+                for location in self._get_locations(day.year, network,
+                                                    station, channel):
+                    filename = self.get_filename(network, station, location,
+                                                 channel, day.year,
+                                                 day.julday)
+                    if os.path.exists(filename):
+                        filenames.append(filename)
+            day += 86400
+        return sorted(filenames)
+
+
+class InMemorySource(WaveformSource):
+    """
+    Traces kept in memory. The keys returned by find() are the indices of
+    the traces.
+    """
+    returns_files = False
+
+    def __init__(self, stream=None):
+        """
+        :param stream: Stream with the initial traces.
+        """
+        self.stream = Stream()
+        if stream is not None:
+            self.add(stream)
+
+    def add(self, stream):
+        """
+        Add all traces of a stream.
+        """
+        self.stream += stream
+
+    def get_fingerprint(self):
+        digest = hashlib.sha1()
+        for trace in self.stream:
+            digest.update(trace.id)
+            digest.update(str(trace.stats.starttime))
+            digest.update(repr(trace.stats.sampling_rate))
+            digest.update(trace.data.tostring())
+        return digest.hexdigest()
+
+    def find(self, station_id, starttime, endtime, components="ENZ"):
+        keys = []
+        for key, trace in enumerate(self.stream):
+            if "%s.%s" % (trace.stats.network, trace.stats.station) != \
+                    station_id or trace.stats.channel[-1:] not in components:
+                continue
+            if trace.stats.starttime <= starttime and \
+                    trace.stats.endtime >= endtime:
+                keys.append(key)
+        return keys
+
+    def read(self, key, starttime, endtime):
+        # Slices share the data but have their own header.
+        return Stream(traces=[self.stream[key].slice(starttime, endtime)])